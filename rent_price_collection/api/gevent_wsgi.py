@@ -0,0 +1,22 @@
+"""
+:author: Henley Kuang
+:since: 06/08/2019
+
+Event loop serving mode. Each request runs in a greenlet instead of a thread, so a worker can hold
+hundreds of slow searches open at once. PyMySQL stands in for MySQLdb since the C driver blocks the
+whole event loop while waiting on MySQL, the pure python driver yields on the patched socket instead.
+Same app and routes as wsgi.py, see run_uwsgi_gevent.sh.
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import pymysql
+pymysql.install_as_MySQLdb()
+
+from rent_price_collection.api.rent_price_collection_api import app as application
+
+
+if __name__ == "__main__":
+    from gevent.pywsgi import WSGIServer
+    WSGIServer(("0.0.0.0", 8081), application).serve_forever()
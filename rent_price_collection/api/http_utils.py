@@ -0,0 +1,104 @@
+"""
+:author: Henley Kuang
+:since: 05/26/2019
+
+Response compression and ETag helpers for the api.
+"""
+
+import gzip
+import hashlib
+import io
+
+try:
+    import brotli
+except ImportError:
+    # brotli is optional, without it only gzip is offered
+    brotli = None
+
+# bodies smaller than this are not worth the compression cpu
+MIN_COMPRESS_BYTES = 500
+GZIP_COMPRESS_LEVEL = 6
+BROTLI_QUALITY = 5
+
+def _accepted_encodings(accept_encoding):
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        pieces = part.strip().split(";")
+        encoding = pieces[0].strip().lower()
+        if not encoding:
+            continue
+        quality = 1.0
+        for param in pieces[1:]:
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[encoding] = quality
+    return accepted
+
+def negotiate_encoding(accept_encoding, offered=None):
+    """
+    Pick the content encoding to respond with, None for identity
+
+    >>> negotiate_encoding('gzip, deflate')
+    'gzip'
+    >>> negotiate_encoding('gzip;q=0') is None
+    True
+    >>> negotiate_encoding('br, gzip', offered=('gzip',))
+    'gzip'
+
+    :param offered: encodings the response can be sent in by preference, defaults to br when available then gzip
+    """
+    if offered is None:
+        offered = ("br", "gzip") if brotli is not None else ("gzip",)
+    accepted = _accepted_encodings(accept_encoding)
+    for encoding in offered:
+        if accepted.get(encoding, 0) > 0:
+            return encoding
+    return None
+
+def compress_body(body, encoding):
+    if isinstance(body, type(u"")):
+        body = body.encode("utf-8")
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    if encoding == "gzip":
+        out = io.BytesIO()
+        with gzip.GzipFile(fileobj=out, mode="wb", compresslevel=GZIP_COMPRESS_LEVEL) as gzip_out:
+            gzip_out.write(body)
+        return out.getvalue()
+    return body
+
+def make_etag(*parts):
+    """Strong validator computed from whatever determines the response, e.g. the cache generation and key"""
+    return hashlib.sha1("|".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+def encoded_etag(etag, encoding):
+    """Each encoding is a different representation so it needs its own strong ETag"""
+    if encoding is None:
+        return etag
+    return "%s-%s" % (etag, encoding)
+
+def compress_response(response, accept_encoding):
+    """Compress a buffered response in place when the client accepts it"""
+    if response.direct_passthrough or response.is_streamed:
+        return response
+    if response.status_code < 200 or response.status_code in (204, 304):
+        return response
+    if "Content-Encoding" in response.headers:
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate_encoding(accept_encoding)
+    if encoding is None:
+        return response
+    body = response.get_data()
+    if len(body) < MIN_COMPRESS_BYTES:
+        return response
+    response.set_data(compress_body(body, encoding))
+    response.headers["Content-Encoding"] = encoding
+    etag, is_weak = response.get_etag()
+    if etag:
+        response.set_etag(encoded_etag(etag, encoding), weak=is_weak)
+    return response
@@ -1,54 +1,452 @@
-from collections import namedtuple
-from flask import Flask, json, request
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from flask import Flask, Response, json, request, stream_with_context
 from flask_cors import CORS
 
+from rent_price_collection.api.http_utils import (
+    compress_body,
+    compress_response,
+    encoded_etag,
+    make_etag,
+    negotiate_encoding,
+)
+from rent_price_collection.misc.export import (
+    gzip_chunks,
+    ndjson_chunks,
+)
+from rent_price_collection.storage.all_listings_autocomplete import (
+    AUTOCOMPLETE_FIELDS,
+    MAX_SUGGESTIONS,
+    AllListingsAutocomplete,
+)
+from rent_price_collection.storage.all_listings_columnar import (
+    AllListingsColumnar,
+    SnapshotGeneration,
+)
 from rent_price_collection.storage.all_listings_mysql import (
     AllListingsMySql,
     SearchParameterObject,
     SEARCH_PARAMETERS,
 )
+from rent_price_collection.storage.all_listings_tiles import (
+    MAX_ZOOM,
+    AllListingsTiles,
+)
+from rent_price_collection.storage.connection_pool import (
+    MySqlPool,
+)
+from rent_price_collection.storage.listing_stats_mysql import (
+    ListingStatsMySql,
+    StatsParameterObject,
+    STATS_PARAMETERS,
+)
+from rent_price_collection.utils.cache import (
+    FileCacheBackend,
+    SearchResultCache,
+    WatermarkGeneration,
+    search_cache_key,
+)
+from rent_price_collection.utils.config import (
+    API_PROFILE_FLUSH_SECONDS,
+    API_PROFILE_MODE,
+    API_PROFILE_SAMPLE_RATE,
+    API_SERVING_MODE,
+    AUTOCOMPLETE_ENABLED,
+    EXPORT_CHUNK_ROWS,
+    MYSQL_POOL_SIZE,
+    PROFILE_DIR,
+    SEARCH_BATCH_MAX_QUERIES,
+    SEARCH_CACHE_MAX_ENTRIES,
+    SEARCH_CACHE_SHARED_DIR,
+    SEARCH_CACHE_TTL_SECONDS,
+    SEARCH_CACHE_WATERMARK_CHECK_SECONDS,
+    TILES_ENABLED,
+    TILES_MAX_AGE_SECONDS,
+)
+from rent_price_collection.utils.exceptions import (
+    InvalidSearchParameterException,
+)
+from rent_price_collection.utils.geo import (
+    parse_bbox,
+    parse_near,
+    parse_radius,
+)
+from rent_price_collection.utils.profiling import (
+    ProfilingMiddleware,
+    profile_path_prefix,
+)
 
 app = Flask(__name__)
 CORS(app)
 
-all_listings_mysql = AllListingsMySql()
+# opt in profiling by route, every uwsgi worker writes its own files
+if API_PROFILE_MODE:
+    app.wsgi_app = ProfilingMiddleware(app.wsgi_app, API_PROFILE_MODE, profile_path_prefix(PROFILE_DIR, "api"),
+                                       sample_rate=API_PROFILE_SAMPLE_RATE, flush_seconds=API_PROFILE_FLUSH_SECONDS)
+
+# concurrent requests each borrow their own connection
+all_listings_pool = MySqlPool(AllListingsMySql)
+listing_stats_pool = MySqlPool(ListingStatsMySql)
+
+# searches go to mysql, or to an in memory replica refreshed in the background
+all_listings_columnar = None
+if API_SERVING_MODE == 'columnar':
+    all_listings_columnar = AllListingsColumnar(AllListingsMySql())
+    all_listings_columnar.start()
+
+# autocomplete and tiles each hold every listing in memory, so they are opt in
+all_listings_autocomplete = None
+if AUTOCOMPLETE_ENABLED:
+    all_listings_autocomplete = AllListingsAutocomplete(AllListingsMySql())
+    all_listings_autocomplete.start()
+
+all_listings_tiles = None
+if TILES_ENABLED:
+    all_listings_tiles = AllListingsTiles(AllListingsMySql())
+    all_listings_tiles.start()
+
+def _search_listings(search_parameter_object, **kwargs):
+    if all_listings_columnar is not None:
+        return all_listings_columnar.search_listings(search_parameter_object, **kwargs)
+    with all_listings_pool.connection() as all_listings_mysql:
+        return all_listings_mysql.search_listings(search_parameter_object, **kwargs)
+
+SEARCH_LIMIT = 20
+
+SearchQuery = namedtuple('SearchQuery', ['search_parameter_object', 'offset', 'sortby', 'sortdesc',
+                                         'bbox', 'near', 'radius', 'cache_key', 'filter_key'])
+
+# runs the queries of a /search/batch request in parallel, one pooled connection each
+search_executor = ThreadPoolExecutor(max_workers=MYSQL_POOL_SIZE)
+
+def _select_last_date_changed():
+    with all_listings_pool.connection() as all_listings_mysql:
+        return all_listings_mysql.select_last_date_changed()
+
+# columnar results change with the snapshot they are read from, which lags mysql. Otherwise the generation
+# file only sees writes made on this box, the date_changed watermark sees every write
+if all_listings_columnar is not None:
+    search_generation = SnapshotGeneration(all_listings_columnar)
+else:
+    search_generation = WatermarkGeneration(_select_last_date_changed, SEARCH_CACHE_WATERMARK_CHECK_SECONDS)
+    search_generation.start()
+
+search_cache = SearchResultCache(
+    SEARCH_CACHE_MAX_ENTRIES,
+    SEARCH_CACHE_TTL_SECONDS,
+    shared_backend=FileCacheBackend(SEARCH_CACHE_SHARED_DIR, SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_TTL_SECONDS)
+    if SEARCH_CACHE_SHARED_DIR else None,
+    generation=search_generation,
+)
+
+def _error_response(message, status):
+    return app.response_class(
+        response=json.dumps({"error": message}),
+        status=status,
+        mimetype='application/json'
+    )
+
+@app.after_request
+def _compress_response(response):
+    return compress_response(response, request.headers.get("Accept-Encoding"))
 
 @app.route("/")
 def hello():
     return "Hello World!"
 
-@app.route("/search", methods=['GET'])
-def search():
+def _get_search_parameter_object(args):
     search_parameters_list = []
     for name in SEARCH_PARAMETERS:
         try:
-            value = request.args[name]
+            value = args[name]
             search_parameters_list.append(value)
         except KeyError:
             search_parameters_list.append(None)
+    return SearchParameterObject._make(search_parameters_list)
+
+def _get_geo_parameters(args):
+    """bbox=west,south,east,north or near=lat,lng&radius=miles"""
+    bbox = None
+    near = None
+    radius = None
+    if "bbox" in args:
+        bbox = parse_bbox(_comma_separated(args["bbox"]))
+    if "near" in args:
+        near = parse_near(_comma_separated(args["near"]))
+        radius = parse_radius(args.get("radius"))
+    return bbox, near, radius
+
+def _comma_separated(value):
+    # batch queries are json and may send coordinates as a list
+    if isinstance(value, (list, tuple)):
+        return ",".join(str(v) for v in value)
+    return value
+
+def _get_search_query(args):
+    """Parse and validate /search parameters from the query string or a batch query dict"""
+    bbox, near, radius = _get_geo_parameters(args)
+    offset = args.get("offset", 0)
+    try:
+        offset = int(offset)
+    except (TypeError, ValueError):
+        raise InvalidSearchParameterException("offset must be an integer: %s" % offset)
+    search_parameter_object = _get_search_parameter_object(args)
+    sortby = args.get("sortby", "date_updated")
+    sortdesc = args.get("sortdesc", False)
+    return SearchQuery(
+        search_parameter_object=search_parameter_object,
+        offset=offset,
+        sortby=sortby,
+        sortdesc=sortdesc,
+        bbox=bbox,
+        near=near,
+        radius=radius,
+        cache_key=search_cache_key(search_parameter_object, SEARCH_LIMIT, offset, sortby, sortdesc,
+                                   bbox=bbox, near=near, radius=radius),
+        # queries differing only in page or sort order share this key and so share one count
+        filter_key=search_cache_key(search_parameter_object, SEARCH_LIMIT, 0, None, False,
+                                    bbox=bbox, near=near, radius=radius),
+    )
+
+def _get_search_body(search_query, generation, count=None):
+    """Return the JSON results of a search, from the cache when possible"""
+    response_body = search_cache.get(search_query.cache_key)
+    if response_body is None:
+        results = _search_listings(search_query.search_parameter_object, limit=SEARCH_LIMIT,
+                                   offset=search_query.offset, sortby=search_query.sortby,
+                                   desc=search_query.sortdesc, bbox=search_query.bbox,
+                                   near=search_query.near, radius=search_query.radius, count=count)
+        response_body = json.dumps(results)
+        search_cache.set(search_query.cache_key, response_body, generation=generation)
+    return response_body
+
+def _get_since():
+    since = request.args.get("since")
+    if not since:
+        return None
+    for since_format in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(since, since_format)
+        except ValueError:
+            pass
+    raise InvalidSearchParameterException("since must look like YYYY-MM-DD HH:MM:SS: %s" % since)
 
-    offset = 0
+def _get_day(name):
+    day = request.args.get(name)
+    if not day:
+        return None
     try:
-        offset = request.args["offset"]
-    except KeyError:
-        pass
+        return datetime.strptime(day, "%Y-%m-%d").date()
+    except ValueError:
+        raise InvalidSearchParameterException("%s must look like YYYY-MM-DD: %s" % (name, day))
 
-    sortby = "date_updated"
+def _accepts_gzip():
+    # exports are only streamed through gzip, "gzip;q=0" refuses it
+    return negotiate_encoding(request.headers.get("Accept-Encoding"), offered=("gzip",)) == "gzip"
+
+@app.route("/search", methods=['GET'])
+def search():
     try:
-        sortby = request.args["sortby"]
-    except KeyError:
-        pass
+        search_query = _get_search_query(request.args)
+    except InvalidSearchParameterException as e:
+        return _error_response(str(e), 400)
+    cache_key = search_query.cache_key
+    # read the generation before querying so a merge committed mid query is not cached as current
+    generation = search_cache.generation.current()
+    encoding = negotiate_encoding(request.headers.get("Accept-Encoding"))
+    etag = encoded_etag(make_etag(generation, cache_key), encoding)
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        response.vary.add("Accept-Encoding")
+        return response
+
+    # compressed bodies are cached per encoding so hits skip compression as well
+    encoded_cache_key = "%s|%s" % (cache_key, encoding)
+    response_body = search_cache.get(encoded_cache_key)
+    if response_body is None:
+        try:
+            response_body = _get_search_body(search_query, generation)
+        except InvalidSearchParameterException as e:
+            return _error_response(str(e), 400)
+        if encoding is not None:
+            response_body = compress_body(response_body, encoding)
+            search_cache.set(encoded_cache_key, response_body, generation=generation)
+    response = app.response_class(
+        response=response_body,
+        status=200,
+        mimetype='application/json'
+    )
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    response.set_etag(etag)
+    return response
+
+def _run_search_group(search_queries, generation):
+    """Run queries sharing the same filters, the first one's count is reused by the rest"""
+    bodies = []
+    count = None
+    for search_query in search_queries:
+        response_body = _get_search_body(search_query, generation, count=count)
+        if count is None:
+            count = json.loads(response_body)["count"]
+        bodies.append(response_body)
+    return bodies
+
+@app.route("/search/batch", methods=['POST'])
+def search_batch():
+    """
+    Run several searches in one round trip. The body is {"queries": [<search parameters>, ...]},
+    each query takes the same parameters as /search. Results come back in the same order as
+    {"results": [<search results or {"error": ...}>, ...]}.
+    Identical queries run once, queries differing only in offset or sort share one count query,
+    and distinct filters run in parallel on pooled connections.
+    """
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or not isinstance(payload.get("queries"), list):
+        return _error_response('body must be {"queries": [...]}', 400)
+    queries = payload["queries"]
+    if len(queries) > SEARCH_BATCH_MAX_QUERIES:
+        return _error_response("at most %s queries per batch" % SEARCH_BATCH_MAX_QUERIES, 400)
 
-    sortdesc = False
+    generation = search_cache.generation.current()
+    result_bodies = [None] * len(queries)
+    # filter_key -> cache_key -> (search query, positions in the batch)
+    groups = OrderedDict()
+    for position, query_args in enumerate(queries):
+        if not isinstance(query_args, dict):
+            result_bodies[position] = json.dumps({"error": "query must be an object"})
+            continue
+        try:
+            search_query = _get_search_query(query_args)
+        except InvalidSearchParameterException as e:
+            result_bodies[position] = json.dumps({"error": str(e)})
+            continue
+        group = groups.setdefault(search_query.filter_key, OrderedDict())
+        group.setdefault(search_query.cache_key, (search_query, []))[1].append(position)
+
+    futures = []
+    for group in groups.values():
+        search_queries = [search_query for search_query, _ in group.values()]
+        futures.append((group, search_executor.submit(_run_search_group, search_queries, generation)))
+    for group, future in futures:
+        try:
+            bodies = future.result()
+        except InvalidSearchParameterException as e:
+            bodies = [json.dumps({"error": str(e)})] * len(group)
+        for (_, positions), response_body in zip(group.values(), bodies):
+            for position in positions:
+                result_bodies[position] = response_body
+
+    # the bodies are already serialized, so they are spliced in rather than decoded and encoded again
+    return app.response_class(
+        response='{"results": [%s]}' % ", ".join(result_bodies),
+        status=200,
+        mimetype='application/json'
+    )
+
+@app.route("/export", methods=['GET'])
+def export():
+    """
+    Stream every listing matching the /search filters as NDJSON, oldest date_updated first.
+    Resume an interrupted export with since=<date_updated of the last row received>.
+    Rows are read off a server side cursor only as fast as the client consumes them.
+    """
     try:
-        sortdesc = request.args["sortdesc"]
-    except KeyError:
-        pass
+        bbox, near, radius = _get_geo_parameters(request.args)
+        since = _get_since()
+    except InvalidSearchParameterException as e:
+        return _error_response(str(e), 400)
 
-    search_parameter_object = SearchParameterObject._make(search_parameters_list)
-    results = all_listings_mysql.search_listings(search_parameter_object, offset=offset, sortby=sortby, desc=sortdesc)
+    # the rows are read over a dedicated connection, the pooled one is only used to build the query
+    with all_listings_pool.connection() as all_listings_mysql:
+        rows = all_listings_mysql.iter_search_listings(_get_search_parameter_object(request.args), since=since,
+                                                       limit=request.args.get("limit", type=int),
+                                                       bbox=bbox, near=near, radius=radius)
+    chunks = ndjson_chunks(rows, EXPORT_CHUNK_ROWS)
+    headers = {"Vary": "Accept-Encoding"}
+    if _accepts_gzip():
+        chunks = gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+    return Response(stream_with_context(chunks), status=200, mimetype='application/x-ndjson', headers=headers)
+
+@app.route("/autocomplete", methods=['GET'])
+def autocomplete():
+    """
+    Suggestions for q ranked by listing count, e.g. /autocomplete?q=arl&field=city
+    field may be repeated and defaults to every field.
+    """
+    if all_listings_autocomplete is None:
+        return _error_response("autocomplete is not enabled", 404)
+    fields = request.args.getlist("field")
+    for field in fields:
+        if field not in AUTOCOMPLETE_FIELDS:
+            return _error_response("field must be one of %s" % ", ".join(sorted(AUTOCOMPLETE_FIELDS)), 400)
+    limit = min(request.args.get("limit", MAX_SUGGESTIONS, type=int), MAX_SUGGESTIONS)
+    suggestions = all_listings_autocomplete.suggest(request.args.get("q", ""), fields=fields, limit=limit)
+    return app.response_class(
+        response=json.dumps({"suggestions": suggestions}),
+        status=200,
+        mimetype='application/json'
+    )
+
+@app.route("/tiles/<int:z>/<int:x>/<int:y>", methods=['GET'])
+def tiles(z, x, y):
+    """
+    Listing clusters of a slippy map tile as {"clusters": [{"lat", "lng", "count", "median_price"}, ...]}.
+    Tiles only change when listings are merged, so they carry an etag and may be cached for a while.
+    """
+    if all_listings_tiles is None:
+        return _error_response("tiles are not enabled", 404)
+    if z > MAX_ZOOM:
+        return _error_response("z must be at most %s" % MAX_ZOOM, 400)
+    if x >= 1 << z or y >= 1 << z:
+        return _error_response("x and y must be less than %s at zoom %s" % (1 << z, z), 400)
+    # the date_changed watermark matches across workers and restarts, unlike an in process counter
+    watermark, clusters = all_listings_tiles.get_tile(z, x, y)
+    etag = make_etag(watermark, z, x, y)
+    # small tiles are sent uncompressed, so the client may hold either validator
+    encoding = negotiate_encoding(request.headers.get("Accept-Encoding"))
+    if request.if_none_match.contains(encoded_etag(etag, encoding)):
+        etag = encoded_etag(etag, encoding)
+        response = app.response_class(status=304)
+    elif request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(
+            response=json.dumps({"z": z, "x": x, "y": y, "clusters": clusters}),
+            status=200,
+            mimetype='application/json'
+        )
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = TILES_MAX_AGE_SECONDS
+    return response
+
+@app.route("/stats", methods=['GET'])
+def stats():
+    """
+    Rent stats per day from the listing_stats rollups. city is required, source, zip_code
+    and beds narrow the rollup and are rolled up across every value when left out.
+    """
+    stats_parameters_list = []
+    for name in STATS_PARAMETERS:
+        stats_parameters_list.append(request.args.get(name))
+    stats_parameter_object = StatsParameterObject._make(stats_parameters_list)
+    if stats_parameter_object.city is None:
+        return _error_response("city is required", 400)
+    try:
+        start_day = _get_day("start_day")
+        end_day = _get_day("end_day")
+    except InvalidSearchParameterException as e:
+        return _error_response(str(e), 400)
+    with listing_stats_pool.connection() as listing_stats_mysql:
+        results = listing_stats_mysql.select_listing_stats(stats_parameter_object,
+                                                           start_day=start_day, end_day=end_day)
     response = app.response_class(
-        response=json.dumps(results),
+        response=json.dumps({"stats": results}),
         status=200,
         mimetype='application/json'
     )
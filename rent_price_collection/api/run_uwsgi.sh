@@ -1 +1 @@
-uwsgi --http :8081 --wsgi-file rent_price_collection/api/wsgi.py --master --processes 2 --threads 4
\ No newline at end of file
+uwsgi --http :8081 --wsgi-file rent_price_collection/api/wsgi.py --master --processes 2 --threads 4 --lazy-apps
\ No newline at end of file
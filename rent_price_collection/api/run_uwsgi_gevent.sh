@@ -0,0 +1 @@
+uwsgi --http :8081 --wsgi-file rent_price_collection/api/gevent_wsgi.py --master --processes 2 --gevent 100 --lazy-apps
\ No newline at end of file
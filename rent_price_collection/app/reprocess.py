@@ -0,0 +1,166 @@
+"""
+:author: Henley Kuang
+:since: 06/21/2019
+
+Re-derive zillow_listings or trulia_listings rows from the raw response archive with the current parsers,
+without any api requests. Segments are parsed in parallel, only the newest observation of every listing
+is kept and the results are upserted in batches. Only what the parsers derive is rewritten: the price only
+when the observation is at least as new as the row, and date_updated is left alone, so reprocessing an
+old window never brings back stale prices or makes delisted listings look current. Listings missing
+from the table are inserted as collected and updated when they were crawled.
+Run all_listings_mysql.py union afterwards to merge the corrected rows, it rewrites every parsed column of
+all_listings and the rows that changed get a new date_changed, which the api's caches follow.
+
+python rent_price_collection/app/reprocess.py --source zillow --since 2019-05-01 --until 2019-06-01
+"""
+
+import argparse
+import calendar
+import datetime
+import logging
+import multiprocessing
+import time
+
+from collections import OrderedDict
+
+from rent_price_collection.app.trulia_rpc import (
+    TruliaRpc,
+)
+from rent_price_collection.app.zillow_rpc import (
+    ZillowRpc,
+)
+from rent_price_collection.storage.raw_response_archive import (
+    iter_pages,
+    select_segments,
+)
+from rent_price_collection.storage.trulia_mysql import (
+    TruliaMySql,
+)
+from rent_price_collection.storage.zillow_mysql import (
+    ZillowMySql,
+)
+from rent_price_collection.utils.config import (
+    DEFAULT_LOG_FORMAT_STRING,
+    RAW_RESPONSE_ARCHIVE_DIR,
+    REPROCESS_UPSERT_BATCH_SIZE,
+    REPROCESS_WORKERS,
+)
+from rent_price_collection.utils.reverse_geocoder import (
+    get_reverse_geocoder,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+def _parse_zillow_listing(listing):
+    # the parsers only read the listing, skip __init__ which connects to MySQL and starts the notifier
+    return ZillowRpc.__new__(ZillowRpc)._get_listings_named_tuple(listing)
+
+def _parse_trulia_listing(listing):
+    return [TruliaRpc.__new__(TruliaRpc)._get_listing_named_tuple(listing)]
+
+PARSERS = {
+    'zillow': _parse_zillow_listing,
+    'trulia': _parse_trulia_listing,
+}
+
+def _parse_segment(args):
+    """
+    Worker: (source, path, since, until, location) -> ((listing, crawl timestamp) oldest first, pages, failures)
+    """
+    source, path, since, until, location = args
+    parse_listing = PARSERS[source]
+    parsed = []
+    pages = 0
+    failures = 0
+    for page in iter_pages(path, since, until, location):
+        pages += 1
+        for listing in page["listings"]:
+            try:
+                parsed.extend((parsed_listing, page["timestamp"]) for parsed_listing in parse_listing(listing))
+            except Exception as e:
+                failures += 1
+                LOGGER.debug("Failed to parse a %s listing of %s page %s: %s", source, page["location"], page["page"], e)
+    return parsed, pages, failures
+
+def _upsert(source, observations):
+    """:param observations: (listing, crawl timestamp) pairs"""
+    if source == 'zillow':
+        storage = ZillowMySql()
+        upsert = storage.reprocess_zillow_listings
+    else:
+        storage = TruliaMySql()
+        upsert = storage.reprocess_trulia_listings
+    # date_updated is in the local time of CURRENT_TIMESTAMP, like the crawlers' clock
+    observations = [(listing, datetime.datetime.fromtimestamp(timestamp)) for listing, timestamp in observations]
+    try:
+        for start in range(0, len(observations), REPROCESS_UPSERT_BATCH_SIZE):
+            upsert(observations[start:start + REPROCESS_UPSERT_BATCH_SIZE])
+    finally:
+        storage.close()
+
+def reprocess(source, directory=RAW_RESPONSE_ARCHIVE_DIR, since=None, until=None, location=None,
+              workers=REPROCESS_WORKERS, dry_run=False):
+    """
+    :param since: unix timestamp, inclusive
+    :param until: unix timestamp, exclusive
+    :returns: number of listings upserted, or that would be with dry_run
+    """
+    paths = select_segments(directory, source, since, until, location)
+    LOGGER.info("Reprocessing %s %s segment(s) with %s worker(s)", len(paths), source, workers)
+    start = time.time()
+    latest = OrderedDict()
+    pages = 0
+    failures = 0
+    pool = multiprocessing.Pool(workers)
+    try:
+        # imap keeps segment order, so newer observations overwrite older ones
+        for parsed, segment_pages, segment_failures in pool.imap(
+                _parse_segment, [(source, path, since, until, location) for path in paths]):
+            pages += segment_pages
+            failures += segment_failures
+            for listing, timestamp in parsed:
+                latest.pop(listing.listing_id, None)
+                latest[listing.listing_id] = (listing, timestamp)
+    finally:
+        pool.close()
+        pool.join()
+    LOGGER.info("Parsed %s pages into %s distinct listings in %.1f seconds, %s listing(s) failed to parse",
+                pages, len(latest), time.time() - start, failures)
+
+    observations = list(latest.values())
+    reverse_geocoder = get_reverse_geocoder()
+    if reverse_geocoder is not None:
+        observations = [(reverse_geocoder.backfill(listing), timestamp) for listing, timestamp in observations]
+    if not dry_run and observations:
+        _upsert(source, observations)
+        LOGGER.info("Upserted %s %s listings", len(observations), source)
+    return len(observations)
+
+def _timestamp(date_string):
+    return calendar.timegm(datetime.datetime.strptime(date_string, "%Y-%m-%d").timetuple())
+
+def _parse_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--source', required=True, choices=sorted(PARSERS.keys()))
+    parser.add_argument('--directory', default=RAW_RESPONSE_ARCHIVE_DIR)
+    parser.add_argument('--since', type=_timestamp, help='YYYY-MM-DD, UTC, inclusive')
+    parser.add_argument('--until', type=_timestamp, help='YYYY-MM-DD, UTC, exclusive')
+    parser.add_argument('--location', help='only pages crawled for this location')
+    parser.add_argument('--workers', type=int, default=REPROCESS_WORKERS)
+    parser.add_argument('--dry-run', action='store_true', help='parse and count without writing to MySQL')
+
+    return parser.parse_args()
+
+def _main():
+    options = _parse_args()
+    if not options.directory:
+        raise SystemExit("Set RAW_RESPONSE_ARCHIVE_DIR or pass --directory")
+
+    count = reprocess(options.source, options.directory, options.since, options.until, options.location,
+                      options.workers, options.dry_run)
+    LOGGER.info("Reprocess complete. Total listings: %s", count)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format=DEFAULT_LOG_FORMAT_STRING, datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO)
+    _main()
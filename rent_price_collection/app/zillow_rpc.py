@@ -8,7 +8,9 @@ import collections
 import logging
 import json
 import re
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
 from random import randint
 from time import sleep
 
@@ -16,25 +18,69 @@ from rent_price_collection.clients.zillow_api_client import (
     ZillowApiClient,
 )
 from rent_price_collection.misc.email import (
-    GMailNotify,
+    NotificationDispatcher,
+)
+from rent_price_collection.misc.percolator import (
+    ListingAlerts,
+)
+from rent_price_collection.storage.page_fingerprints_mysql import (
+    page_fingerprint,
+    PageFingerprintsMySql,
+)
+from rent_price_collection.storage.raw_response_archive import (
+    RawResponseArchive,
 )
 from rent_price_collection.storage.zillow_mysql import (
     ZillowMySql,
 )
 from rent_price_collection.utils.config import (
     DEFAULT_LOG_FORMAT_STRING,
-    GMAIL_USER,
-    GMAIL_PASSWORD,
     GMAIL_SENT_TO_EMAILS,
+    METRICS_FILE,
+    METRICS_PORT,
+    METRICS_SUMMARY_FILE,
+    PROFILE_DIR,
+    RAW_RESPONSE_ARCHIVE_DIR,
+    SKIP_UNCHANGED_PAGES,
     SLEEP_BETWEEN_API_REQUESTS_MAX,
     SLEEP_BETWEEN_API_REQUESTS_MIN,
     SLEEP_BETWEEN_LOCATIONS_MAX,
     SLEEP_BETWEEN_LOCATIONS_MIN,
+    TRACE_FILE,
 )
 from rent_price_collection.utils.exceptions import (
     EmailSendingException,
     StoreListingResultsException,
 )
+from rent_price_collection.utils.http_archive import (
+    open_http_recorder,
+)
+from rent_price_collection.utils.metrics import (
+    increment,
+    metrics_context,
+    METRICS,
+    start_metrics_server,
+    timer,
+)
+from rent_price_collection.utils.profiling import (
+    PROFILE_MODES,
+    profile_path_prefix,
+    profile_stage,
+    start_profiler,
+    stop_profiler,
+)
+from rent_price_collection.utils.proxy_pool import (
+    load_proxy_file,
+    ProxyPool,
+)
+from rent_price_collection.utils.reverse_geocoder import (
+    get_reverse_geocoder,
+)
+from rent_price_collection.utils.tracing import (
+    LOCATION_SPAN_NAME,
+    open_trace_exporter,
+    span,
+)
 
 LOGGER = logging.getLogger(__name__)
 
@@ -56,17 +102,54 @@ ZillowListing = collections.namedtuple('ZillowListing',
     ],
 )
 
+# stored is the number of listings stored, 0 when every page was unchanged, None when nothing was stored
+LocationCrawlResult = collections.namedtuple('LocationCrawlResult',
+    [
+        'location',
+        'stored',
+        'failures',
+        'pages_fetched',
+        'pages_skipped',
+    ],
+)
+
 class ZillowRpc(object):
 
-    def __init__(self, proxy_ip=None, proxy_port=None, proxy_user=None, proxy_pass=None):
+    def __init__(self, proxy_ip=None, proxy_port=None, proxy_user=None, proxy_pass=None, api_host=None, sleep=True,
+                 skip_unchanged=SKIP_UNCHANGED_PAGES, metrics_file=METRICS_FILE, metrics_summary_file=METRICS_SUMMARY_FILE,
+                 proxy_pool=None, workers=1):
+        """
+        :param api_host: host:port of a stand-in for the api, e.g. scripts/replay_server.py
+        :param sleep: False skips the random sleeps between requests and locations, for offline runs
+        :param skip_unchanged: skip parsing and storing pages whose listing ids and prices match the last crawl
+        :param metrics_file: written with the run's metrics in the Prometheus text format at the end of run
+        :param metrics_summary_file: written with a JSON summary of the run's metrics at the end of run
+        :param proxy_pool: ProxyPool to spread requests over, instead of a single proxy
+        :param workers: locations crawled at once, each with its own sleeps between requests
+        """
         self.zillow_api_client = ZillowApiClient(
             proxy_ip=proxy_ip,
             proxy_port=proxy_port,
             proxy_user=proxy_user,
             proxy_pass=proxy_pass,
+            api_host=api_host,
+            proxy_pool=proxy_pool,
         )
+        self.sleep = sleep
+        self.workers = workers
+        # one mysql connection and alert digest is shared by every worker
+        self.storage_lock = threading.Lock()
         self.zillow_storage = ZillowMySql()
-        self.email_client = GMailNotify(GMAIL_USER, GMAIL_PASSWORD)
+        self.email_client = NotificationDispatcher()
+        self.listing_alerts = ListingAlerts("Zillow", self.email_client)
+        # fills in zip codes missing from the api response, None when no centroids file is configured
+        self.reverse_geocoder = get_reverse_geocoder()
+        # keeps the raw listings of every page for app/reprocess.py
+        self.raw_response_archive = RawResponseArchive() if RAW_RESPONSE_ARCHIVE_DIR else None
+        # fingerprints of the last stored crawl of every page, None parses and stores every page
+        self.page_fingerprints = PageFingerprintsMySql() if skip_unchanged else None
+        self.metrics_file = metrics_file
+        self.metrics_summary_file = metrics_summary_file
 
     def _get_dict_key_value_no_exception(self, _dict, key, skip_string_conversion=False, return_val='-1'):
         try:
@@ -162,66 +245,192 @@ class ZillowRpc(object):
             raise Exception("[ERROR] Listing: %s, error: %s", listing, e)
         return zillow_named_tuples_list
 
-    def run(self, locations_list, start_page_num):
-        success_count = 0
-        success_list = []
-        fail_count = 0
-        fail_list = []
-        for location in locations_list:
+    def _listing_ids(self, listings):
+        """Ids _get_listings_named_tuple gives the listings of a page, without parsing the rest"""
+        listing_ids = []
+        for listing in listings:
+            listing_id = self._get_dict_key_value_no_exception(listing, "id")
+            if 'units' in listing:
+                # every unit of an apartment complex is its own listing
+                listing_ids.extend('%s-%s' % (listing_id, self._get_dict_key_value_no_exception(unit, "beds"))
+                                   for unit in listing['units'])
+            else:
+                listing_ids.append(listing_id)
+        return listing_ids
+
+    def _select_page_fingerprints(self, location):
+        if self.page_fingerprints is None:
+            return {}
+        try:
+            with self.storage_lock:
+                return self.page_fingerprints.select_fingerprints("zillow", location)
+        except StoreListingResultsException as e:
+            LOGGER.warning("Failed to read page fingerprints, every page of %s is parsed: %s", location, e)
+            return {}
+
+    def _upsert_page_fingerprints(self, location, fingerprints):
+        if self.page_fingerprints is None:
+            return
+        try:
+            with self.storage_lock:
+                self.page_fingerprints.upsert_fingerprints("zillow", location, fingerprints)
+        except StoreListingResultsException as e:
+            LOGGER.warning("Failed to store page fingerprints of %s, its next crawl parses every page: %s", location, e)
+
+    def _crawl_location(self, location, start_page_num):
+        """Crawl, parse and store every page of one location, :returns: LocationCrawlResult"""
+        stored = None
+        failures = []
+        pages_fetched = 0
+        pages_skipped = 0
+        # every metric recorded while crawling and storing a location is labeled with it, and it is one trace
+        with metrics_context(source="zillow", location=location), \
+                span(LOCATION_SPAN_NAME, source="zillow", location=location):
             zillow_listings_tuple = []
+            stored_fingerprints = self._select_page_fingerprints(location)
+            # fingerprints of the changed pages, saved once their listings are stored
+            new_fingerprints = {}
+            # listings of the unchanged pages, only their date_updated is refreshed
+            skipped_listing_ids = []
             # Paginate for all listings
             page_num = start_page_num
             while True:
                 try:
-                    api_response = self.zillow_api_client.get_listings_by_search_api(location, page_num)
+                    with profile_stage("fetch"), span("fetch_page", page=page_num):
+                        api_response = self.zillow_api_client.get_listings_by_search_api(location, page_num)
                     listings = api_response.listings
                     total_pages = api_response.pages
+                    if self.raw_response_archive is not None:
+                        self.raw_response_archive.append("zillow", location, page_num, listings)
                     LOGGER.info("current location: %s, current_page: %s, total pages: %s", location, page_num, total_pages)
-                    for listing_dict in listings:
-                        zillow_listing = self._get_listings_named_tuple(listing_dict)
-                        zillow_listings_tuple += zillow_listing
+                    pages_fetched += 1
+                    increment("pages_total")
+                    fingerprint = page_fingerprint("zillow", listings)
+                    if stored_fingerprints.get(page_num) == fingerprint:
+                        pages_skipped += 1
+                        increment("pages_skipped_total")
+                        skipped_listing_ids.extend(self._listing_ids(listings))
+                        LOGGER.info("Page %s is unchanged since the last crawl, skipping it", page_num)
+                    else:
+                        new_fingerprints[page_num] = fingerprint
+                        with timer("parse_seconds"), profile_stage("extract"), span("parse", listings=len(listings)):
+                            for listing_dict in listings:
+                                zillow_listing = self._get_listings_named_tuple(listing_dict)
+                                zillow_listings_tuple += zillow_listing
+                        increment("listings_parsed_total", len(listings))
                     page_num += 1
                     if total_pages < page_num:
                         LOGGER.info("No more results. Next Step: store %s results into MySQL", len(zillow_listings_tuple))
                         break
                     # Random sleep between each api request
-                    sleep_time_seconds = randint(SLEEP_BETWEEN_API_REQUESTS_MIN, SLEEP_BETWEEN_API_REQUESTS_MAX)
-                    LOGGER.info("Sleep between api request for %s seconds", sleep_time_seconds)
-                    sleep(sleep_time_seconds)
+                    if self.sleep:
+                        sleep_time_seconds = randint(SLEEP_BETWEEN_API_REQUESTS_MIN, SLEEP_BETWEEN_API_REQUESTS_MAX)
+                        LOGGER.info("Sleep between api request for %s seconds", sleep_time_seconds)
+                        increment("sleep_seconds_total", sleep_time_seconds, kind="request")
+                        with span("sleep", kind="request", seconds=sleep_time_seconds):
+                            sleep(sleep_time_seconds)
                 except Exception as e:
                     LOGGER.error("There was a problem crawling the API: %s", e)
                     raise
-                    fail_count += 1
-                    fail_error_set = (type(e).__name__, location, e)
-                    fail_list.append(fail_error_set)
+                    failures.append((type(e).__name__, location, e))
+            if self.reverse_geocoder is not None:
+                zillow_listings_tuple = [self.reverse_geocoder.backfill(zillow_listing)
+                                         for zillow_listing in zillow_listings_tuple]
+            # listings on unchanged pages are still listed, keep them fresh for searches and rollups
+            if skipped_listing_ids:
+                try:
+                    with profile_stage("store"), span("touch", listings=len(skipped_listing_ids)), self.storage_lock:
+                        self.zillow_storage.touch_zillow_listings(skipped_listing_ids)
+                    LOGGER.info("Refreshed %s listings of unchanged pages", len(skipped_listing_ids))
+                    stored = 0
+                except StoreListingResultsException as e:
+                    LOGGER.info("Failed to refresh listings of unchanged pages: %s", e)
+                    failures.append((type(e).__name__, location, e))
             # store results into MySQL
             if len(zillow_listings_tuple) > 0:
+                # only used to tell new listings apart for alerts, storing goes ahead without it
+                try:
+                    with self.storage_lock:
+                        existing_listing_ids = self.zillow_storage.select_existing_listing_ids(
+                            zillow_listing.listing_id for zillow_listing in zillow_listings_tuple)
+                except StoreListingResultsException as e:
+                    LOGGER.warning("Failed to look up stored listings of %s, every listing is alerted as new: %s",
+                                   location, e)
+                    existing_listing_ids = set()
                 try:
-                    self.zillow_storage.upsert_zillow_listings(zillow_listings_tuple)
+                    with profile_stage("store"), span("store", listings=len(zillow_listings_tuple)), self.storage_lock:
+                        self.zillow_storage.upsert_zillow_listings(zillow_listings_tuple)
                     LOGGER.info("Stored %s results", len(zillow_listings_tuple))
-                    success_count += 1
-                    success_list.append((location, len(zillow_listings_tuple)))
+                    stored = len(zillow_listings_tuple)
+                    self._upsert_page_fingerprints(location, new_fingerprints)
+                    with self.storage_lock:
+                        self.listing_alerts.percolate(zillow_listing for zillow_listing in zillow_listings_tuple
+                                                      if zillow_listing.listing_id not in existing_listing_ids)
                 except StoreListingResultsException as e:
                     LOGGER.info("Failed to store listing results into storage: %s", e)
-                    fail_count += 1
-                    fail_error_set = (type(e).__name__, location, e)
-                    fail_list.append(fail_error_set)
+                    failures.append((type(e).__name__, location, e))
             # Random sleep between each location
-            sleep_time_seconds = randint(SLEEP_BETWEEN_LOCATIONS_MIN, SLEEP_BETWEEN_LOCATIONS_MAX)
-            LOGGER.info("Sleep between locations for %s seconds", sleep_time_seconds)
-            sleep(sleep_time_seconds)
+            if self.sleep:
+                sleep_time_seconds = randint(SLEEP_BETWEEN_LOCATIONS_MIN, SLEEP_BETWEEN_LOCATIONS_MAX)
+                LOGGER.info("Sleep between locations for %s seconds", sleep_time_seconds)
+                increment("sleep_seconds_total", sleep_time_seconds, kind="location")
+                with span("sleep", kind="location", seconds=sleep_time_seconds):
+                    sleep(sleep_time_seconds)
+        return LocationCrawlResult(location, stored, failures, pages_fetched, pages_skipped)
+
+    def run(self, locations_list, start_page_num):
+        success_count = 0
+        success_list = []
+        fail_count = 0
+        fail_list = []
+        pages_fetched = 0
+        pages_skipped = 0
+        if self.workers > 1:
+            # locations are crawled concurrently, the storage lock serializes their mysql reads and writes
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                location_results = list(executor.map(
+                    lambda location: self._crawl_location(location, start_page_num), locations_list))
+        else:
+            location_results = (self._crawl_location(location, start_page_num) for location in locations_list)
+        for location_result in location_results:
+            pages_fetched += location_result.pages_fetched
+            pages_skipped += location_result.pages_skipped
+            if location_result.stored is not None:
+                success_count += 1
+                success_list.append((location_result.location, location_result.stored))
+            fail_count += len(location_result.failures)
+            fail_list.extend(location_result.failures)
+        LOGGER.info("Skipped %s of %s pages unchanged since the last crawl (%.0f%%)", pages_skipped, pages_fetched,
+                    100.0 * pages_skipped / pages_fetched if pages_fetched else 0)
+        metrics_totals = json.dumps(METRICS.totals(), sort_keys=True, indent=4)
+        LOGGER.info("Metrics: %s", json.dumps(METRICS.summary(), sort_keys=True))
         # Email results of the run
         try:
             email_subject = "[Zillow Complete] %s Successful | %s Failed" % (success_count, fail_count)
             success_list_formatted = json.dumps(success_list, sort_keys=True, indent=4)
             failed_list_formatted = json.dumps(fail_list, sort_keys=True, indent=4)
-            email_message = "success_list: %s\nfailed_list: %s" % (success_list_formatted, failed_list_formatted)
+            email_message = "success_list: %s\nfailed_list: %s\nunchanged pages skipped: %s of %s\nmetrics: %s" % (
+                success_list_formatted, failed_list_formatted, pages_skipped, pages_fetched, metrics_totals)
             self.email_client.send_email(GMAIL_SENT_TO_EMAILS, email_subject, email_message)
-            LOGGER.info("Emailed completion of crawling %s location(s)", len(locations_list))
+            LOGGER.info("Queued email of completion of crawling %s location(s)", len(locations_list))
         except EmailSendingException as e:
             LOGGER.info("Failed email results: %s", e)
+        # Email new listings matching saved searches
+        digest_count = self.listing_alerts.send_digests()
+        LOGGER.info("Queued %s saved search alert digest(s)", digest_count)
+        # wait a bounded time for queued notifications
+        self.email_client.close()
         # close database handle
         self.zillow_storage.close()
+        if self.raw_response_archive is not None:
+            self.raw_response_archive.close()
+        if self.page_fingerprints is not None:
+            self.page_fingerprints.close()
+        # after closing, so the upserts and notifications of the last location are counted
+        if self.metrics_file:
+            METRICS.write_prometheus_file(self.metrics_file)
+        if self.metrics_summary_file:
+            METRICS.write_summary_file(self.metrics_summary_file)
 
 def _parse_args():
     parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
@@ -235,6 +444,27 @@ def _parse_args():
     parser.add_argument('--proxy-port')
     parser.add_argument('--proxy-user')
     parser.add_argument('--proxy-pass')
+    parser.add_argument('--proxy-file', help='file of proxies to spread requests over, see utils/proxy_pool.py')
+    parser.add_argument('--workers', type=int,
+                        help='locations crawled at once, defaults to the number of proxies in --proxy-file or 1,\n'
+                             'always 1 with --profile deterministic')
+
+    parser.add_argument('--api-host', help='host:port to crawl instead of the api, e.g. scripts/replay_server.py')
+    parser.add_argument('--record-file', help='append every api request and response to this gzipped archive')
+    parser.add_argument('--no-sleep', action='store_true', help='skip the sleeps between requests, for offline runs')
+    parser.add_argument('--no-skip-unchanged', action='store_true',
+                        help='parse and store every page, even when it matches the last crawl')
+    parser.add_argument('--metrics-file', default=METRICS_FILE,
+                        help='write the run\'s metrics in the Prometheus text format to this file')
+    parser.add_argument('--metrics-summary-file', default=METRICS_SUMMARY_FILE,
+                        help='write a JSON summary of the run\'s metrics to this file')
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help='serve the metrics on http://127.0.0.1:<port>/metrics while crawling')
+    parser.add_argument('--profile', choices=PROFILE_MODES,
+                        help='profile the crawl by stage: fetch, decode, extract and store')
+    parser.add_argument('--profile-dir', default=PROFILE_DIR)
+    parser.add_argument('--trace-file', default=TRACE_FILE,
+                        help='append a trace of every location crawl to this file, see utils/tracing.py')
 
     return parser.parse_args()
 
@@ -247,7 +477,7 @@ def _main():
     # optional proxy
     proxy_ip = options.proxy_ip
     proxy_port = options.proxy_port
-    proxy_user = options.proxy_port
+    proxy_user = options.proxy_user
     proxy_pass = options.proxy_pass
 
     if location_file:
@@ -255,9 +485,39 @@ def _main():
     else:
         locations_list = [location]
 
-    zillow_rpc = ZillowRpc(proxy_ip, proxy_port, proxy_user, proxy_pass)
+    if options.record_file:
+        open_http_recorder(options.record_file)
+    if options.metrics_port:
+        start_metrics_server(options.metrics_port)
+    if options.profile:
+        start_profiler(options.profile)
+    if options.trace_file:
+        open_trace_exporter(options.trace_file)
+    proxy_pool = None
+    if options.proxy_file:
+        proxy_pool = ProxyPool(load_proxy_file(options.proxy_file))
+        proxy_pool.start()
+    workers = options.workers or (len(proxy_pool) if proxy_pool is not None else 1)
+    if options.profile == 'deterministic' and workers > 1:
+        # cProfile only sees the thread it was started on, the workers' fetches and stores would be missing
+        LOGGER.warning("Deterministic profiling crawls with 1 worker instead of %s", workers)
+        workers = 1
+
+    zillow_rpc = ZillowRpc(proxy_ip, proxy_port, proxy_user, proxy_pass, api_host=options.api_host, sleep=not options.no_sleep,
+                    skip_unchanged=SKIP_UNCHANGED_PAGES and not options.no_skip_unchanged,
+                    metrics_file=options.metrics_file, metrics_summary_file=options.metrics_summary_file,
+                    proxy_pool=proxy_pool, workers=workers)
 
-    zillow_rpc.run(locations_list, start_page_num)
+    try:
+        zillow_rpc.run(locations_list, start_page_num)
+    finally:
+        if options.profile:
+            stop_profiler(profile_path_prefix(options.profile_dir, "zillow_rpc"))
+        open_trace_exporter(None)
+        if proxy_pool is not None:
+            proxy_pool.close()
+    # closing writes the end of the gzip stream
+    open_http_recorder(None)
 
 
 if __name__ == '__main__':
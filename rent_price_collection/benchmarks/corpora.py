@@ -0,0 +1,111 @@
+"""
+:author: Henley Kuang
+:since: 06/19/2019
+
+Synthetic, repeatable inputs for the benchmarks, scaled up from example_zillow_response.json and
+example_trulia_response.json. Every corpus is generated from a fixed seed so runs on different
+commits measure the same data.
+"""
+
+import copy
+import datetime
+import json
+import os
+import random
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir))
+EXAMPLE_ZILLOW_RESPONSE = os.path.join(REPO_ROOT, 'example_zillow_response.json')
+EXAMPLE_TRULIA_RESPONSE = os.path.join(REPO_ROOT, 'example_trulia_response.json')
+
+SEED = 20190619
+CITIES = [('Arlington Heights', 'IL', 60004), ('Chicago', 'IL', 60601), ('Evanston', 'IL', 60201),
+          ('Seattle', 'WA', 98101), ('San Francisco', 'CA', 94117), ('Austin', 'TX', 78701)]
+
+def _load(path):
+    with open(path, 'r') as example_file:
+        return json.load(example_file)
+
+def _jitter(rng, value, amount):
+    return round(value + rng.uniform(-amount, amount), 6)
+
+def zillow_listings(count, seed=SEED, first_id=10000000):
+    """count listResults entries of a Zillow search response, cycling through the example's listings"""
+    rng = random.Random(seed)
+    examples = _load(EXAMPLE_ZILLOW_RESPONSE)["searchResults"]["listResults"]
+    listings = []
+    for listing_num in range(count):
+        listing = copy.deepcopy(examples[listing_num % len(examples)])
+        listing["id"] = str(first_id + listing_num)
+        lat_lng = listing.get("latLong") or {}
+        if "latitude" in lat_lng:
+            lat_lng["latitude"] = _jitter(rng, lat_lng["latitude"], 0.05)
+            lat_lng["longitude"] = _jitter(rng, lat_lng["longitude"], 0.05)
+        if "units" in listing:
+            for unit in listing["units"]:
+                unit["price"] = "$%s+" % format(rng.randint(800, 4000), ",")
+        else:
+            listing["price"] = "$%s/mo" % format(rng.randint(800, 4000), ",")
+        listings.append(listing)
+    return listings
+
+def zillow_response(count, seed=SEED, first_id=10000000):
+    """A Zillow search response with count listings"""
+    response = _load(EXAMPLE_ZILLOW_RESPONSE)
+    response["searchResults"]["listResults"] = zillow_listings(count, seed, first_id)
+    return response
+
+def trulia_cards(count, seed=SEED, first_id=4000000000):
+    """count cards of a Trulia search response, cycling through the example's cards"""
+    rng = random.Random(seed)
+    examples = _load(EXAMPLE_TRULIA_RESPONSE)["page"]["cards"]
+    cards = []
+    for card_num in range(count):
+        card = copy.deepcopy(examples[card_num % len(examples)])
+        card["id"] = str(first_id + card_num)
+        if card.get("latLng"):
+            card["latLng"] = [_jitter(rng, card["latLng"][0], 0.05), _jitter(rng, card["latLng"][1], 0.05)]
+        card["price"] = "$%s" % format(rng.randint(800, 4000), ",")
+        cards.append(card)
+    return cards
+
+def trulia_response(count, seed=SEED, first_id=4000000000):
+    """A Trulia search response with count cards"""
+    response = _load(EXAMPLE_TRULIA_RESPONSE)
+    response["page"]["cards"] = trulia_cards(count, seed, first_id)
+    return response
+
+def iter_all_listings_rows(count, seed=SEED):
+    """count rows shaped like all_listings rows, spread over a few cities. Generated lazily so 1M rows fit in memory."""
+    rng = random.Random(seed)
+    start = datetime.datetime(2019, 1, 1)
+    for row_num in range(count):
+        city, state, zip_code = CITIES[row_num % len(CITIES)]
+        source = "zillow" if row_num % 2 else "trulia"
+        date_collected = start + datetime.timedelta(minutes=rng.randint(0, 60 * 24 * 150))
+        yield {
+            "id": "%s-%s" % (source, row_num),
+            "source": source,
+            "url": "https://www.%s.com/listing/%s" % (source, row_num),
+            "street_address": "%s Main St" % rng.randint(1, 9999),
+            "city": city,
+            "state": state,
+            "zip_code": str(zip_code + rng.randint(0, 20)),
+            "beds": "%sbd" % rng.randint(0, 4),
+            "baths": "%sba" % rng.randint(1, 3),
+            "lat": _jitter(rng, 41.9, 0.5),
+            "lng": _jitter(rng, -87.8, 0.5),
+            "sqft": "%s sqft" % rng.randint(400, 3000),
+            "price": "$%s" % format(rng.randint(800, 4000), ","),
+            "date_collected": date_collected,
+            "date_updated": date_collected + datetime.timedelta(days=rng.randint(0, 30)),
+        }
+
+class SyntheticAllListings(object):
+    """Serves synthetic rows where an AllListingsMySql is expected to load from, e.g. AllListingsColumnar"""
+
+    def __init__(self, count, seed=SEED):
+        self.count = count
+        self.seed = seed
+
+    def iter_all_listings(self, limit=None, fetch_size=None):
+        return iter_all_listings_rows(min(limit, self.count) if limit else self.count, self.seed)
@@ -0,0 +1,310 @@
+"""
+:author: Henley Kuang
+:since: 06/19/2019
+
+Offline benchmarks of the hot paths, no network or MySQL server needed:
+
+json_decode     decode_response_content on a Zillow search response, what RestClient.request did per page
+json_gzip       what RestClient.request does per page now: read the same response gzipped, decompress it,
+                decode it and keep only what the api client reads
+parse_zillow    ZillowRpc._get_listings_named_tuple over a page worth of listings
+parse_trulia    TruliaRpc._get_listing_named_tuple over a page worth of cards
+upsert          batched insert then update of zillow_listings rows into an in memory SQLite table,
+                a stand-in for the MySQL upsert with the same columns, primary key and duplicate key update
+search_columnar AllListingsColumnar.search_listings, needs numpy
+search_sqlite   the same filtered, sorted and paged query against an indexed SQLite all_listings
+
+Every benchmark is repeated and reports the min and median in milliseconds, the min is the number to compare.
+Results are printed, or written to --output, as JSON together with the commit they were measured on,
+so two runs can be diffed.
+
+python rent_price_collection/benchmarks/run_benchmarks.py --output benchmarks.json
+python rent_price_collection/benchmarks/run_benchmarks.py --benchmark search_columnar --size 10000 --size 1000000
+"""
+
+import argparse
+import datetime
+import io
+import json
+import logging
+import platform
+import sqlite3
+import subprocess
+import sys
+import time
+
+from rent_price_collection.api.http_utils import (
+    compress_body,
+)
+from rent_price_collection.benchmarks.corpora import (
+    iter_all_listings_rows,
+    REPO_ROOT,
+    SyntheticAllListings,
+    trulia_cards,
+    zillow_listings,
+    zillow_response,
+)
+from rent_price_collection.clients.zillow_rest_client import (
+    SEARCH_RESPONSE_KEYS,
+)
+from rent_price_collection.storage.all_listings_mysql import (
+    SearchParameterObject,
+    SEARCH_PARAMETERS,
+)
+from rent_price_collection.utils.config import (
+    DEFAULT_LOG_FORMAT_STRING,
+)
+from rent_price_collection.utils.rest_client import (
+    decode_response_content,
+    read_response_content,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_REPEAT = 5
+PAGE_SIZES = [24, 500]
+PARSE_SIZES = [1000, 10000]
+UPSERT_SIZES = [1000, 10000]
+UPSERT_BATCH_SIZE = 1000
+SEARCH_SIZES = [10000, 100000, 1000000]
+SEARCH_QUERIES = [
+    ('city', {'city': 'Chicago'}, 'date_updated'),
+    ('city_zip', {'city': 'Arlington', 'zip_code': '6000'}, 'price'),
+    ('all', {}, 'date_updated'),
+]
+
+ZILLOW_COLUMNS = ['listing_id', 'detail_url', 'street_address', 'city', 'state', 'building_name', 'zip_code',
+                  'beds', 'baths', 'lat', 'lng', 'sqft', 'price']
+SQLITE_CREATE_ZILLOW = '''create table zillow_listings (
+listing_id text primary key, detail_url text, street_address text, city text, state text,
+building_name text, zip_code integer, beds text, baths text, lat real, lng real, sqft text, price text,
+date_updated text)'''
+SQLITE_UPSERT_ZILLOW = '''insert into zillow_listings ({columns}) values ({placeholders})
+on conflict(listing_id) do update set price=excluded.price, sqft=excluded.sqft,
+zip_code=case when zip_code = -1 then excluded.zip_code else zip_code end,
+city=case when city = '-1' then excluded.city else city end, date_updated=CURRENT_TIMESTAMP'''.format(
+    columns=", ".join(ZILLOW_COLUMNS), placeholders=", ".join(":%s" % column for column in ZILLOW_COLUMNS))
+# upsert syntax needs sqlite 3.24, older versions replace the whole row which still exercises the same index work
+SQLITE_REPLACE_ZILLOW = '''insert or replace into zillow_listings ({columns}) values ({placeholders})'''.format(
+    columns=", ".join(ZILLOW_COLUMNS), placeholders=", ".join(":%s" % column for column in ZILLOW_COLUMNS))
+
+ALL_LISTINGS_COLUMNS = ['id', 'source', 'url', 'street_address', 'city', 'state', 'zip_code', 'beds', 'baths',
+                        'lat', 'lng', 'sqft', 'price', 'date_collected', 'date_updated']
+SQLITE_CREATE_ALL_LISTINGS = '''create table all_listings (
+id text primary key, source text, url text, street_address text, city text, state text, zip_code text,
+beds text, baths text, lat real, lng real, sqft text, price text, date_collected text, date_updated text)'''
+SQLITE_INDEX_ALL_LISTINGS = '''create index all_listings_date_updated on all_listings (date_updated)'''
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def measure(func, repeat=DEFAULT_REPEAT):
+    """Call func once to warm up, then repeat times. Returns the sorted timings in seconds."""
+    func()
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    return sorted(timings)
+
+def _result(name, size, timings, **extra):
+    result = {
+        "name": name,
+        "size": size,
+        "repeat": len(timings),
+        "min_ms": round(timings[0] * 1000, 3),
+        "median_ms": round(timings[len(timings) // 2] * 1000, 3),
+        "items_per_second": round(size / timings[0]) if timings[0] else None,
+    }
+    result.update(extra)
+    LOGGER.info("%s size=%s min=%sms median=%sms", name, size, result["min_ms"], result["median_ms"])
+    return result
+
+def bench_json_decode(sizes, repeat):
+    for size in sizes:
+        response_content = json.dumps(zillow_response(size)).encode('utf-8')
+        timings = measure(lambda: decode_response_content(response_content), repeat)
+        yield _result("json_decode", size, timings, bytes=len(response_content))
+
+class _RecordedResponse(object):
+    """Stand-in for an httplib response, reading a body from memory"""
+
+    def __init__(self, content, content_encoding=None):
+        self._body = io.BytesIO(content)
+        self._content_encoding = content_encoding
+
+    def getheader(self, name, default=None):
+        return self._content_encoding if name == 'Content-Encoding' else default
+
+    def read(self, size=-1):
+        return self._body.read(size)
+
+def bench_json_gzip(sizes, repeat):
+    for size in sizes:
+        compressed = compress_body(json.dumps(zillow_response(size)).encode('utf-8'), 'gzip')
+
+        def decode():
+            response_content, _ = read_response_content(_RecordedResponse(compressed, 'gzip'))
+            return decode_response_content(response_content, 'application/json', SEARCH_RESPONSE_KEYS)
+        yield _result("json_gzip", size, measure(decode, repeat), bytes=len(compressed))
+
+def bench_parse_zillow(sizes, repeat):
+    from rent_price_collection.app.zillow_rpc import ZillowRpc
+    # parsing only reads the listing, skip __init__ which connects to MySQL and starts the notifier
+    zillow_rpc = ZillowRpc.__new__(ZillowRpc)
+    for size in sizes:
+        listings = zillow_listings(size)
+        timings = measure(lambda: [zillow_rpc._get_listings_named_tuple(listing) for listing in listings], repeat)
+        yield _result("parse_zillow", size, timings)
+
+def bench_parse_trulia(sizes, repeat):
+    from rent_price_collection.app.trulia_rpc import TruliaRpc
+    trulia_rpc = TruliaRpc.__new__(TruliaRpc)
+    for size in sizes:
+        cards = trulia_cards(size)
+        timings = measure(lambda: [trulia_rpc._get_listing_named_tuple(card) for card in cards], repeat)
+        yield _result("parse_trulia", size, timings)
+
+def _zillow_rows(size):
+    from rent_price_collection.app.zillow_rpc import ZillowRpc
+    zillow_rpc = ZillowRpc.__new__(ZillowRpc)
+    rows = []
+    for listing in zillow_listings(size):
+        for zillow_listing in zillow_rpc._get_listings_named_tuple(listing):
+            rows.append(zillow_listing._asdict())
+    return rows
+
+def _upsert(connection, query, rows):
+    cursor = connection.cursor()
+    for start in range(0, len(rows), UPSERT_BATCH_SIZE):
+        cursor.executemany(query, rows[start:start + UPSERT_BATCH_SIZE])
+        connection.commit()
+    cursor.close()
+
+def bench_upsert(sizes, repeat):
+    query = SQLITE_UPSERT_ZILLOW if sqlite3.sqlite_version_info >= (3, 24, 0) else SQLITE_REPLACE_ZILLOW
+    for size in sizes:
+        rows = _zillow_rows(size)
+        insert_timings = []
+        update_timings = []
+        for _ in range(repeat):
+            connection = sqlite3.connect(':memory:')
+            connection.execute(SQLITE_CREATE_ZILLOW)
+            start = time.time()
+            _upsert(connection, query, rows)
+            insert_timings.append(time.time() - start)
+            # second pass hits the duplicate key path like a recrawl of the same pages
+            start = time.time()
+            _upsert(connection, query, rows)
+            update_timings.append(time.time() - start)
+            connection.close()
+        yield _result("upsert_insert", len(rows), sorted(insert_timings))
+        yield _result("upsert_update", len(rows), sorted(update_timings))
+
+def _search_parameter_object(filters):
+    return SearchParameterObject(**dict((name, filters.get(name)) for name in SEARCH_PARAMETERS))
+
+def bench_search_columnar(sizes, repeat):
+    from rent_price_collection.storage.all_listings_columnar import AllListingsColumnar, numpy
+    if numpy is None:
+        LOGGER.warning("numpy is not installed, skipping search_columnar")
+        return
+    for size in sizes:
+        all_listings_columnar = AllListingsColumnar(SyntheticAllListings(size))
+        start = time.time()
+        all_listings_columnar.load()
+        yield _result("search_columnar_load", size, [time.time() - start])
+        for query_name, filters, sortby in SEARCH_QUERIES:
+            search_parameter_object = _search_parameter_object(filters)
+            timings = measure(lambda: all_listings_columnar.search_listings(search_parameter_object, sortby=sortby),
+                              repeat)
+            yield _result("search_columnar_%s" % query_name, size, timings)
+
+def _sqlite_row(row):
+    return tuple(str(row[column]) if column.startswith('date_') else row[column] for column in ALL_LISTINGS_COLUMNS)
+
+def bench_search_sqlite(sizes, repeat):
+    for size in sizes:
+        connection = sqlite3.connect(':memory:')
+        connection.execute(SQLITE_CREATE_ALL_LISTINGS)
+        connection.execute(SQLITE_INDEX_ALL_LISTINGS)
+        start = time.time()
+        connection.executemany('insert into all_listings values (%s)' % ", ".join(["?"] * len(ALL_LISTINGS_COLUMNS)),
+                               (_sqlite_row(row) for row in iter_all_listings_rows(size)))
+        connection.commit()
+        yield _result("search_sqlite_load", size, [time.time() - start])
+        for query_name, filters, sortby in SEARCH_QUERIES:
+            # same shape as AllListingsMySql.QUERY_SEARCH: like filters, order by, limit 20 plus a count
+            where = " and ".join("%s like ?" % name for name in sorted(filters)) or "1"
+            args = ["%" + filters[name] + "%" for name in sorted(filters)]
+            query = 'select * from all_listings where %s order by %s desc limit 20' % (where, sortby)
+            query_count = 'select count(*) from all_listings where %s' % where
+
+            def search():
+                connection.execute(query, args).fetchall()
+                connection.execute(query_count, args).fetchone()
+            yield _result("search_sqlite_%s" % query_name, size, measure(search, repeat))
+        connection.close()
+
+BENCHMARKS = [
+    ('json_decode', bench_json_decode, PAGE_SIZES),
+    ('json_gzip', bench_json_gzip, PAGE_SIZES),
+    ('parse_zillow', bench_parse_zillow, PARSE_SIZES),
+    ('parse_trulia', bench_parse_trulia, PARSE_SIZES),
+    ('upsert', bench_upsert, UPSERT_SIZES),
+    ('search_columnar', bench_search_columnar, SEARCH_SIZES),
+    ('search_sqlite', bench_search_sqlite, SEARCH_SIZES),
+]
+
+def run_benchmarks(names=None, sizes=None, repeat=DEFAULT_REPEAT):
+    """
+    :param names: benchmarks to run, defaults to all of them
+    :param sizes: overrides every benchmark's default sizes
+    :returns: dict with meta and results, JSON serializable
+    """
+    results = []
+    for name, benchmark, default_sizes in BENCHMARKS:
+        if names and name not in names:
+            continue
+        results.extend(benchmark(sizes or default_sizes, repeat))
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "sqlite": sqlite3.sqlite_version,
+            "repeat": repeat,
+            "date": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        },
+        "results": results,
+    }
+
+def _parse_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--benchmark', action='append', choices=[name for name, _, _ in BENCHMARKS],
+                        help='defaults to every benchmark')
+    parser.add_argument('--size', type=int, action='append', help="overrides every benchmark's default sizes")
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+
+    return parser.parse_args()
+
+def _main():
+    options = _parse_args()
+
+    report = run_benchmarks(options.benchmark, options.size, options.repeat)
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2, sort_keys=True)
+        LOGGER.info("Wrote %s results to %s", len(report["results"]), options.output)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format=DEFAULT_LOG_FORMAT_STRING, datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO)
+    _main()
@@ -29,8 +29,10 @@ LISTING_TYPES = {
 
 class TruliaApiClient(TruliaRestClient):
 
-    def __init__(self, client=None, proxy_ip=None, proxy_port=None, proxy_user=None, proxy_pass=None):
-        super(TruliaApiClient, self).__init__(client)
+    def __init__(self, client=None, proxy_ip=None, proxy_port=None, proxy_user=None, proxy_pass=None, api_host=None,
+                 proxy_pool=None):
+        super(TruliaApiClient, self).__init__(client, proxy_ip, proxy_port, proxy_user, proxy_pass, api_host=api_host,
+                                              proxy_pool=proxy_pool)
 
     def _format_location_str(self, location):
         return location.replace(" ", "_")
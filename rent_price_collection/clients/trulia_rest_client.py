@@ -11,8 +11,12 @@ from rent_price_collection.utils.exceptions import (
     ResponseSuccessFalseException,
     ZeroListingsReturnedException,
 )
+from rent_price_collection.utils.metrics import (
+    increment,
+)
 from rent_price_collection.utils.rest_client import (
-    get_client
+    get_client,
+    response_preview,
 )
 
 LOGGER = logging.getLogger(__name__)
@@ -25,6 +29,8 @@ CODE_EXCEPTIONS = {
 }
 
 TRULIA_DOMAIN = "www.trulia.com"
+# the only parts of a search response that are read, see handle_api_error, the rest is dropped while decoding
+SEARCH_RESPONSE_KEYS = ('success', 'page.cards')
 
 def _get_api_path(api_name, *args):
     """Return api_path_with_version
@@ -37,23 +43,28 @@ def _get_api_path(api_name, *args):
 
 class TruliaRestClient(object):
 
-    def __init__(self, client=None, proxy_ip=None, proxy_port=None, proxy_user=None, proxy_pass=None):
-        self._client = client if client else get_client(proxy_ip, proxy_port, proxy_user, proxy_pass)
+    def __init__(self, client=None, proxy_ip=None, proxy_port=None, proxy_user=None, proxy_pass=None, api_host=None,
+                 proxy_pool=None):
+        self._client = client if client else get_client(proxy_ip, proxy_port, proxy_user, proxy_pass, api_host, proxy_pool)
 
     def get_api_path(self, api_name, *args):
         """Return api_path"""
         return _get_api_path(api_name, *args)
 
-    def handle_api_error(self, api_response):
-        """Trulia API ERROR Handler"""
+    def handle_api_error(self, api_response, response_content=None):
+        """
+        Trulia API ERROR Handler
+        :param response_content: raw body api_response was decoded from, logged instead when keys were dropped
+        """
+        logged_response = response_preview(response_content) if response_content is not None else api_response
         if "success" in api_response and api_response["success"] is False:
-            LOGGER.warn('API RESPONSE has error ==> %s', api_response)
+            LOGGER.warn('API RESPONSE has error ==> %s', logged_response)
             raise ResponseSuccessFalseException("Please double check your input location spelling")
         if "page" not in api_response:
-            LOGGER.warn('API RESPONSE does not have "pages" key ==> %s', api_response)
+            LOGGER.warn('API RESPONSE does not have "pages" key ==> %s', logged_response)
             raise ResponseMissingPageKeyException("Response format may have change. Missing 'pages' in response")
         if "cards" not in api_response["page"]:
-            LOGGER.warn('API RESPONSE does not have "cards" key in response["pages"] ==> %s', api_response)
+            LOGGER.warn('API RESPONSE does not have "cards" key in response["pages"] ==> %s', logged_response)
             raise ResponseMissingPageCardsKeyException("Response format may have changed. Missing 'cards' in response['pages']")
         if len(api_response["page"]["cards"]) == 0:
             raise ZeroListingsReturnedException
@@ -66,6 +77,13 @@ class TruliaRestClient(object):
 
     def make_get_request(self, api_path):
         LOGGER.info('GET request ==> %s', api_path)
-        response = self._client.get(TRULIA_DOMAIN, api_path)
-        self.handle_api_error(response)
+        response, response_content = self._client.get(TRULIA_DOMAIN, api_path, keep=SEARCH_RESPONSE_KEYS,
+                                                       with_content=True)
+        try:
+            self.handle_api_error(response, response_content)
+        except Exception as e:
+            increment("api_response_errors_total", exception=type(e).__name__)
+            # so the retry asks the api again instead of the response cache
+            self._client.invalidate(TRULIA_DOMAIN, api_path)
+            raise
         return response
@@ -23,6 +23,9 @@ from rent_price_collection.utils.exceptions import (
 from rent_price_collection.utils.decorators import (
     retry_decorator,
 )
+from rent_price_collection.utils.tracing import (
+    traced,
+)
 from rent_price_collection.clients.zillow_rest_client import (
     ZILLOW_DOMAIN,
     ZillowRestClient,
@@ -35,8 +38,10 @@ ZillowRegionResponse = namedtuple('ZillowRegionResponse', ['region_id', 'latitud
 
 class ZillowApiClient(ZillowRestClient):
 
-    def __init__(self, client=None, proxy_ip=None, proxy_port=None, proxy_user=None, proxy_pass=None):
-        super(ZillowApiClient, self).__init__(client)
+    def __init__(self, client=None, proxy_ip=None, proxy_port=None, proxy_user=None, proxy_pass=None, api_host=None,
+                 proxy_pool=None):
+        super(ZillowApiClient, self).__init__(client, proxy_ip, proxy_port, proxy_user, proxy_pass, api_host=api_host,
+                                              proxy_pool=proxy_pool)
 
     def _api_search_parameters(self, location, page_num):
         url_params = []
@@ -116,6 +121,7 @@ class ZillowApiClient(ZillowRestClient):
         pages = response["searchList"]["totalPages"]
         return ZillowApiResponse(listings=listings, pages=pages)
 
+    @traced("region_lookup")
     def get_region_id_and_default_lat_lng(self, location):
         city = location.split(",")[0].strip()
         state = location.split(",")[1].strip()
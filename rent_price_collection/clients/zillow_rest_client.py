@@ -9,8 +9,12 @@ from rent_price_collection.utils.exceptions import (
     ResponseMissingKeyException,
     ResponseSuccessFalseException,
 )
+from rent_price_collection.utils.metrics import (
+    increment,
+)
 from rent_price_collection.utils.rest_client import (
-    get_client
+    get_client,
+    response_preview,
 )
 
 LOGGER = logging.getLogger(__name__)
@@ -23,6 +27,8 @@ CODE_EXCEPTIONS = {
 }
 
 ZILLOW_DOMAIN = "www.zillow.com"
+# the only parts of a search response that are read, see handle_api_error, the rest is dropped while decoding
+SEARCH_RESPONSE_KEYS = ('searchResults.listResults', 'searchList.totalPages')
 
 def _get_api_path(api_name, *args):
     """Return api_path_with_version
@@ -35,15 +41,19 @@ def _get_api_path(api_name, *args):
 
 class ZillowRestClient(object):
 
-    def __init__(self, client=None, proxy_ip=None, proxy_port=None, proxy_user=None, proxy_pass=None):
-        self._client = client if client else get_client(proxy_ip, proxy_port, proxy_user, proxy_pass)
+    def __init__(self, client=None, proxy_ip=None, proxy_port=None, proxy_user=None, proxy_pass=None, api_host=None,
+                 proxy_pool=None):
+        self._client = client if client else get_client(proxy_ip, proxy_port, proxy_user, proxy_pass, api_host, proxy_pool)
 
     def get_api_path(self, api_name, *args):
         """Return api_path"""
         return _get_api_path(api_name, *args)
 
-    def handle_api_error(self, api_response):
-        """Zillow API ERROR Handler"""
+    def handle_api_error(self, api_response, response_content=None):
+        """
+        Zillow API ERROR Handler
+        :param response_content: raw body api_response was decoded from, logged instead when keys were dropped
+        """
         if "searchResults" not in api_response:
             raise ResponseMissingKeyException("'searchResults' key not in api_response")
         if "listResults" not in api_response["searchResults"]:
@@ -51,7 +61,7 @@ class ZillowRestClient(object):
         if "searchList" not in api_response:
             raise ResponseMissingKeyException("'searchList' key not in api_response")
         if "totalPages" not in api_response['searchList']:
-            LOGGER.info(api_response)
+            LOGGER.info(response_preview(response_content) if response_content is not None else api_response)
             raise ResponseMissingKeyException("'totalPages' key not in api_response['searchList']")
 
     def handle_xml_error(self, xml_response):
@@ -67,8 +77,15 @@ class ZillowRestClient(object):
 
     def make_get_request(self, api_path):
         LOGGER.info('GET request ==> %s', api_path)
-        response = self._client.get(ZILLOW_DOMAIN, api_path)
-        self.handle_api_error(response)
+        response, response_content = self._client.get(ZILLOW_DOMAIN, api_path, keep=SEARCH_RESPONSE_KEYS,
+                                                       with_content=True)
+        try:
+            self.handle_api_error(response, response_content)
+        except Exception as e:
+            increment("api_response_errors_total", exception=type(e).__name__)
+            # so the retry asks the api again instead of the response cache
+            self._client.invalidate(ZILLOW_DOMAIN, api_path)
+            raise
         return response
 
     def make_get_request_xml(self, api_path):
@@ -1,12 +1,37 @@
 """
 :author: Henley Kuang
 :since: 04/28/2019
+
+Email notifications. NotificationDispatcher queues messages and sends them from a background thread
+over one SMTP session kept open between messages, so a slow or failing mail server never holds up a crawl.
+Messages queued for the same recipients within NOTIFY_BATCH_SECONDS are sent as a single digest.
+
+Point SMTP_HOST at a local debugging server to print messages instead of sending them:
+python -m smtpd -n -c DebuggingServer localhost:1025
 """
 
 import logging
 import smtplib
+import threading
+import time
 
-from rent_price_collection.utils.config import DEFAULT_LOG_FORMAT_STRING
+from collections import OrderedDict
+from Queue import Queue, Empty
+
+from rent_price_collection.utils.config import (
+    DEFAULT_LOG_FORMAT_STRING,
+    GMAIL_PASSWORD,
+    GMAIL_USER,
+    NOTIFY_BATCH_SECONDS,
+    NOTIFY_FLUSH_TIMEOUT_SECONDS,
+    NOTIFY_MAX_RETRIES,
+    NOTIFY_RETRY_BACKOFF_SECONDS,
+    NOTIFY_TRANSPORT,
+    SMTP_HOST,
+    SMTP_PORT,
+    SMTP_TIMEOUT_SECONDS,
+    SMTP_USE_SSL,
+)
 from rent_price_collection.utils.exceptions import (
     EmailSendingException,
 )
@@ -21,6 +46,162 @@ GMAIL_PORT = 465
 # https://www.google.com/settings/security/lesssecureapps
 # This 2nd link is to allow the python app to use the gmail
 
+def format_message(from_addr, to_emails_list, subject, body):
+    return 'From: {}\nTo: {}\nSubject: {}\n\n{}'.format(from_addr, ", ".join(to_emails_list), subject, body)
+
+class SmtpTransport(object):
+    """
+    One SMTP session reused for every message, opened on first use and reopened after the server drops it.
+    Login is skipped when the server does not offer AUTH, e.g. a local debugging server.
+    """
+
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, user=GMAIL_USER, password=GMAIL_PASSWORD,
+                 use_ssl=SMTP_USE_SSL, timeout=SMTP_TIMEOUT_SECONDS):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.server = None
+
+    def _connect(self):
+        smtp_class = smtplib.SMTP_SSL if self.use_ssl else smtplib.SMTP
+        server = smtp_class(self.host, self.port, timeout=self.timeout)
+        server.ehlo()
+        if server.has_extn('auth') and self.user:
+            server.login(self.user, self.password)
+        self.server = server
+        LOGGER.info("Connected to SMTP server %s:%s", self.host, self.port)
+
+    def send(self, to_emails_list, subject, body):
+        try:
+            if self.server is None:
+                self._connect()
+            try:
+                self.server.sendmail(self.user, to_emails_list, format_message(self.user, to_emails_list, subject, body))
+            except smtplib.SMTPServerDisconnected:
+                # idle sessions get closed by the server, reconnect once before counting it as a failure
+                self._connect()
+                self.server.sendmail(self.user, to_emails_list, format_message(self.user, to_emails_list, subject, body))
+        except Exception as e:
+            self.close()
+            raise EmailSendingException(e)
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except Exception:
+                pass
+            self.server = None
+
+class LogTransport(object):
+    """Logs messages instead of sending them"""
+
+    def send(self, to_emails_list, subject, body):
+        LOGGER.info("Email to: %s | Subject: %s\n%s", to_emails_list, subject, body)
+
+    def close(self):
+        pass
+
+def make_transport(name=NOTIFY_TRANSPORT):
+    if name == 'smtp':
+        return SmtpTransport()
+    if name == 'log':
+        return LogTransport()
+    raise ValueError("Unknown notification transport: %s" % name)
+
+class NotificationDispatcher(object):
+    """
+    Queue notifications and send them from a daemon thread.
+    send_email only enqueues, so it has the same signature as GMailNotify.send_email but never blocks or raises.
+    Failed sends are retried with exponential backoff and dropped after max_retries.
+    """
+
+    _STOP = object()
+
+    def __init__(self, transport=None, batch_seconds=NOTIFY_BATCH_SECONDS, max_retries=NOTIFY_MAX_RETRIES,
+                 retry_backoff_seconds=NOTIFY_RETRY_BACKOFF_SECONDS):
+        self.transport = transport if transport else make_transport()
+        self.batch_seconds = batch_seconds
+        self.max_retries = max_retries
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self.sent_count = 0
+        self.failed_count = 0
+        self._queue = Queue()
+        self._worker = threading.Thread(target=self._run, name="notification-dispatcher")
+        self._worker.daemon = True
+        self._worker.start()
+
+    def send_email(self, to_emails_list, subject, body):
+        self._queue.put((tuple(to_emails_list), subject, body))
+
+    def _next_batch(self):
+        """Block for one message, then collect whatever else arrives within batch_seconds"""
+        message = self._queue.get()
+        if message is self._STOP:
+            return [], True
+        batch = [message]
+        deadline = time.time() + self.batch_seconds
+        while True:
+            try:
+                message = self._queue.get(timeout=max(deadline - time.time(), 0))
+            except Empty:
+                return batch, False
+            if message is self._STOP:
+                return batch, True
+            batch.append(message)
+
+    @staticmethod
+    def _digests(batch):
+        """Merge messages to the same recipients into one"""
+        by_recipients = OrderedDict()
+        for to_emails, subject, body in batch:
+            by_recipients.setdefault(to_emails, []).append((subject, body))
+        for to_emails, messages in by_recipients.items():
+            if len(messages) == 1:
+                subject, body = messages[0]
+            else:
+                subject = "[%s notifications] %s" % (len(messages), messages[0][0])
+                body = "\n\n".join("%s\n%s\n%s" % (subject, "-" * len(subject), body) for subject, body in messages)
+            yield list(to_emails), subject, body
+
+    def _send_with_retry(self, to_emails_list, subject, body):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.transport.send(to_emails_list, subject, body)
+                self.sent_count += 1
+                LOGGER.info("Email sent to: %s", to_emails_list)
+                return
+            except EmailSendingException as e:
+                if attempt == self.max_retries:
+                    self.failed_count += 1
+                    LOGGER.error("Email failed to send to: %s after %s attempts | Error: %s",
+                                 to_emails_list, attempt + 1, e)
+                    return
+                backoff_seconds = self.retry_backoff_seconds * 2 ** attempt
+                LOGGER.info("Email to %s failed, retrying in %s seconds | Error: %s", to_emails_list, backoff_seconds, e)
+                time.sleep(backoff_seconds)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            for to_emails_list, subject, body in self._digests(batch):
+                try:
+                    self._send_with_retry(to_emails_list, subject, body)
+                except Exception as e:
+                    LOGGER.exception("Unexpected error sending email: %s", e)
+        self.transport.close()
+
+    def close(self, timeout=NOTIFY_FLUSH_TIMEOUT_SECONDS):
+        """Send whatever is queued and stop, giving up after timeout seconds so shutdown is bounded"""
+        self._queue.put(self._STOP)
+        self._worker.join(timeout)
+        if self._worker.is_alive():
+            LOGGER.warning("Gave up waiting for %s queued notification(s) after %s seconds", self._queue.qsize(), timeout)
+
 class GMailNotify(object):
 
     def __init__(self, gmail_user, gmail_password):
@@ -28,18 +209,13 @@ class GMailNotify(object):
         self.gmail_password = gmail_password
 
     def send_email(self, to_emails_list, subject, body):
+        """Send one message synchronously over its own session, see NotificationDispatcher to send in the background"""
+        transport = SmtpTransport(GMAIL_SMTP_HOST, GMAIL_PORT, self.gmail_user, self.gmail_password, use_ssl=True)
         try:
-            server = smtplib.SMTP_SSL(GMAIL_SMTP_HOST, GMAIL_PORT)
-            server.ehlo()
-            server.login(self.gmail_user, self.gmail_password)
-            message = 'Subject: {}\n\n{}'.format(subject, body)
-            server.sendmail(
-                from_addr=self.gmail_user,
-                to_addrs=to_emails_list,
-                msg=message,
-            )
-            server.close()
+            transport.send(to_emails_list, subject, body)
             LOGGER.info("Email sent to: %s", to_emails_list)
-        except Exception as e:
+        except EmailSendingException as e:
             LOGGER.error("Email failed to send to: %s | Error: %s", to_emails_list, e)
-            raise EmailSendingException(e)
+            raise
+        finally:
+            transport.close()
@@ -0,0 +1,159 @@
+"""
+:author: Henley Kuang
+:since: 05/19/2019
+
+Stream a listings table to NDJSON or CSV, optionally gzipped, without holding the table in memory.
+
+python rent_price_collection/misc/export.py all --format ndjson --gzip --output all_listings.ndjson.gz
+python rent_price_collection/misc/export.py zillow --format csv > zillow_listings.csv
+"""
+
+import argparse
+import csv
+import datetime
+import decimal
+import gzip
+import json
+import logging
+import sys
+import zlib
+
+from rent_price_collection.utils.config import (
+    DEFAULT_LOG_FORMAT_STRING,
+    MYSQL_STREAM_FETCH_SIZE,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ['ndjson', 'csv']
+
+def _json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    raise TypeError("%r is not JSON serializable" % value)
+
+def ndjson_line(row):
+    return json.dumps(row, default=_json_default, separators=(',', ':')) + "\n"
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield ndjson_line(row)
+
+def ndjson_chunks(rows, chunk_rows):
+    """Group NDJSON lines into chunks of chunk_rows rows so a stream is not written one row at a time"""
+    chunk = []
+    for line in ndjson_lines(rows):
+        chunk.append(line)
+        if len(chunk) >= chunk_rows:
+            yield "".join(chunk)
+            chunk = []
+    if chunk:
+        yield "".join(chunk)
+
+def gzip_chunks(chunks, compress_level=6):
+    """
+    Gzip a stream of chunks. Each chunk is sync flushed so the client can decode
+    everything received so far instead of waiting for the end of the stream.
+    """
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def write_ndjson(rows, out):
+    count = 0
+    for line in ndjson_lines(rows):
+        out.write(line)
+        count += 1
+    return count
+
+def write_csv(rows, out):
+    writer = None
+    count = 0
+    for row in rows:
+        if writer is None:
+            # rows are plain dicts, sort the header so every export has the same column order
+            writer = csv.DictWriter(out, fieldnames=sorted(row.keys()))
+            writer.writeheader()
+        writer.writerow(row)
+        count += 1
+    return count
+
+WRITERS = {
+    'ndjson': write_ndjson,
+    'csv': write_csv,
+}
+
+def export_rows(rows, out, export_format='ndjson', compress=False):
+    """
+    Write rows to out as they are read. Returns the number of rows written.
+
+    :param rows: iterable of row dicts, usually a server side cursor generator
+    :type rows: iterable
+    :param out: file object to write to
+    :type out: file
+    :param export_format: one of EXPORT_FORMATS
+    :type export_format: string
+    :param compress: gzip the output
+    :type compress: bool
+    """
+    writer = WRITERS[export_format]
+    if not compress:
+        return writer(rows, out)
+    gzip_out = gzip.GzipFile(fileobj=out, mode='wb')
+    try:
+        return writer(rows, gzip_out)
+    finally:
+        gzip_out.close()
+
+def _get_rows(table, limit, fetch_size):
+    if table == 'all':
+        from rent_price_collection.storage.all_listings_mysql import AllListingsMySql
+        storage = AllListingsMySql()
+        iter_listings = storage.iter_all_listings
+    elif table == 'zillow':
+        from rent_price_collection.storage.zillow_mysql import ZillowMySql
+        storage = ZillowMySql()
+        iter_listings = storage.iter_zillow_listings
+    else:
+        from rent_price_collection.storage.trulia_mysql import TruliaMySql
+        storage = TruliaMySql()
+        iter_listings = storage.iter_trulia_listings
+    try:
+        return iter_listings(limit=limit, fetch_size=fetch_size)
+    finally:
+        # rows stream over a connection of their own once iterated, the storage's is not needed
+        storage.close()
+
+def _parse_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('table', choices=['all', 'zillow', 'trulia'])
+    parser.add_argument('--format', dest='export_format', choices=EXPORT_FORMATS, default='ndjson')
+    parser.add_argument('--gzip', action='store_true', help='gzip the output')
+    parser.add_argument('--output', help='file to write to, defaults to stdout')
+    parser.add_argument('--limit', type=int)
+    parser.add_argument('--fetch-size', type=int, default=MYSQL_STREAM_FETCH_SIZE,
+                        help='rows pulled from mysql per round trip')
+
+    return parser.parse_args()
+
+def _main():
+    options = _parse_args()
+
+    rows = _get_rows(options.table, options.limit, options.fetch_size)
+    if options.output:
+        with open(options.output, 'wb') as out:
+            count = export_rows(rows, out, options.export_format, options.gzip)
+    else:
+        count = export_rows(rows, sys.stdout, options.export_format, options.gzip)
+    LOGGER.info("Exported %s rows from %s listings", count, options.table)
+
+
+if __name__ == '__main__':
+    # logs go to stderr so they never mix into an export written to stdout
+    logging.basicConfig(format=DEFAULT_LOG_FORMAT_STRING, datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO)
+    _main()
@@ -0,0 +1,273 @@
+"""
+:author: Henley Kuang
+:since: 06/16/2019
+
+Match new listings against every saved search without checking each search against each listing.
+
+Saved searches are compiled into an inverted index keyed by zip code, or by city for searches without
+a zip code, plus one bucket for searches on neither. Within a bucket the price and beds ranges are
+stored in interval trees, so a listing only visits the buckets of its own zip code and city and each
+tree returns the searches whose range contains the listing's value in O(log n + matches).
+"""
+
+import argparse
+import logging
+
+from collections import defaultdict, OrderedDict
+
+from rent_price_collection.storage.saved_searches_mysql import (
+    SavedSearchesMySql,
+)
+from rent_price_collection.utils.config import (
+    DEFAULT_LOG_FORMAT_STRING,
+)
+from rent_price_collection.utils.exceptions import (
+    EmailSendingException,
+)
+from rent_price_collection.utils.parsers import (
+    parse_beds,
+    parse_price,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+UNBOUNDED_LOW = float('-inf')
+UNBOUNDED_HIGH = float('inf')
+ANY_LOCATION = ('any',)
+
+def _normalize(value):
+    if value is None:
+        return None
+    return str(value).strip().lower()
+
+def listing_url(listing):
+    """Full url of a ZillowListing or TruliaListing"""
+    if hasattr(listing, 'detail_url'):
+        return listing.detail_url
+    return "https://www.trulia.com%s" % listing.card_url
+
+class IntervalTree(object):
+    """
+    Static centered interval tree over closed [low, high] intervals.
+    Each node keeps the intervals containing its center sorted by low and by high, the rest go left or right.
+    """
+
+    __slots__ = ('center', 'by_low', 'by_high', 'left', 'right')
+
+    def __init__(self, intervals):
+        """:param intervals: non empty list of (low, high, value)"""
+        endpoints = sorted(endpoint for low, high, _ in intervals for endpoint in (low, high))
+        self.center = endpoints[len(endpoints) // 2]
+        left = [interval for interval in intervals if interval[1] < self.center]
+        right = [interval for interval in intervals if interval[0] > self.center]
+        overlapping = [interval for interval in intervals if interval[0] <= self.center <= interval[1]]
+        self.by_low = sorted(overlapping, key=lambda interval: interval[0])
+        self.by_high = sorted(overlapping, key=lambda interval: interval[1], reverse=True)
+        self.left = IntervalTree(left) if left else None
+        self.right = IntervalTree(right) if right else None
+
+    def stab(self, point):
+        """Values of every interval containing point"""
+        values = []
+        node = self
+        while node is not None:
+            if point < node.center:
+                for low, _, value in node.by_low:
+                    if low > point:
+                        break
+                    values.append(value)
+                node = node.left
+            elif point > node.center:
+                for _, high, value in node.by_high:
+                    if high < point:
+                        break
+                    values.append(value)
+                node = node.right
+            else:
+                values.extend(value for _, _, value in node.by_low)
+                break
+        return values
+
+class _Bucket(object):
+
+    def __init__(self, saved_searches):
+        price_intervals = []
+        beds_intervals = []
+        # listings without a price or beds only match searches not filtering on it
+        self.any_price = set()
+        self.any_beds = set()
+        for saved_search in saved_searches:
+            price_interval = (saved_search.min_price, saved_search.max_price)
+            beds_interval = (saved_search.min_beds, saved_search.max_beds)
+            if price_interval == (None, None):
+                self.any_price.add(saved_search.saved_search_id)
+            if beds_interval == (None, None):
+                self.any_beds.add(saved_search.saved_search_id)
+            self._add_interval(price_intervals, price_interval, saved_search.saved_search_id)
+            self._add_interval(beds_intervals, beds_interval, saved_search.saved_search_id)
+        self.price_tree = IntervalTree(price_intervals) if price_intervals else None
+        self.beds_tree = IntervalTree(beds_intervals) if beds_intervals else None
+
+    @staticmethod
+    def _add_interval(intervals, bounds, saved_search_id):
+        low = UNBOUNDED_LOW if bounds[0] is None else bounds[0]
+        high = UNBOUNDED_HIGH if bounds[1] is None else bounds[1]
+        # a minimum above the maximum can never match
+        if low <= high:
+            intervals.append((low, high, saved_search_id))
+
+    @staticmethod
+    def _stab(tree, any_value, value):
+        if value is None:
+            return any_value
+        if tree is None:
+            return []
+        return tree.stab(value)
+
+    def match(self, price, beds):
+        price_matches = self._stab(self.price_tree, self.any_price, price)
+        if not price_matches:
+            return set()
+        return set(price_matches).intersection(self._stab(self.beds_tree, self.any_beds, beds))
+
+class Percolator(object):
+
+    def __init__(self, saved_searches):
+        """:param saved_searches: list of SavedSearch"""
+        self.saved_searches = dict((saved_search.saved_search_id, saved_search) for saved_search in saved_searches)
+        by_location = defaultdict(list)
+        for saved_search in saved_searches:
+            by_location[self._location_key(saved_search)].append(saved_search)
+        self.buckets = dict((location, _Bucket(searches)) for location, searches in by_location.items())
+
+    @staticmethod
+    def _location_key(saved_search):
+        if saved_search.zip_code is not None:
+            return ('zip_code', int(saved_search.zip_code))
+        if saved_search.city is not None:
+            return ('city', _normalize(saved_search.city))
+        return ANY_LOCATION
+
+    def percolate(self, listing):
+        """
+        Saved searches matching a listing
+
+        :param listing: ZillowListing or TruliaListing
+        :returns: list of SavedSearch
+        """
+        price = parse_price(listing.price)
+        beds = parse_beds(listing.beds)
+        state = _normalize(listing.state)
+        locations = [('zip_code', int(listing.zip_code)), ('city', _normalize(listing.city)), ANY_LOCATION]
+        matches = []
+        for location in locations:
+            bucket = self.buckets.get(location)
+            if bucket is None:
+                continue
+            for saved_search_id in bucket.match(price, beds):
+                saved_search = self.saved_searches[saved_search_id]
+                # the few candidates left are checked against the criteria that are not indexed
+                if saved_search.state is not None and _normalize(saved_search.state) != state:
+                    continue
+                if saved_search.zip_code is not None and saved_search.city is not None \
+                        and _normalize(saved_search.city) != _normalize(listing.city):
+                    continue
+                matches.append(saved_search)
+        return matches
+
+class ListingAlerts(object):
+    """
+    Percolation stage of a crawl. New listings are matched after every upsert and the matches of
+    the whole run are sent at the end as one digest email per subscriber.
+    Failures are logged and never fail the crawl.
+    """
+
+    MAX_DIGEST_LISTINGS = 50
+
+    def __init__(self, source, email_client, saved_searches=None):
+        self.source = source
+        self.email_client = email_client
+        if saved_searches is None:
+            saved_searches = self._load_saved_searches()
+        self.percolator = Percolator(saved_searches)
+        # email -> listing url -> (listing, ids of the saved searches it matched)
+        self.matches = defaultdict(OrderedDict)
+
+    @staticmethod
+    def _load_saved_searches():
+        saved_searches_mysql = None
+        try:
+            saved_searches_mysql = SavedSearchesMySql()
+            return saved_searches_mysql.select_saved_searches()
+        except Exception as e:
+            LOGGER.error("Failed to load saved searches, alerts are disabled for this run: %s", e)
+            return []
+        finally:
+            if saved_searches_mysql is not None:
+                saved_searches_mysql.close()
+
+    def percolate(self, new_listings):
+        """Record the saved searches every new listing matches, returns the number of match events"""
+        match_count = 0
+        try:
+            for listing in new_listings:
+                for saved_search in self.percolator.percolate(listing):
+                    url = listing_url(listing)
+                    _, saved_search_ids = self.matches[saved_search.email].setdefault(url, (listing, []))
+                    saved_search_ids.append(saved_search.saved_search_id)
+                    match_count += 1
+        except Exception as e:
+            LOGGER.exception("Failed to percolate new listings: %s", e)
+        if match_count:
+            LOGGER.info("%s new listings matched saved searches %s times", self.source, match_count)
+        return match_count
+
+    def _format_digest(self, listing_matches):
+        lines = []
+        for url, (listing, saved_search_ids) in list(listing_matches.items())[:self.MAX_DIGEST_LISTINGS]:
+            lines.append("%s | %s | %s, %s %s | %s" % (listing.price, listing.beds, listing.street_address,
+                                                       listing.city, listing.zip_code, url))
+        if len(listing_matches) > self.MAX_DIGEST_LISTINGS:
+            lines.append("and %s more" % (len(listing_matches) - self.MAX_DIGEST_LISTINGS))
+        return "\n".join(lines)
+
+    def send_digests(self):
+        """Email every subscriber the listings matched during the run, returns the number of digests sent"""
+        sent_count = 0
+        for email, listing_matches in self.matches.items():
+            subject = "[%s Alert] %s new listings match your saved searches" % (self.source, len(listing_matches))
+            try:
+                self.email_client.send_email([email], subject, self._format_digest(listing_matches))
+                sent_count += 1
+            except EmailSendingException as e:
+                LOGGER.info("Failed to send alert digest to %s: %s", email, e)
+        self.matches.clear()
+        return sent_count
+
+def _parse_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--city', required=True)
+    parser.add_argument('--state', required=True)
+    parser.add_argument('--zip-code', type=int, default=-1)
+    parser.add_argument('--price', required=True)
+    parser.add_argument('--beds', default='-1')
+
+    return parser.parse_args()
+
+def _main():
+    options = _parse_args()
+
+    saved_searches_mysql = SavedSearchesMySql()
+    percolator = Percolator(saved_searches_mysql.select_saved_searches())
+    saved_searches_mysql.close()
+
+    from rent_price_collection.app.trulia_rpc import TruliaListing
+    listing = TruliaListing(listing_id=0, card_url='', street_address='', city=options.city, state=options.state,
+                            zip_code=options.zip_code, beds=options.beds, baths='-1', lat=-1, lng=-1, sqft='-1',
+                            price=options.price)
+    LOGGER.info(percolator.percolate(listing))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format=DEFAULT_LOG_FORMAT_STRING, datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO)
+    _main()
@@ -0,0 +1,111 @@
+"""
+:author: Henley Kuang
+:since: 06/08/2019
+
+Closed loop load test for the search api: concurrency clients each send a request as soon as the
+previous one returns, for duration seconds. Prints throughput and latency percentiles as JSON so runs
+against run_uwsgi.sh and run_uwsgi_gevent.sh can be compared.
+
+python rent_price_collection/scripts/benchmark_api.py --url "http://127.0.0.1:8081/search?city=Arlington" --concurrency 32
+"""
+
+import argparse
+import json
+import logging
+import threading
+import time
+
+from httplib import HTTPConnection
+from urlparse import urlparse
+
+from rent_price_collection.utils.config import (
+    DEFAULT_LOG_FORMAT_STRING,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+class _Client(threading.Thread):
+
+    def __init__(self, urls, deadline, timeout):
+        super(_Client, self).__init__()
+        self.daemon = True
+        self.urls = urls
+        self.deadline = deadline
+        self.timeout = timeout
+        self.latencies = []
+        self.errors = 0
+
+    def run(self):
+        connections = {}
+        request_num = 0
+        while time.time() < self.deadline:
+            url = self.urls[request_num % len(self.urls)]
+            request_num += 1
+            netloc = url.netloc
+            start = time.time()
+            try:
+                if netloc not in connections:
+                    connections[netloc] = HTTPConnection(netloc, timeout=self.timeout)
+                path = url.path + ("?" + url.query if url.query else "")
+                connections[netloc].request("GET", path, headers={"Accept-Encoding": "gzip"})
+                response = connections[netloc].getresponse()
+                response.read()
+                if response.status >= 400:
+                    self.errors += 1
+                    continue
+            except Exception:
+                self.errors += 1
+                connections.pop(netloc, None)
+                continue
+            self.latencies.append(time.time() - start)
+
+def run_benchmark(urls, concurrency, duration, timeout=30):
+    parsed_urls = [urlparse(url) for url in urls]
+    deadline = time.time() + duration
+    clients = [_Client(parsed_urls, deadline, timeout) for _ in range(concurrency)]
+    start = time.time()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.time() - start
+    latencies = sorted(latency for client in clients for latency in client.latencies)
+    return {
+        "concurrency": concurrency,
+        "duration_seconds": elapsed,
+        "requests": len(latencies),
+        "errors": sum(client.errors for client in clients),
+        "requests_per_second": len(latencies) / elapsed,
+        "latency_ms": {
+            "p50": (_percentile(latencies, 0.5) or 0) * 1000,
+            "p90": (_percentile(latencies, 0.9) or 0) * 1000,
+            "p99": (_percentile(latencies, 0.99) or 0) * 1000,
+            "max": (latencies[-1] if latencies else 0) * 1000,
+        },
+    }
+
+def _parse_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--url', action='append', required=True, help='url to request, repeat to rotate through several')
+    parser.add_argument('--concurrency', type=int, action='append',
+                        help='number of concurrent clients, repeat to run several levels')
+    parser.add_argument('--duration', type=int, default=30, help='seconds per concurrency level')
+
+    return parser.parse_args()
+
+def _main():
+    options = _parse_args()
+
+    for concurrency in options.concurrency or [8]:
+        LOGGER.info("Running %s concurrent clients for %s seconds", concurrency, options.duration)
+        print(json.dumps(run_benchmark(options.url, concurrency, options.duration), sort_keys=True))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format=DEFAULT_LOG_FORMAT_STRING, datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO)
+    _main()
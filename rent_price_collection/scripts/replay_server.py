@@ -0,0 +1,262 @@
+"""
+:author: Henley Kuang
+:since: 06/20/2019
+
+Stand-in for the Zillow and Trulia apis, so whole crawls can run offline. Requests are answered from
+archives recorded with --record-file (see utils/http_archive.py), or with synthetic pages generated from
+example_zillow_response.json and example_trulia_response.json, with configurable latency, 503s and stalls.
+The domain is taken from the Host header, which RestClient sends when api_host is set.
+
+python rent_price_collection/scripts/replay_server.py --port 8090 --latency-ms 200 --error-rate 0.05
+python rent_price_collection/app/zillow_rpc.py --location "Arlington Heights, IL" --api-host 127.0.0.1:8090 --no-sleep
+
+GET /_stats returns request counts and throughput since the server started. Bodies are gzip or brotli
+compressed when the request accepts it, like the real apis, unless --no-compress is passed.
+"""
+
+import argparse
+import json
+import logging
+import random
+import re
+import threading
+import time
+import zlib
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qs, urlparse
+
+from rent_price_collection.api.http_utils import (
+    compress_body,
+    MIN_COMPRESS_BYTES,
+    negotiate_encoding,
+)
+from rent_price_collection.benchmarks.corpora import (
+    trulia_response,
+    zillow_response,
+)
+from rent_price_collection.clients.trulia_rest_client import (
+    TRULIA_DOMAIN,
+)
+from rent_price_collection.clients.zillow_rest_client import (
+    ZILLOW_DOMAIN,
+)
+from rent_price_collection.utils.config import (
+    DEFAULT_LOG_FORMAT_STRING,
+)
+from rent_price_collection.utils.http_archive import (
+    HttpArchive,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+TRULIA_PAGE_REGEX = re.compile(r'/for_rent/([^/]+)/.*?(\d+)_p')
+# every synthetic region is centered on the example listings, which the synthetic pages jitter around
+REGION_LATITUDE = 42.08
+REGION_LONGITUDE = -87.98
+REGION_XML = '''<?xml version="1.0" encoding="utf-8"?>
+<RegionChildren><message><text>Request successfully processed</text><code>0</code></message>
+<response><region><id>{region_id}</id><latitude>{latitude}</latitude><longitude>{longitude}</longitude></region></response>
+</RegionChildren>'''
+
+def _location_number(location):
+    return zlib.crc32(location.lower().encode('utf-8')) & 0xffff
+
+class SyntheticApi(object):
+    """Search pages for any location, listing ids are unique per location and page and stable between runs"""
+
+    def __init__(self, page_size=40, pages=5):
+        self.page_size = page_size
+        self.pages = pages
+
+    def _first_id(self, base, location, page_num):
+        return base + (_location_number(location) * (self.pages + 1) + page_num) * self.page_size
+
+    def zillow_region(self, query):
+        city = query.get('city', [''])[0]
+        content = REGION_XML.format(region_id=_location_number(city), latitude=REGION_LATITUDE,
+                                    longitude=REGION_LONGITUDE)
+        return 200, 'text/xml', content.encode('utf-8')
+
+    def zillow_search(self, query):
+        search_query_state = json.loads(query['searchQueryState'][0])
+        location = search_query_state.get('usersSearchTerm', '')
+        page_num = search_query_state.get('pagination', {}).get('currentPage', 1)
+        response = zillow_response(self.page_size, seed=_location_number(location) ^ page_num,
+                                   first_id=self._first_id(10000000, location, page_num))
+        response["searchList"]["totalPages"] = self.pages
+        return 200, 'application/json', json.dumps(response).encode('utf-8')
+
+    def trulia_search(self, url):
+        match = TRULIA_PAGE_REGEX.search(url)
+        if match is None:
+            return 404, 'application/json', b'{"success": false}'
+        location, page_num = match.group(1), int(match.group(2))
+        response = trulia_response(self.page_size, seed=_location_number(location) ^ page_num,
+                                   first_id=self._first_id(4000000000, location, page_num))
+        if page_num > self.pages:
+            response["page"]["cards"] = []
+        return 200, 'application/json', json.dumps(response).encode('utf-8')
+
+    def respond(self, domain, method, path):
+        parsed_path = urlparse(path)
+        if domain == ZILLOW_DOMAIN and parsed_path.path.startswith('/webservice/'):
+            return self.zillow_region(parse_qs(parsed_path.query))
+        if domain == ZILLOW_DOMAIN and parsed_path.path.startswith('/search/'):
+            return self.zillow_search(parse_qs(parsed_path.query))
+        if domain == TRULIA_DOMAIN and parsed_path.path.startswith('/json/search/url'):
+            # the url parameter is not parsed with parse_qs, it contains ;
+            return self.trulia_search(parsed_path.query)
+        return None
+
+class ReplayResponder(object):
+
+    def __init__(self, http_archive=None, synthetic_api=None, latency_ms=0, latency_jitter_ms=0,
+                 error_rate=0.0, stall_rate=0.0, stall_seconds=90, seed=None):
+        """
+        :param http_archive: HttpArchive answered first, None to only serve synthetic pages
+        :param synthetic_api: SyntheticApi for requests missing from the archive, None answers them with 404
+        :param error_rate: fraction of requests answered with a 503
+        :param stall_rate: fraction of requests held for stall_seconds, past RestClient's timeout
+        """
+        self.http_archive = http_archive
+        self.synthetic_api = synthetic_api
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.error_rate = error_rate
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self.random = random.Random(seed)
+        self.started = time.time()
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self.counts)
+        elapsed = time.time() - self.started
+        requests = sum(count for name, count in counts.items() if name.startswith('status_'))
+        return {
+            "elapsed_seconds": round(elapsed, 3),
+            "requests": requests,
+            "requests_per_second": round(requests / elapsed, 3) if elapsed else None,
+            "counts": counts,
+        }
+
+    def respond(self, domain, method, path):
+        """:returns: (status, content type, body)"""
+        with self._lock:
+            delay = max(self.latency_ms + self.random.uniform(-1, 1) * self.latency_jitter_ms, 0) / 1000.0
+            stall = self.random.random() < self.stall_rate
+            error = self.random.random() < self.error_rate
+        if stall:
+            self.count('stalled')
+            delay = self.stall_seconds
+        time.sleep(delay)
+        if error:
+            self.count('injected_errors')
+            return 503, 'text/html', b'<html><body>Service Unavailable</body></html>'
+        if self.http_archive is not None:
+            exchange = self.http_archive.lookup(domain, method, path)
+            if exchange is not None:
+                self.count('replayed')
+                return exchange["status"], 'application/octet-stream', exchange["content"]
+        if self.synthetic_api is not None:
+            response = self.synthetic_api.respond(domain, method, path)
+            if response is not None:
+                self.count('synthetic')
+                return response
+        self.count('missing')
+        return 404, 'text/plain', b'Not recorded'
+
+class ReplayHandler(BaseHTTPRequestHandler):
+
+    def _respond(self):
+        if self.path == '/_stats':
+            status, content_type, body = 200, 'application/json', json.dumps(self.server.responder.stats()).encode('utf-8')
+        else:
+            domain = self.headers.get('Host', '').split(':')[0]
+            status, content_type, body = self.server.responder.respond(domain, self.command, self.path)
+            self.server.responder.count('status_%s' % status)
+        encoding = negotiate_encoding(self.headers.get('Accept-Encoding')) if self.server.compress else None
+        if encoding is not None and len(body) >= MIN_COMPRESS_BYTES:
+            body = compress_body(body, encoding)
+        else:
+            encoding = None
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._respond()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self._respond()
+
+    def log_message(self, format, *args):
+        LOGGER.debug(format, *args)
+
+class ReplayServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, responder, compress=True):
+        HTTPServer.__init__(self, address, ReplayHandler)
+        self.responder = responder
+        self.compress = compress
+
+def _parse_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--archive', action='append', help='recorded archive to replay, may be repeated')
+    parser.add_argument('--no-synthetic', action='store_true', help='answer requests missing from the archives with 404')
+    parser.add_argument('--page-size', type=int, default=40, help='listings per synthetic page')
+    parser.add_argument('--pages', type=int, default=5, help='synthetic pages per location')
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--latency-jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with a 503')
+    parser.add_argument('--stall-rate', type=float, default=0.0, help='fraction of requests held for --stall-seconds')
+    parser.add_argument('--stall-seconds', type=float, default=90)
+    parser.add_argument('--seed', type=int, help='seed of the injected latency and errors')
+    parser.add_argument('--no-compress', action='store_true', help='never compress response bodies')
+
+    return parser.parse_args()
+
+def _main():
+    options = _parse_args()
+
+    responder = ReplayResponder(
+        http_archive=HttpArchive(options.archive) if options.archive else None,
+        synthetic_api=None if options.no_synthetic else SyntheticApi(options.page_size, options.pages),
+        latency_ms=options.latency_ms,
+        latency_jitter_ms=options.latency_jitter_ms,
+        error_rate=options.error_rate,
+        stall_rate=options.stall_rate,
+        stall_seconds=options.stall_seconds,
+        seed=options.seed,
+    )
+    replay_server = ReplayServer((options.host, options.port), responder, compress=not options.no_compress)
+    LOGGER.info("Serving the api stand-in on %s:%s", options.host, options.port)
+    try:
+        replay_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        replay_server.server_close()
+        LOGGER.info("Stats: %s", json.dumps(responder.stats(), sort_keys=True))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format=DEFAULT_LOG_FORMAT_STRING, datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO)
+    _main()
@@ -0,0 +1,211 @@
+"""
+:author: Henley Kuang
+:since: 06/09/2019
+
+In memory typeahead over the distinct cities, states, zip codes and streets of all_listings.
+
+Each field is a sorted list of lowercased names, so every name starting with a prefix is one
+contiguous range found with two binary searches. The top suggestions of every 1 to
+SHORT_PREFIX_LENGTH character prefix are precomputed since those ranges are the largest.
+New listings are merged in incrementally, a periodic full rebuild corrects the counts of
+listings that were removed or changed city.
+"""
+
+import argparse
+import bisect
+import heapq
+import logging
+import threading
+import time
+
+from rent_price_collection.storage.all_listings_mysql import (
+    AllListingsMySql,
+)
+from rent_price_collection.utils.config import (
+    AUTOCOMPLETE_REBUILD_SECONDS,
+    AUTOCOMPLETE_REFRESH_SECONDS,
+    DEFAULT_LOG_FORMAT_STRING,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+SHORT_PREFIX_LENGTH = 3
+MAX_SUGGESTIONS = 10
+
+# field name -> (columns grouped on, how a group is displayed)
+AUTOCOMPLETE_FIELDS = {
+    'city': (['city', 'state'], u"{city}, {state}"),
+    'state': (['state'], u"{state}"),
+    'zip_code': (['zip_code'], u"{zip_code}"),
+    'street_address': (['street_address', 'city', 'state'], u"{street_address}, {city}, {state}"),
+}
+
+def _to_text(value):
+    if isinstance(value, bytes):
+        return value.decode('latin1')
+    return u"%s" % value
+
+class _PrefixIndex(object):
+
+    def __init__(self, counts):
+        """:param counts: dict of display name to listing count"""
+        self.counts = counts
+        self.keys = sorted((display.lower(), display) for display in counts)
+        self.lowered = [lowered for lowered, _ in self.keys]
+        self.top = {}
+        for length in range(1, SHORT_PREFIX_LENGTH + 1):
+            self._build_top(length)
+
+    def _build_top(self, length):
+        # names sharing a prefix are adjacent in sorted order, so every prefix is one pass over a run
+        start = 0
+        while start < len(self.keys):
+            prefix = self.lowered[start][:length]
+            end = start + 1
+            while end < len(self.keys) and self.lowered[end][:length] == prefix:
+                end += 1
+            if len(prefix) == length:
+                self.top[prefix] = self._rank(start, end)
+            start = end
+
+    def _rank(self, start, end):
+        candidates = ((self.counts[display], display) for _, display in self.keys[start:end])
+        return [(display, count) for count, display in heapq.nlargest(MAX_SUGGESTIONS, candidates)]
+
+    def _range(self, prefix):
+        start = bisect.bisect_left(self.lowered, prefix)
+        end = bisect.bisect_left(self.lowered, prefix + u"\uffff")
+        return start, end
+
+    def suggest(self, prefix, limit):
+        prefix = prefix.lower()
+        if prefix in self.top:
+            return self.top[prefix][:limit]
+        start, end = self._range(prefix)
+        return self._rank(start, end)[:limit]
+
+    def add(self, display, count):
+        """Add count listings to display, inserting it when new"""
+        if display in self.counts:
+            self.counts[display] += count
+        else:
+            self.counts[display] = count
+            lowered = display.lower()
+            position = bisect.bisect_left(self.keys, (lowered, display))
+            self.keys.insert(position, (lowered, display))
+            self.lowered.insert(position, lowered)
+        # counts only grow here, so display either stays out of a prefix's top or moves up within it
+        lowered = display.lower()
+        for length in range(1, min(SHORT_PREFIX_LENGTH, len(lowered)) + 1):
+            prefix = lowered[:length]
+            candidates = [(count, other) for other, count in self.top.get(prefix, []) if other != display]
+            candidates.append((self.counts[display], display))
+            self.top[prefix] = [(other, count) for count, other in heapq.nlargest(MAX_SUGGESTIONS, candidates)]
+
+class AllListingsAutocomplete(object):
+
+    def __init__(self, all_listings_mysql=None, refresh_seconds=AUTOCOMPLETE_REFRESH_SECONDS,
+                 rebuild_seconds=AUTOCOMPLETE_REBUILD_SECONDS):
+        self.all_listings_mysql = all_listings_mysql if all_listings_mysql else AllListingsMySql()
+        self.refresh_seconds = refresh_seconds
+        self.rebuild_seconds = rebuild_seconds
+        self._indexes = {}
+        self._watermark = None
+        self._last_rebuild = None
+        # serializes builds and refreshes, held while querying mysql
+        self._refresh_lock = threading.Lock()
+        # guards in place index updates against concurrent suggestions, only held for in memory work
+        self._index_lock = threading.Lock()
+
+    def _count(self, field, collected_after=None, collected_until=None):
+        columns, display_format = AUTOCOMPLETE_FIELDS[field]
+        counts = {}
+        for row in self.all_listings_mysql.count_listings_by(columns, collected_after=collected_after,
+                                                             collected_until=collected_until):
+            display = display_format.format(**dict((column, _to_text(row[column])) for column in columns))
+            counts[display] = counts.get(display, 0) + row["listing_count"]
+        return counts
+
+    def build(self):
+        """Build every field's index from scratch"""
+        with self._refresh_lock:
+            watermark = self.all_listings_mysql.select_last_date_collected()
+            # counts stop at the watermark, rows collected meanwhile are counted by the next refresh
+            indexes = dict((field, _PrefixIndex(self._count(field, collected_until=watermark)))
+                           for field in AUTOCOMPLETE_FIELDS)
+            with self._index_lock:
+                self._indexes = indexes
+            self._watermark = watermark
+            self._last_rebuild = time.time()
+        LOGGER.info("Built autocomplete index: %s", dict((field, len(index.keys)) for field, index in indexes.items()))
+
+    def refresh(self):
+        """Merge in listings collected since the last build or refresh"""
+        if self._watermark is None or time.time() - self._last_rebuild >= self.rebuild_seconds:
+            self.build()
+            return
+        with self._refresh_lock:
+            watermark = self.all_listings_mysql.select_last_date_collected()
+            if watermark is None or watermark <= self._watermark:
+                return
+            new_counts = dict((field, self._count(field, collected_after=self._watermark, collected_until=watermark))
+                              for field in AUTOCOMPLETE_FIELDS)
+            with self._index_lock:
+                for field, counts in new_counts.items():
+                    for display, count in counts.items():
+                        self._indexes[field].add(display, count)
+            self._watermark = watermark
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_seconds)
+            try:
+                self.refresh()
+            except Exception as e:
+                LOGGER.exception("Failed to refresh the autocomplete index: %s", e)
+
+    def start(self):
+        """Build the index and keep it refreshed from a daemon thread"""
+        self.build()
+        refresh_thread = threading.Thread(target=self._refresh_loop, name="autocomplete-refresh")
+        refresh_thread.daemon = True
+        refresh_thread.start()
+
+    def suggest(self, prefix, fields=None, limit=MAX_SUGGESTIONS):
+        """
+        Suggestions for prefix ranked by listing count, across every field unless fields is given
+
+        :returns: list of {"field": ..., "value": ..., "count": ...}
+        """
+        prefix = _to_text(prefix).strip()
+        if not prefix:
+            return []
+        suggestions = []
+        with self._index_lock:
+            for field in fields or AUTOCOMPLETE_FIELDS.keys():
+                index = self._indexes.get(field)
+                if index is None:
+                    continue
+                for display, count in index.suggest(prefix, limit):
+                    suggestions.append({"field": field, "value": display, "count": count})
+        suggestions.sort(key=lambda suggestion: suggestion["count"], reverse=True)
+        return suggestions[:limit]
+
+def _parse_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('prefix')
+    parser.add_argument('--field', action='append', choices=sorted(AUTOCOMPLETE_FIELDS.keys()))
+
+    return parser.parse_args()
+
+def _main():
+    options = _parse_args()
+
+    all_listings_autocomplete = AllListingsAutocomplete()
+    all_listings_autocomplete.build()
+    LOGGER.info(all_listings_autocomplete.suggest(options.prefix, options.field))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format=DEFAULT_LOG_FORMAT_STRING, datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO)
+    _main()
@@ -0,0 +1,332 @@
+"""
+:author: Henley Kuang
+:since: 06/02/2019
+
+In memory, read only replica of all_listings for the api.
+
+Numeric columns are numpy arrays, every string column is dictionary encoded: a sorted array of the
+distinct values plus one int32 code per row. Code order is the same as value order, so sorting by a
+string column is a sort of its codes, and a like filter is evaluated once per distinct value instead
+of once per row. A background thread pulls rows updated since the last refresh and swaps in a new
+snapshot, requests always read a complete snapshot. Rows are pulled from the latest date_changed on,
+the ones already merged at exactly that date_changed are left out, so an idle table costs one query
+and no rebuild. A new snapshot copies the arrays of the previous one, patches updated rows in place and
+appends new rows, only string values never seen before are inserted into the dictionaries.
+"""
+
+import argparse
+import logging
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from rent_price_collection.storage.all_listings_mysql import (
+    AllListingsMySql,
+    ChangeWatermark,
+)
+from rent_price_collection.utils.config import (
+    COLUMNAR_REFRESH_SECONDS,
+    DEFAULT_LOG_FORMAT_STRING,
+)
+from rent_price_collection.utils.exceptions import (
+    InvalidSearchParameterException,
+)
+from rent_price_collection.utils.geo import (
+    EARTH_RADIUS_MILES,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+STRING_COLUMNS = ['id', 'source', 'url', 'street_address', 'city', 'state', 'zip_code',
+                  'beds', 'baths', 'sqft', 'price']
+FLOAT_COLUMNS = ['lat', 'lng']
+DATE_COLUMNS = ['date_collected', 'date_updated']
+# cached like matches per (column, value), cleared with every new snapshot
+MAX_CACHED_MATCHES = 1024
+
+def _merge_array(array, positions, values, appended, dtype):
+    merged = numpy.concatenate([array, numpy.array(appended, dtype=dtype)])
+    merged[positions] = numpy.array(values, dtype=dtype)
+    return merged
+
+def _to_text(value):
+    if isinstance(value, bytes):
+        return value.decode('latin1')
+    return u"%s" % value
+
+class _StringColumn(object):
+
+    __slots__ = ('dictionary', 'codes', 'lowered')
+
+    def __init__(self, values):
+        self.dictionary, codes = numpy.unique(numpy.array(values, dtype=object), return_inverse=True)
+        self.codes = codes.astype(numpy.int32)
+        self.lowered = numpy.array([_to_text(value).lower() for value in self.dictionary], dtype=object)
+
+    def merge(self, positions, values, appended):
+        """
+        Copy of the column with values written at positions and appended added as new rows.
+        Unseen values are inserted into the dictionary at their sorted place and the codes shifted to match.
+        """
+        incoming = numpy.array(list(values) + list(appended), dtype=object)
+        found = numpy.searchsorted(self.dictionary, incoming)
+        known = found < len(self.dictionary)
+        known[known] = self.dictionary[found[known]] == incoming[known]
+        merged = object.__new__(_StringColumn)
+        if known.all():
+            merged.dictionary = self.dictionary
+            merged.lowered = self.lowered
+            codes = self.codes
+            incoming_codes = found
+        else:
+            added = numpy.unique(incoming[~known])
+            at = numpy.searchsorted(self.dictionary, added)
+            merged.dictionary = numpy.insert(self.dictionary, at, added)
+            merged.lowered = numpy.insert(self.lowered, at,
+                                          numpy.array([_to_text(value).lower() for value in added], dtype=object))
+            # an old code moves up by the number of values inserted before it
+            shifts = numpy.searchsorted(at, numpy.arange(len(self.dictionary)), side='right')
+            codes = (numpy.arange(len(self.dictionary)) + shifts).astype(numpy.int32)[self.codes]
+            incoming_codes = numpy.searchsorted(merged.dictionary, incoming)
+        merged.codes = numpy.concatenate([codes, incoming_codes[len(values):].astype(numpy.int32)])
+        merged.codes[positions] = incoming_codes[:len(values)]
+        return merged
+
+    def like(self, value):
+        """Boolean mask over rows matching like '%value%', case insensitive as in mysql"""
+        value = _to_text(value).lower()
+        matched = numpy.fromiter((value in entry for entry in self.lowered), dtype=bool, count=len(self.lowered))
+        return matched[self.codes]
+
+    def decode(self, indices):
+        return self.dictionary[self.codes[indices]]
+
+class _Snapshot(object):
+
+    def __init__(self, columns, watermark=None):
+        """
+        :param columns: dict of column name to a list of values, every list in the same row order
+        :param watermark: latest date_changed of the rows
+        """
+        self.watermark = watermark
+        self.size = len(columns['id'])
+        self.strings = dict((name, _StringColumn(columns[name])) for name in STRING_COLUMNS)
+        self.floats = dict((name, numpy.array(columns[name], dtype=numpy.float64)) for name in FLOAT_COLUMNS)
+        self.dates = dict((name, numpy.array(columns[name], dtype='datetime64[s]')) for name in DATE_COLUMNS)
+        self.matches = {}
+
+    def merge(self, positions, updated_rows, appended_rows, watermark):
+        """
+        New snapshot with updated_rows written at their positions and appended_rows added at the end
+
+        :param positions: numpy array of the position of every updated row
+        """
+        merged = object.__new__(_Snapshot)
+        merged.watermark = watermark
+        merged.size = self.size + len(appended_rows)
+
+        def merge_values(name):
+            return [row[name] for row in updated_rows], [row[name] for row in appended_rows]
+
+        merged.strings = dict((name, column.merge(positions, *merge_values(name)))
+                              for name, column in self.strings.items())
+        merged.floats = dict((name, _merge_array(array, positions, *merge_values(name), dtype=numpy.float64))
+                             for name, array in self.floats.items())
+        merged.dates = dict((name, _merge_array(array, positions, *merge_values(name), dtype='datetime64[s]'))
+                            for name, array in self.dates.items())
+        merged.matches = {}
+        return merged
+
+    def like(self, name, value):
+        key = (name, value)
+        mask = self.matches.get(key)
+        if mask is None:
+            if name in self.strings:
+                mask = self.strings[name].like(value)
+            else:
+                # dates are matched against mysql's formatting of them
+                formatted = numpy.char.replace(numpy.datetime_as_string(self.dates[name], unit='s'), 'T', ' ')
+                mask = numpy.char.find(formatted, str(value)) >= 0
+            if len(self.matches) >= MAX_CACHED_MATCHES:
+                self.matches.clear()
+            self.matches[key] = mask
+        return mask
+
+class SnapshotGeneration(object):
+    """
+    Cache generation of searches served by an AllListingsColumnar: the watermark of the snapshot they read,
+    so results are never cached as newer than the data they were computed from
+    """
+
+    def __init__(self, all_listings_columnar):
+        self.all_listings_columnar = all_listings_columnar
+
+    def current(self):
+        return str(self.all_listings_columnar.snapshot_watermark())
+
+class AllListingsColumnar(object):
+
+    def __init__(self, all_listings_mysql=None, refresh_seconds=COLUMNAR_REFRESH_SECONDS):
+        if numpy is None:
+            raise ImportError("numpy is required for the columnar serving mode")
+        self.all_listings_mysql = all_listings_mysql if all_listings_mysql else AllListingsMySql()
+        self.refresh_seconds = refresh_seconds
+        self._snapshot = None
+        self._changes = ChangeWatermark()
+        # listing id -> row position, rows keep their position in every later snapshot
+        self._positions = {}
+        self._refresh_lock = threading.Lock()
+        self._refresh_thread = None
+
+    def load(self):
+        """Load every row of all_listings"""
+        with self._refresh_lock:
+            columns = dict((name, []) for name in STRING_COLUMNS + FLOAT_COLUMNS + DATE_COLUMNS)
+            changes = ChangeWatermark()
+            for row in self.all_listings_mysql.iter_changed_listings():
+                for name, values in columns.items():
+                    values.append(row[name])
+                changes.advance(row)
+            self._changes = changes
+            self._positions = dict((listing_id, position) for position, listing_id in enumerate(columns['id']))
+            self._swap(_Snapshot(columns, changes.value))
+        LOGGER.info("Loaded %s listings into the columnar store", self._snapshot.size)
+
+    def refresh(self):
+        """Merge in rows changed since the last load or refresh"""
+        with self._refresh_lock:
+            rows = self.all_listings_mysql.iter_changed_listings(since=self._changes.value)
+            updated_rows = [row for row in rows if not self._changes.is_merged(row)]
+            if not updated_rows:
+                return 0
+            positions = []
+            changed_rows = []
+            appended_rows = []
+            for row in updated_rows:
+                position = self._positions.get(row['id'])
+                if position is None:
+                    appended_rows.append(row)
+                else:
+                    positions.append(position)
+                    changed_rows.append(row)
+            # rows come at or after the watermark, so the newest of them is the next one
+            snapshot = self._snapshot.merge(numpy.array(positions, dtype=numpy.intp), changed_rows, appended_rows,
+                                            max(row['date_changed'] for row in updated_rows))
+            for offset, row in enumerate(appended_rows):
+                self._positions[row['id']] = self._snapshot.size + offset
+            for row in updated_rows:
+                self._changes.advance(row)
+            self._swap(snapshot)
+        LOGGER.info("Merged %s updated listings into the columnar store", len(updated_rows))
+        return len(updated_rows)
+
+    def _swap(self, snapshot):
+        # a single reference assignment, requests hold on to whichever snapshot they started with
+        self._snapshot = snapshot
+
+    def snapshot_watermark(self):
+        """Latest date_changed of the snapshot requests read now"""
+        return self._snapshot.watermark if self._snapshot is not None else None
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_seconds)
+            try:
+                self.refresh()
+            except Exception as e:
+                LOGGER.exception("Failed to refresh the columnar store: %s", e)
+
+    def start(self):
+        """Load the table and keep it refreshed from a daemon thread"""
+        self.load()
+        self._refresh_thread = threading.Thread(target=self._refresh_loop, name="columnar-refresh")
+        self._refresh_thread.daemon = True
+        self._refresh_thread.start()
+
+    def _sort_key(self, snapshot, sortby, indices, distances):
+        if sortby in snapshot.strings:
+            return snapshot.strings[sortby].codes[indices]
+        if sortby in snapshot.floats:
+            return snapshot.floats[sortby][indices]
+        if sortby in snapshot.dates:
+            return snapshot.dates[sortby][indices]
+        if sortby == "distance" and distances is not None:
+            return distances[indices]
+        raise InvalidSearchParameterException("Cannot sort by %s" % sortby)
+
+    def search_listings(self, search_parameter_object, limit=20, offset=0, sortby="date_updated", desc=True,
+                        bbox=None, near=None, radius=None, count=None):
+        """Same contract and results as AllListingsMySql.search_listings, count is always computed since it is free here"""
+        snapshot = self._snapshot
+        mask = numpy.ones(snapshot.size, dtype=bool)
+        for name, value in search_parameter_object._asdict().items():
+            if value is not None:
+                mask &= snapshot.like(name, value)
+        lat = snapshot.floats['lat']
+        lng = snapshot.floats['lng']
+        if bbox is not None:
+            mask &= (lat >= bbox.south) & (lat <= bbox.north) & (lng >= bbox.west) & (lng <= bbox.east)
+        distances = None
+        if near is not None:
+            if radius is None:
+                raise InvalidSearchParameterException("radius is required when searching near a point")
+            lat_radians = numpy.radians(lat)
+            near_lat_radians = numpy.radians(near.lat)
+            a = (numpy.sin((lat_radians - near_lat_radians) / 2) ** 2 +
+                 numpy.cos(lat_radians) * numpy.cos(near_lat_radians) *
+                 numpy.sin(numpy.radians(lng - near.lng) / 2) ** 2)
+            distances = 2 * EARTH_RADIUS_MILES * numpy.arcsin(numpy.sqrt(a))
+            mask &= distances <= radius
+        indices = numpy.flatnonzero(mask)
+        count = len(indices)
+        # stable sort so ties keep table order page to page
+        order = numpy.argsort(self._sort_key(snapshot, sortby, indices, distances), kind='mergesort')
+        if desc:
+            order = order[::-1]
+        offset = int(offset)
+        page = indices[order[offset:offset + int(limit)]]
+        listings = [dict() for _ in page]
+        for name, column in snapshot.strings.items():
+            for listing, value in zip(listings, column.decode(page)):
+                listing[name] = value
+        for name, values in snapshot.floats.items():
+            for listing, value in zip(listings, values[page]):
+                listing[name] = float(value)
+        for name, values in snapshot.dates.items():
+            for listing, value in zip(listings, values[page].astype(object)):
+                listing[name] = value
+        return {"listings": listings, "count": count}
+
+def _parse_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+
+    command_subparser = parser.add_subparsers(dest='sub_command')
+    command_subparser.required = True
+
+    search_parser = command_subparser.add_parser('search')
+    search_parser.add_argument('--city')
+
+    return parser.parse_args()
+
+def _main():
+    options = _parse_args()
+
+    all_listings_columnar = AllListingsColumnar()
+    all_listings_columnar.load()
+
+    if options.sub_command == 'search':
+        search_parameters = dict((name, None) for name in SEARCH_PARAMETERS)
+        search_parameters['city'] = options.city
+        start = time.time()
+        results = all_listings_columnar.search_listings(SearchParameterObject(**search_parameters))
+        LOGGER.info("%s matches in %.3f ms", results["count"], (time.time() - start) * 1000)
+        LOGGER.info(results["listings"])
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format=DEFAULT_LOG_FORMAT_STRING, datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO)
+    _main()
@@ -0,0 +1,260 @@
+"""
+:author: Henley Kuang
+:since: 06/17/2019
+
+Find listings of the same apartment collected from different sources and point them at one canonical id.
+
+Listings are blocked by geohash cell, and only listings from different sources in the same or a
+neighboring cell are compared, so the work grows with the number of listings rather than its square.
+Candidates are scored on their normalized address, distance, baths and price, beds and unit numbers
+have to agree. Matches are grouped transitively and every group's canonical_id is its first collected
+listing, listings without a duplicate keep a NULL canonical_id.
+"""
+
+import argparse
+import logging
+import re
+
+from collections import defaultdict, namedtuple
+
+from rent_price_collection.storage.all_listings_mysql import (
+    AllListingsMySql,
+)
+from rent_price_collection.storage.streaming import (
+    stream_query,
+)
+from rent_price_collection.utils.config import (
+    DEFAULT_LOG_FORMAT_STRING,
+)
+from rent_price_collection.utils.geo import (
+    geohash,
+    geohash_neighbors,
+    haversine_miles,
+    METERS_PER_MILE,
+)
+from rent_price_collection.utils.parsers import (
+    parse_beds,
+    parse_price,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+# cells of about 150m, duplicates are further apart than MAX_DISTANCE_METERS only when a source geocoded badly
+GEOHASH_PRECISION = 7
+MAX_DISTANCE_METERS = 150.0
+MATCH_THRESHOLD = 0.75
+SCORE_WEIGHTS = {
+    'address': 0.45,
+    'distance': 0.3,
+    'price': 0.15,
+    'baths': 0.1,
+}
+# relative price difference past which the price no longer counts towards a match
+MAX_PRICE_DIFFERENCE = 0.15
+
+STREET_SUFFIXES = {
+    'avenue': 'ave', 'av': 'ave', 'boulevard': 'blvd', 'circle': 'cir', 'court': 'ct', 'drive': 'dr',
+    'highway': 'hwy', 'lane': 'ln', 'parkway': 'pkwy', 'place': 'pl', 'road': 'rd', 'square': 'sq',
+    'street': 'st', 'terrace': 'ter', 'trail': 'trl',
+}
+DIRECTIONS = {
+    'north': 'n', 'south': 's', 'east': 'e', 'west': 'w',
+    'northeast': 'ne', 'northwest': 'nw', 'southeast': 'se', 'southwest': 'sw',
+}
+UNIT_REGEX = re.compile(r'(?:#|\b(?:apt|apartment|unit|ste|suite)\b\.?)\s*([a-z0-9-]+)\s*$')
+NON_WORD_REGEX = re.compile(r'[^a-z0-9# ]+')
+BATHS_REGEX = re.compile(r'([0-9]+(?:\.[0-9]+)?)')
+
+NormalizedAddress = namedtuple('NormalizedAddress', ['number', 'street', 'unit'])
+DedupListing = namedtuple('DedupListing', ['id', 'source', 'address', 'zip_code', 'beds', 'baths',
+                                           'lat', 'lng', 'price', 'date_collected', 'canonical_id'])
+
+def normalize_address(street_address):
+    """
+    Split a street address into house number, street tokens and unit, with case, punctuation,
+    street suffixes and directions normalized
+
+    >>> normalize_address('821 North Salem Avenue, Apt. 3B')
+    NormalizedAddress(number='821', street=('n', 'salem', 'ave'), unit='3b')
+    >>> normalize_address('821 N Salem Ave #3b')
+    NormalizedAddress(number='821', street=('n', 'salem', 'ave'), unit='3b')
+    """
+    address = street_address.lower().replace(",", " ")
+    unit = None
+    match = UNIT_REGEX.search(address)
+    if match is not None:
+        unit = match.group(1)
+        address = address[:match.start()]
+    tokens = NON_WORD_REGEX.sub(" ", address).split()
+    number = None
+    if tokens and tokens[0][0].isdigit():
+        number = tokens.pop(0)
+    street = tuple(DIRECTIONS.get(token, STREET_SUFFIXES.get(token, token)) for token in tokens)
+    return NormalizedAddress(number=number, street=street, unit=unit)
+
+def _parse_baths(baths):
+    if baths is None:
+        return None
+    match = BATHS_REGEX.search(str(baths))
+    if match is None or str(baths).strip().startswith("-"):
+        return None
+    return float(match.group(1))
+
+def _to_dedup_listing(row):
+    return DedupListing(
+        id=row['id'],
+        source=row['source'],
+        address=normalize_address(row['street_address']),
+        zip_code=row['zip_code'] if str(row['zip_code']) != '-1' else None,
+        beds=parse_beds(row['beds']),
+        baths=_parse_baths(row['baths']),
+        lat=float(row['lat']),
+        lng=float(row['lng']),
+        price=parse_price(row['price']),
+        date_collected=row['date_collected'],
+        canonical_id=row['canonical_id'],
+    )
+
+def match_score(listing, other):
+    """Likelihood in [0, 1] that two listings are the same apartment, 0 when a hard criterion disagrees"""
+    if listing.zip_code is not None and other.zip_code is not None and listing.zip_code != other.zip_code:
+        return 0.0
+    if listing.beds != other.beds:
+        return 0.0
+    if listing.address.unit is not None and other.address.unit is not None and listing.address.unit != other.address.unit:
+        return 0.0
+    if listing.address.number is not None and other.address.number is not None \
+            and listing.address.number != other.address.number:
+        return 0.0
+    distance_meters = haversine_miles(listing.lat, listing.lng, other.lat, other.lng) * METERS_PER_MILE
+    if distance_meters > MAX_DISTANCE_METERS:
+        return 0.0
+
+    street = set(listing.address.street)
+    other_street = set(other.address.street)
+    address_score = len(street & other_street) / float(len(street | other_street)) if street | other_street else 0.0
+    distance_score = 1.0 - distance_meters / MAX_DISTANCE_METERS
+    price_score = 0.5
+    if listing.price is not None and other.price is not None:
+        difference = abs(listing.price - other.price) / float(max(listing.price, other.price))
+        price_score = max(0.0, 1.0 - difference / MAX_PRICE_DIFFERENCE)
+    baths_score = 0.5
+    if listing.baths is not None and other.baths is not None:
+        baths_score = 1.0 if listing.baths == other.baths else 0.0
+    return (SCORE_WEIGHTS['address'] * address_score + SCORE_WEIGHTS['distance'] * distance_score +
+            SCORE_WEIGHTS['price'] * price_score + SCORE_WEIGHTS['baths'] * baths_score)
+
+class _DisjointSet(object):
+
+    def __init__(self):
+        self.parents = {}
+
+    def find(self, item):
+        root = item
+        while self.parents.get(root, root) != root:
+            root = self.parents[root]
+        # path compression
+        while item != root:
+            self.parents[item], item = root, self.parents.get(item, item)
+        return root
+
+    def union(self, item, other):
+        self.parents.setdefault(item, item)
+        self.parents.setdefault(other, other)
+        root = self.find(item)
+        other_root = self.find(other)
+        if root != other_root:
+            self.parents[other_root] = root
+
+    def groups(self):
+        groups = defaultdict(list)
+        for item in self.parents:
+            groups[self.find(item)].append(item)
+        return groups.values()
+
+def find_duplicates(listings, threshold=MATCH_THRESHOLD):
+    """
+    Group duplicate listings
+
+    :param listings: list of DedupListing
+    :returns: list of lists of DedupListing, only groups of two or more
+    """
+    cells = defaultdict(list)
+    for position, listing in enumerate(listings):
+        cells[geohash(listing.lat, listing.lng, GEOHASH_PRECISION)].append(position)
+
+    disjoint_set = _DisjointSet()
+    comparisons = 0
+    for cell, positions in cells.items():
+        first = listings[positions[0]]
+        neighbor_cells = [neighbor for neighbor in geohash_neighbors(first.lat, first.lng, GEOHASH_PRECISION)
+                          if neighbor >= cell and neighbor in cells]
+        for neighbor in neighbor_cells:
+            neighbor_positions = cells[neighbor]
+            for position in positions:
+                listing = listings[position]
+                for other_position in neighbor_positions:
+                    # each pair once, and only across sources
+                    if neighbor == cell and other_position <= position:
+                        continue
+                    other = listings[other_position]
+                    if other.source == listing.source:
+                        continue
+                    comparisons += 1
+                    if match_score(listing, other) >= threshold:
+                        disjoint_set.union(position, other_position)
+    LOGGER.info("Compared %s candidate pairs across %s cells", comparisons, len(cells))
+    return [[listings[position] for position in group] for group in disjoint_set.groups() if len(group) > 1]
+
+def canonical_ids(duplicate_groups):
+    """Map every listing in a group to the id of the group's first collected listing"""
+    canonical_id_by_id = {}
+    for group in duplicate_groups:
+        canonical = min(group, key=lambda listing: (listing.date_collected, listing.id))
+        for listing in group:
+            canonical_id_by_id[listing.id] = canonical.id
+    return canonical_id_by_id
+
+class AllListingsDedup(object):
+
+    QUERY_SELECT = '''select id, source, street_address, zip_code, beds, baths, lat, lng, price, date_collected,
+canonical_id from all_listings'''
+
+    def __init__(self, all_listings_mysql=None):
+        self.all_listings_mysql = all_listings_mysql if all_listings_mysql else AllListingsMySql()
+
+    def dedup(self):
+        """Recompute every canonical_id, only rows whose canonical_id changed are written. Returns that count."""
+        listings = []
+        for row in stream_query(self.all_listings_mysql.db_selector, self.QUERY_SELECT):
+            # -1 is stored when the api had no coordinates
+            if row['lat'] == -1 and row['lng'] == -1:
+                continue
+            listings.append(_to_dedup_listing(row))
+        LOGGER.info("Deduplicating %s listings", len(listings))
+        canonical_id_by_id = canonical_ids(find_duplicates(listings))
+        changes = []
+        for listing in listings:
+            canonical_id = canonical_id_by_id.get(listing.id)
+            if canonical_id != listing.canonical_id:
+                changes.append((canonical_id, listing.id))
+        LOGGER.info("%s listings are duplicates, %s canonical ids changed", len(canonical_id_by_id), len(changes))
+        self.all_listings_mysql.update_canonical_ids(changes)
+        return len(changes)
+
+def _parse_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+
+    return parser.parse_args()
+
+def _main():
+    _parse_args()
+
+    all_listings_dedup = AllListingsDedup()
+    count = all_listings_dedup.dedup()
+    LOGGER.info("Dedup complete. Total updated: %s", count)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format=DEFAULT_LOG_FORMAT_STRING, datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO)
+    _main()
@@ -13,12 +13,46 @@ CREATE TABLE `all_listings` (
     `zip_code` varchar(10) NOT NULL,
     `beds` varchar(255) NOT NULL,
     `baths` varchar(255) NOT NULL,
+    `lat` double(10,7) NOT NULL,
+    `lng` double(10,7) NOT NULL,
+    `coordinates` point NOT NULL,
     `sqft` varchar(255) NOT NULL,
     `price` varchar(255) NOT NULL,
     `date_collected` datetime DEFAULT CURRENT_TIMESTAMP,
     `date_updated` datetime DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-    PRIMARY KEY (`id`)
+    `date_changed` datetime DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    `canonical_id` varchar(255) DEFAULT NULL,
+    PRIMARY KEY (`id`),
+    SPATIAL KEY `coordinates` (`coordinates`),
+    KEY `date_updated` (`date_updated`),
+    KEY `date_changed` (`date_changed`),
+    KEY `canonical_id` (`canonical_id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1 ROW_FORMAT=COMPRESSED;
+
+canonical_id is set by all_listings_dedup.py on listings that are duplicates of another source's listing,
+it is the id of the first collected listing of the apartment. NULL means the listing has no duplicate.
+
+date_updated is copied from the source table, when the listing was last crawled. date_changed is never
+assigned so mysql moves it whenever any column of the row changes, including a reprocessed row whose
+date_updated is kept. The in memory copies of the api follow date_changed, see iter_changed_listings.
+
+Migrating an existing table (lat/lng/coordinates are filled in by the next union):
+ALTER TABLE `all_listings`
+    ADD COLUMN `lat` double(10,7) NOT NULL DEFAULT 0 AFTER `baths`,
+    ADD COLUMN `lng` double(10,7) NOT NULL DEFAULT 0 AFTER `lat`,
+    ADD COLUMN `coordinates` point NULL AFTER `lng`;
+UPDATE `all_listings` SET `coordinates` = POINT(`lng`, `lat`);
+ALTER TABLE `all_listings`
+    MODIFY COLUMN `coordinates` point NOT NULL,
+    ADD SPATIAL KEY `coordinates` (`coordinates`);
+ALTER TABLE `all_listings`
+    ADD COLUMN `canonical_id` varchar(255) DEFAULT NULL,
+    ADD KEY `canonical_id` (`canonical_id`);
+ALTER TABLE `all_listings`
+    ADD COLUMN `date_changed` datetime DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP AFTER `date_updated`,
+    ADD KEY `date_changed` (`date_changed`);
+ALTER TABLE `all_listings`
+    ADD KEY `date_updated` (`date_updated`);
 """
 
 import argparse
@@ -27,6 +61,15 @@ import MySQLdb
 
 from collections import namedtuple
 
+from rent_price_collection.storage.listing_stats_mysql import (
+    ListingStatsMySql,
+)
+from rent_price_collection.storage.streaming import (
+    stream_query,
+)
+from rent_price_collection.utils.cache import (
+    bump_cache_generation,
+)
 from rent_price_collection.utils.config import (
     DEFAULT_LOG_FORMAT_STRING,
     MYSQL_HOST,
@@ -34,11 +77,17 @@ from rent_price_collection.utils.config import (
     MYSQL_PASS,
     MYSQL_DB,
     MYSQL_PORT,
+    MYSQL_STREAM_FETCH_SIZE,
 )
 
 from rent_price_collection.utils.exceptions import (
+    InvalidSearchParameterException,
     MergeQueryAllListingsException,
 )
+from rent_price_collection.utils.geo import (
+    METERS_PER_MILE,
+    bbox_around,
+)
 
 LOGGER = logging.getLogger(__name__)
 
@@ -47,12 +96,39 @@ SEARCH_PARAMETERS = ['source', 'url', 'street_address', 'city', 'state', 'zip_co
                     'date_collected', 'date_updated']
 SearchParameterObject = namedtuple('SearchParameterObject', SEARCH_PARAMETERS)
 
+class ChangeWatermark(object):
+    """
+    Latest date_changed merged into an in memory copy of all_listings, and the ids merged at exactly it,
+    which the next iter_changed_listings(since=value) sends again
+    """
+
+    def __init__(self):
+        self.value = None
+        self.ids = set()
+
+    def is_merged(self, row):
+        return row['date_changed'] == self.value and row['id'] in self.ids
+
+    def advance(self, row):
+        if self.value is None or row['date_changed'] > self.value:
+            self.value = row['date_changed']
+            self.ids = set([row['id']])
+        elif row['date_changed'] == self.value:
+            self.ids.add(row['id'])
+
 class AllListingsMySql():
 
     DB_TABLE_NAME = 'all_listings'
-    QUERY_SELECT = '''select * from {table_name}'''.format(table_name=DB_TABLE_NAME)
+    # coordinates is a binary geometry only used for indexing, lat/lng carry the same data
+    SELECT_COLUMNS = ['id', 'source', 'url', 'street_address', 'city', 'state', 'zip_code',
+                      'beds', 'baths', 'lat', 'lng', 'sqft', 'price',
+                      'date_collected', 'date_updated']
+    QUERY_SELECT = '''select {columns} from {table_name}'''.format(columns=", ".join(SELECT_COLUMNS),
+                                                                   table_name=DB_TABLE_NAME)
     QUERY_COUNT = '''select count(1) from {table_name}'''.format(table_name=DB_TABLE_NAME)
     QUERY_UNION = '''insert into {table_name}
+(id, source, url, street_address, city, state, zip_code, beds, baths, lat, lng, coordinates, sqft, price,
+date_collected, date_updated)
 select * from (
 SELECT
 CONCAT("zillow-", zillow.listing_id) as `id`,
@@ -64,6 +140,9 @@ CONCAT("zillow-", zillow.listing_id) as `id`,
 `zip_code`,
 `beds`,
 `baths`,
+`lat`,
+`lng`,
+POINT(`lng`, `lat`) as `coordinates`,
 `sqft`,
 `price`,
 `date_collected`,
@@ -80,65 +159,160 @@ CONCAT("https://www.trulia.com", trulia.card_url) as `url`,
 `zip_code`,
 `beds`,
 `baths`,
+`lat`,
+`lng`,
+POINT(`lng`, `lat`) as `coordinates`,
 `sqft`,
 `price`,
 `date_collected`,
 `date_updated`
 FROM trulia_listings as trulia
-) all_l ON DUPLICATE KEY UPDATE date_updated=all_l.date_updated;'''.format(table_name=DB_TABLE_NAME)
+) all_l ON DUPLICATE KEY UPDATE
+url=all_l.url,
+street_address=all_l.street_address,
+city=all_l.city,
+state=all_l.state,
+zip_code=all_l.zip_code,
+beds=all_l.beds,
+baths=all_l.baths,
+lat=all_l.lat,
+lng=all_l.lng,
+coordinates=all_l.coordinates,
+sqft=all_l.sqft,
+price=all_l.price,
+date_updated=all_l.date_updated;'''.format(table_name=DB_TABLE_NAME)
+    QUERY_SELECT_CHANGED = '''select {columns}, date_changed from {table_name}'''.format(
+        columns=", ".join(SELECT_COLUMNS), table_name=DB_TABLE_NAME)
+    QUERY_UPDATE_CANONICAL_ID = '''update {table_name} set canonical_id = %s where id = %s'''.format(
+        table_name=DB_TABLE_NAME)
+    UPDATE_BATCH_SIZE = 1000
 
     def __init__(self):
-        db_selector = {'host': MYSQL_HOST,
-                       'user': MYSQL_USER,
-                       'passwd': MYSQL_PASS,
-                       'db': MYSQL_DB,
-                       'port': MYSQL_PORT,
-                       'use_unicode': False,
-                       'charset': 'latin1',
-                      }
-        self.db_handle = MySQLdb.connect(**db_selector)
+        self.db_selector = {'host': MYSQL_HOST,
+                            'user': MYSQL_USER,
+                            'passwd': MYSQL_PASS,
+                            'db': MYSQL_DB,
+                            'port': MYSQL_PORT,
+                            'use_unicode': False,
+                            'charset': 'latin1',
+                           }
+        self.db_handle = MySQLdb.connect(**self.db_selector)
 
     def union_listings(self):
+        """
+        Merge the zillow and trulia listings into all_listings, link duplicates across sources, then
+        snapshot the listing stats of the crawled days, see ListingStatsMySql.rollup_crawl
+        """
         cursor = None
         result = None
         try:
             cursor = self.db_handle.cursor(MySQLdb.cursors.DictCursor)
             result = cursor.execute(self.QUERY_UNION)
             cursor.connection.commit()
+            bump_cache_generation()
         except Exception as e:
             LOGGER.exception(e)
             raise MergeQueryAllListingsException(e)
         finally:
             if cursor is not None:
                 cursor.close()
+        LOGGER.info("Union complete. Total merged: %s", result)
+        # all_listings_dedup imports this module
+        from rent_price_collection.storage.all_listings_dedup import AllListingsDedup
+        dedup_count = AllListingsDedup(self).dedup()
+        LOGGER.info("Dedup complete. Total updated: %s", dedup_count)
+        listing_stats_mysql = ListingStatsMySql()
+        try:
+            stats_count = listing_stats_mysql.rollup_crawl()
+        finally:
+            listing_stats_mysql.close()
+        LOGGER.info("Listing stats rollup complete. Total rows: %s", stats_count)
         return result
 
-    def search_listings(self, search_parameter_object, limit=20, offset=0, sortby="date_updated", desc=True):
+    def update_canonical_ids(self, canonical_ids):
+        """
+        :param canonical_ids: (canonical_id, id) pairs, canonical_id None to clear it
+        :type canonical_ids: list
+        """
+        cursor = None
+        try:
+            cursor = self.db_handle.cursor(MySQLdb.cursors.DictCursor)
+            for start in range(0, len(canonical_ids), self.UPDATE_BATCH_SIZE):
+                cursor.executemany(self.QUERY_UPDATE_CANONICAL_ID, canonical_ids[start:start + self.UPDATE_BATCH_SIZE])
+            cursor.connection.commit()
+            if canonical_ids:
+                bump_cache_generation()
+        except Exception as e:
+            LOGGER.exception(e)
+            raise MergeQueryAllListingsException(e)
+        finally:
+            if cursor is not None:
+                cursor.close()
+
+    def _get_where_clauses(self, search_parameter_object, bbox=None, near=None, radius=None):
+        """
+        :param bbox: only match listings inside this box
+        :type bbox: rent_price_collection.utils.geo.BoundingBox
+        :param near: only match listings within radius miles of this point
+        :type near: rent_price_collection.utils.geo.GeoPoint
+        :param radius: radius in miles, required with near
+        :type radius: float
+        """
+        where_clauses = []
+        for name, value in search_parameter_object._asdict().iteritems():
+            if value is not None:
+                where_clauses.append('{name} like \"%{value}%\"'.format(name=name, value=value))
+        if bbox is not None:
+            where_clauses.append(self._mbr_contains_clause(bbox))
+        if near is not None:
+            if radius is None:
+                raise InvalidSearchParameterException("radius is required when searching near a point")
+            # the bounding box lets MySQL use the spatial index, the distance check drops the corners
+            where_clauses.append(self._mbr_contains_clause(bbox_around(near, radius)))
+            where_clauses.append("ST_Distance_Sphere(coordinates, POINT({lng:.7f}, {lat:.7f})) <= {meters:.1f}".format(
+                lng=near.lng, lat=near.lat, meters=radius * METERS_PER_MILE))
+        return where_clauses
+
+    def _mbr_contains_clause(self, bbox):
+        polygon = "POLYGON(({w:.7f} {s:.7f}, {e:.7f} {s:.7f}, {e:.7f} {n:.7f}, {w:.7f} {n:.7f}, {w:.7f} {s:.7f}))".format(
+            w=bbox.west, s=bbox.south, e=bbox.east, n=bbox.north)
+        return "MBRContains(ST_GeomFromText('%s'), coordinates)" % polygon
+
+    def search_listings(self, search_parameter_object, limit=20, offset=0, sortby="date_updated", desc=True,
+                        bbox=None, near=None, radius=None, count=None):
+        """
+        :param count: total matches when already known, e.g. from another page of the same search, skips the count query
+        :type count: int
+        """
         cursor = None
         results = None
-        count = None
+        query_select = None
         try:
             cursor = self.db_handle.cursor(MySQLdb.cursors.DictCursor)
             query_select = self.QUERY_SELECT
             query_count = self.QUERY_COUNT
-            where_clauses = []
-            for name, value in search_parameter_object._asdict().iteritems():
-                if value is not None:
-                    where_clauses.append('{name} like \"%{value}%\"'.format(name=name, value=value))
+            where_clauses = self._get_where_clauses(search_parameter_object, bbox=bbox, near=near, radius=radius)
             if len(where_clauses) > 0:
                 where_clause_str = " where %s" % " and ".join(where_clauses)
                 query_select += where_clause_str
                 query_count += where_clause_str
-            query_select += " order by %s" % sortby
+            if sortby == "distance" and near is not None:
+                query_select += " order by ST_Distance_Sphere(coordinates, POINT({lng:.7f}, {lat:.7f}))".format(
+                    lng=near.lng, lat=near.lat)
+            else:
+                query_select += " order by %s" % sortby
             if desc:
                 query_select += " desc"
             query_select += " limit %s" % limit
             query_select += " offset %s" % offset
             cursor.execute(query_select)
             results = cursor.fetchall()
-            cursor.execute(query_count)
-            count = cursor.fetchone()["count(1)"]
+            if count is None:
+                cursor.execute(query_count)
+                count = cursor.fetchone()["count(1)"]
             cursor.connection.commit()
+        except InvalidSearchParameterException:
+            raise
         except Exception as e:
             LOGGER.exception("Query: %s | Exception: %s", query_select, e)
             raise Exception(e)
@@ -147,6 +321,111 @@ FROM trulia_listings as trulia
                 cursor.close()
         return {"listings": results, "count": count}
 
+    def iter_search_listings(self, search_parameter_object, since=None, limit=None,
+                             bbox=None, near=None, radius=None, fetch_size=MYSQL_STREAM_FETCH_SIZE):
+        """
+        Stream every listing matching the search, oldest date_updated first, off a server side cursor.
+        Pass the last date_updated seen as since to resume, rows updated at exactly since are sent again.
+
+        :param since: only listings updated at or after this time
+        :type since: datetime.datetime
+        """
+        where_clauses = self._get_where_clauses(search_parameter_object, bbox=bbox, near=near, radius=radius)
+        if since is not None:
+            where_clauses.append("date_updated >= '%s'" % since.strftime("%Y-%m-%d %H:%M:%S"))
+        query_select = self.QUERY_SELECT
+        if len(where_clauses) > 0:
+            query_select += " where %s" % " and ".join(where_clauses)
+        query_select += " order by date_updated, id"
+        if limit:
+            query_select += " limit %s" % int(limit)
+        return stream_query(self.db_selector, query_select, fetch_size=fetch_size)
+
+    def iter_changed_listings(self, since=None, fetch_size=MYSQL_STREAM_FETCH_SIZE):
+        """
+        Stream every listing with its date_changed, oldest change first, off a server side cursor.
+        Pass the last date_changed seen as since to resume, rows changed at exactly since are sent again,
+        see ChangeWatermark.
+
+        :param since: only listings changed at or after this time
+        :type since: datetime.datetime
+        """
+        query_select = self.QUERY_SELECT_CHANGED
+        if since is not None:
+            query_select += " where date_changed >= '%s'" % since.strftime("%Y-%m-%d %H:%M:%S")
+        query_select += " order by date_changed, id"
+        return stream_query(self.db_selector, query_select, fetch_size=fetch_size)
+
+    def count_listings_by(self, columns, collected_after=None, collected_until=None):
+        """
+        Listing counts per distinct combination of columns, optionally only of listings collected in a window.
+
+        :param columns: column names from SELECT_COLUMNS
+        :type columns: list
+        :param collected_after: only count listings with a later date_collected
+        :type collected_after: datetime.datetime
+        :param collected_until: only count listings collected at or before this time, e.g. a watermark read
+            before counting, so rows collected meanwhile are left to the next count instead of counted twice
+        :type collected_until: datetime.datetime
+        """
+        cursor = None
+        results = None
+        for column in columns:
+            if column not in self.SELECT_COLUMNS:
+                raise InvalidSearchParameterException("Unknown column: %s" % column)
+        column_str = ", ".join(columns)
+        query_select = "select {columns}, count(1) as listing_count from {table_name}".format(
+            columns=column_str, table_name=self.DB_TABLE_NAME)
+        where_clauses = []
+        args = {}
+        if collected_after is not None:
+            where_clauses.append("date_collected > %(collected_after)s")
+            args["collected_after"] = collected_after
+        if collected_until is not None:
+            where_clauses.append("date_collected <= %(collected_until)s")
+            args["collected_until"] = collected_until
+        if where_clauses:
+            query_select += " where %s" % " and ".join(where_clauses)
+        query_select += " group by %s" % column_str
+        try:
+            cursor = self.db_handle.cursor(MySQLdb.cursors.DictCursor)
+            cursor.execute(query_select, args)
+            results = cursor.fetchall()
+            cursor.connection.commit()
+        except Exception as e:
+            LOGGER.exception("Query: %s | Exception: %s", query_select, e)
+            raise Exception(e)
+        finally:
+            if cursor is not None:
+                cursor.close()
+        return results
+
+    def select_last_date_collected(self):
+        cursor = None
+        try:
+            cursor = self.db_handle.cursor(MySQLdb.cursors.DictCursor)
+            cursor.execute("select max(date_collected) as last_date_collected from %s" % self.DB_TABLE_NAME)
+            result = cursor.fetchone()["last_date_collected"]
+            # end the snapshot, REPEATABLE READ would keep returning this watermark
+            cursor.connection.commit()
+            return result
+        finally:
+            if cursor is not None:
+                cursor.close()
+
+    def select_last_date_changed(self):
+        cursor = None
+        try:
+            cursor = self.db_handle.cursor(MySQLdb.cursors.DictCursor)
+            cursor.execute("select max(date_changed) as last_date_changed from %s" % self.DB_TABLE_NAME)
+            result = cursor.fetchone()["last_date_changed"]
+            # end the snapshot, REPEATABLE READ would keep returning this watermark
+            cursor.connection.commit()
+            return result
+        finally:
+            if cursor is not None:
+                cursor.close()
+
     def select_all_listings(self, limit=None):
         cursor = None
         results = None
@@ -166,6 +445,16 @@ FROM trulia_listings as trulia
                 cursor.close()
         return results
 
+    def iter_all_listings(self, limit=None, fetch_size=MYSQL_STREAM_FETCH_SIZE):
+        """
+        Stream rows off an unbuffered server side cursor, fetch_size rows per round trip.
+        A dedicated connection is used since an unbuffered cursor ties up its connection until it is drained.
+        """
+        query_select = self.QUERY_SELECT
+        if limit:
+            query_select = "%s limit %s" % (query_select, limit)
+        return stream_query(self.db_selector, query_select, fetch_size=fetch_size)
+
     def close(self):
         self.db_handle.close()
 
@@ -187,8 +476,7 @@ def _main():
     all_listings_mysql = AllListingsMySql()
 
     if options.sub_command == 'union':
-        count = all_listings_mysql.union_listings()
-        LOGGER.info("Union complete. Total merged: %s", count)
+        all_listings_mysql.union_listings()
     elif options.sub_command == 'search':
         search_parameter_object = SearchParameterObject(
             source="zill",
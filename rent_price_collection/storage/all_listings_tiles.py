@@ -0,0 +1,215 @@
+"""
+:author: Henley Kuang
+:since: 06/15/2019
+
+Clustered map tiles over the lat/lng of every listing in all_listings.
+
+Points are kept in web mercator coordinates normalized to [0, 1) and bucketed by their tile at
+BUCKET_ZOOM, so a tile only visits the buckets it covers. Inside a tile, points are clustered on a
+TILE_CLUSTER_CELLS x TILE_CLUSTER_CELLS grid and every non empty cell becomes one cluster with its
+count, centroid and median price. Listings updated after a merge are moved between buckets in place,
+every change bumps the index version which invalidates cached tiles. Tiles are served with the
+date_changed watermark of the index, which is the same in every process that has merged the same
+listings.
+"""
+
+import argparse
+import logging
+import math
+import threading
+import time
+
+from collections import defaultdict
+
+from rent_price_collection.storage.all_listings_mysql import (
+    AllListingsMySql,
+    ChangeWatermark,
+)
+from rent_price_collection.utils.cache import (
+    CacheGeneration,
+    LRUCache,
+)
+from rent_price_collection.utils.config import (
+    DEFAULT_LOG_FORMAT_STRING,
+    TILES_CACHE_MAX_ENTRIES,
+    TILES_REFRESH_SECONDS,
+)
+from rent_price_collection.utils.parsers import (
+    parse_price,
+    percentile,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+BUCKET_ZOOM = 12
+MAX_ZOOM = 20
+TILE_CLUSTER_CELLS = 16
+# web mercator is undefined at the poles
+MAX_LATITUDE = 85.0511287798
+
+def mercator(lat, lng):
+    """Normalized web mercator coordinates of a point, both in [0, 1)"""
+    lat = max(min(lat, MAX_LATITUDE), -MAX_LATITUDE)
+    mx = (lng + 180.0) / 360.0
+    sin_lat = math.sin(math.radians(lat))
+    my = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return min(max(mx, 0.0), 1.0 - 1e-12), min(max(my, 0.0), 1.0 - 1e-12)
+
+def _has_location(row):
+    # -1 is stored when the api had no coordinates
+    return row['lat'] is not None and row['lng'] is not None and not (row['lat'] == -1 or row['lng'] == -1)
+
+class AllListingsTiles(object):
+
+    def __init__(self, all_listings_mysql=None, refresh_seconds=TILES_REFRESH_SECONDS):
+        self.all_listings_mysql = all_listings_mysql if all_listings_mysql else AllListingsMySql()
+        self.refresh_seconds = refresh_seconds
+        # listing id -> (mx, my, lat, lng, price, bucket)
+        self._points = {}
+        # bucket -> set of listing ids
+        self._buckets = defaultdict(set)
+        self._changes = ChangeWatermark()
+        self._cache_generation = CacheGeneration()
+        self._loaded_generation = None
+        self._tiles = LRUCache(TILES_CACHE_MAX_ENTRIES, 24 * 60 * 60)
+        self._lock = threading.Lock()
+        self._version = 0
+
+    def _put(self, row):
+        listing_id = row['id']
+        self._remove(listing_id)
+        if not _has_location(row):
+            return
+        lat = float(row['lat'])
+        lng = float(row['lng'])
+        mx, my = mercator(lat, lng)
+        scale = 1 << BUCKET_ZOOM
+        bucket = (int(mx * scale), int(my * scale))
+        self._points[listing_id] = (mx, my, lat, lng, parse_price(row['price']), bucket)
+        self._buckets[bucket].add(listing_id)
+
+    def _remove(self, listing_id):
+        point = self._points.pop(listing_id, None)
+        if point is not None:
+            bucket_ids = self._buckets[point[5]]
+            bucket_ids.discard(listing_id)
+            if not bucket_ids:
+                del self._buckets[point[5]]
+
+    def load(self):
+        """Load every listing with a location"""
+        generation = self._cache_generation.current()
+        with self._lock:
+            self._points = {}
+            self._buckets = defaultdict(set)
+            changes = ChangeWatermark()
+            for row in self.all_listings_mysql.iter_changed_listings():
+                self._put(row)
+                changes.advance(row)
+            self._changes = changes
+            self._loaded_generation = generation
+            self._version += 1
+        LOGGER.info("Loaded %s listing locations into %s tile buckets", len(self._points), len(self._buckets))
+
+    def refresh(self):
+        """Move listings changed since the last load or refresh, only when listings were written since"""
+        generation = self._cache_generation.current()
+        if generation == self._loaded_generation:
+            return 0
+        updated_rows = [row for row in self.all_listings_mysql.iter_changed_listings(since=self._changes.value)
+                        if not self._changes.is_merged(row)]
+        with self._lock:
+            for row in updated_rows:
+                self._put(row)
+                self._changes.advance(row)
+            self._loaded_generation = generation
+            if updated_rows:
+                self._version += 1
+        LOGGER.info("Merged %s updated listings into the tile index", len(updated_rows))
+        return len(updated_rows)
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_seconds)
+            try:
+                self.refresh()
+            except Exception as e:
+                LOGGER.exception("Failed to refresh the tile index: %s", e)
+
+    def start(self):
+        """Load every listing and keep the index refreshed from a daemon thread"""
+        self.load()
+        refresh_thread = threading.Thread(target=self._refresh_loop, name="tiles-refresh")
+        refresh_thread.daemon = True
+        refresh_thread.start()
+
+    def _tile_point_ids(self, z, x, y):
+        if z >= BUCKET_ZOOM:
+            # the tile lies inside a single bucket
+            shift = z - BUCKET_ZOOM
+            return self._buckets.get((x >> shift, y >> shift), ())
+        shift = BUCKET_ZOOM - z
+        covered_buckets = 1 << (2 * shift)
+        if covered_buckets <= len(self._buckets):
+            buckets = ((bx, by) for bx in range(x << shift, (x + 1) << shift)
+                       for by in range(y << shift, (y + 1) << shift))
+        else:
+            buckets = (bucket for bucket in self._buckets.keys()
+                       if bucket[0] >> shift == x and bucket[1] >> shift == y)
+        return [listing_id for bucket in buckets for listing_id in self._buckets.get(bucket, ())]
+
+    def _cluster(self, z, x, y):
+        scale = float(1 << z)
+        cells = defaultdict(list)
+        for listing_id in self._tile_point_ids(z, x, y):
+            point = self._points[listing_id]
+            tx = point[0] * scale - x
+            ty = point[1] * scale - y
+            if not (0 <= tx < 1 and 0 <= ty < 1):
+                continue
+            cells[(int(tx * TILE_CLUSTER_CELLS), int(ty * TILE_CLUSTER_CELLS))].append(point)
+        clusters = []
+        for points in cells.values():
+            prices = sorted(point[4] for point in points if point[4] is not None)
+            clusters.append({
+                "lat": sum(point[2] for point in points) / len(points),
+                "lng": sum(point[3] for point in points) / len(points),
+                "count": len(points),
+                "median_price": percentile(prices, 0.5),
+            })
+        return clusters
+
+    def get_tile(self, z, x, y):
+        """
+        Clusters of the z/x/y tile, see https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames
+
+        :returns: (date_changed watermark of the index, list of {"lat", "lng", "count", "median_price"})
+        """
+        with self._lock:
+            version = self._version
+            clusters = self._tiles.get((z, x, y), version)
+            if clusters is None:
+                clusters = self._cluster(z, x, y)
+                self._tiles.set((z, x, y), version, clusters)
+            watermark = self._changes.value
+        return watermark, clusters
+
+def _parse_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('z', type=int)
+    parser.add_argument('x', type=int)
+    parser.add_argument('y', type=int)
+
+    return parser.parse_args()
+
+def _main():
+    options = _parse_args()
+
+    all_listings_tiles = AllListingsTiles()
+    all_listings_tiles.load()
+    LOGGER.info(all_listings_tiles.get_tile(options.z, options.x, options.y))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format=DEFAULT_LOG_FORMAT_STRING, datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO)
+    _main()
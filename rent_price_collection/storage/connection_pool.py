@@ -0,0 +1,74 @@
+"""
+:author: Henley Kuang
+:since: 06/08/2019
+"""
+
+import logging
+import threading
+
+from contextlib import contextmanager
+from Queue import Queue, Empty
+
+from rent_price_collection.utils.config import (
+    MYSQL_POOL_SIZE,
+    MYSQL_POOL_TIMEOUT_SECONDS,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+class MySqlPool(object):
+    """
+    Fixed size pool of storage objects (AllListingsMySql, ListingStatsMySql, ...), each owning one connection.
+    A MySQLdb connection can only run one query at a time, so concurrent requests each borrow their own.
+    Storage objects are created lazily, the pool never holds more than size of them.
+    """
+
+    def __init__(self, factory, size=MYSQL_POOL_SIZE, timeout=MYSQL_POOL_TIMEOUT_SECONDS):
+        self.factory = factory
+        self.size = size
+        self.timeout = timeout
+        self._idle = Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self.factory()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get(timeout=self.timeout)
+
+    def _discard(self, storage):
+        with self._lock:
+            self._created -= 1
+        try:
+            storage.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a storage object for the duration of the with block.
+        It is replaced instead of returned when the block raises, since the connection may be broken.
+        """
+        storage = self._acquire()
+        try:
+            yield storage
+        except Exception:
+            self._discard(storage)
+            raise
+        self._idle.put(storage)
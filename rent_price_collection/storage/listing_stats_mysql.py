@@ -0,0 +1,315 @@
+"""
+:author: Henley Kuang
+:since: 06/01/2019
+
+Rent statistics rolled up per (source, city, zip_code, beds, day) from zillow_listings and trulia_listings.
+A day is a snapshot of the listings live that day, the ones its crawls saw, with the prices they stored.
+Every union run snapshots today (see AllListingsMySql.union_listings), and yesterday as well when a union
+finishing after midnight is the first to merge yesterday's crawls. Running the union again the same day
+replaces the day's snapshot. A listing crawled again moves its date_updated to the later day, so a past
+day can still be rolled up by hand but only counts the listings not crawled since.
+Rollups are also stored with '*' in place of source, zip_code and beds so "median rent in a city" is a
+single row lookup as well.
+Rollups across every source count an apartment listed on several sources once, see all_listings_dedup.py.
+
+Table SCHEMA:
+CREATE TABLE `listing_stats` (
+    `source` varchar(255) NOT NULL,
+    `city` varchar(255) NOT NULL,
+    `state` varchar(255) NOT NULL,
+    `zip_code` varchar(10) NOT NULL,
+    `beds` varchar(10) NOT NULL,
+    `day` date NOT NULL,
+    `listing_count` int(10) unsigned NOT NULL,
+    `price_mean` double NOT NULL,
+    `price_p25` double NOT NULL,
+    `price_median` double NOT NULL,
+    `price_p75` double NOT NULL,
+    `date_updated` datetime DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (`city`, `state`, `day`, `source`, `zip_code`, `beds`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+"""
+
+import argparse
+import datetime
+import itertools
+import logging
+import MySQLdb
+
+from collections import defaultdict, namedtuple
+
+from rent_price_collection.storage.streaming import (
+    stream_query,
+)
+from rent_price_collection.utils.config import (
+    DEFAULT_LOG_FORMAT_STRING,
+    MYSQL_HOST,
+    MYSQL_USER,
+    MYSQL_PASS,
+    MYSQL_DB,
+    MYSQL_PORT,
+)
+from rent_price_collection.utils.exceptions import (
+    StoreListingResultsException,
+)
+from rent_price_collection.utils.parsers import (
+    parse_beds,
+    parse_price,
+    percentile,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+ALL = '*'
+
+STATS_PARAMETERS = ['source', 'city', 'state', 'zip_code', 'beds']
+StatsParameterObject = namedtuple('StatsParameterObject', STATS_PARAMETERS)
+
+ListingStats = namedtuple('ListingStats', ['source', 'city', 'state', 'zip_code', 'beds', 'day',
+                                           'listing_count', 'price_mean', 'price_p25', 'price_median', 'price_p75'])
+
+def _group_keys(source, city, state, zip_code, beds, day, duplicate=False):
+    """
+    Every rollup a listing counts towards, the exact group plus each '*' combination.
+    A duplicate of another source's listing only counts towards its own source's rollups.
+    """
+    source_keys = (source,) if duplicate else (source, ALL)
+    for source_key, zip_key, beds_key in itertools.product(source_keys, (zip_code, ALL), (beds, ALL)):
+        yield (source_key, city, state, zip_key, beds_key, day)
+
+def compute_listing_stats(rows, day):
+    """
+    Group listing rows and compute count, mean, p25, median and p75 of the monthly price.
+    Rows without a parseable price are skipped.
+
+    :param rows: row dicts of the listings live on day, with the canonical_id of their all_listings row
+    :type rows: iterable
+    :param day: snapshot day every row is counted towards
+    :type day: datetime.date
+    """
+    prices_by_group = defaultdict(list)
+    for row in rows:
+        price = parse_price(row["price"])
+        if price is None:
+            continue
+        beds = parse_beds(row["beds"])
+        duplicate = row.get("canonical_id") not in (None, row.get("id"))
+        for key in _group_keys(row["source"], row["city"], row["state"], str(row["zip_code"]),
+                               str(beds) if beds is not None else '-1', day, duplicate=duplicate):
+            prices_by_group[key].append(price)
+    for key, prices in prices_by_group.items():
+        prices.sort()
+        source, city, state, zip_code, beds, day = key
+        yield ListingStats(
+            source=source,
+            city=city,
+            state=state,
+            zip_code=zip_code,
+            beds=beds,
+            day=day,
+            listing_count=len(prices),
+            price_mean=float(sum(prices)) / len(prices),
+            price_p25=percentile(prices, 0.25),
+            price_median=percentile(prices, 0.5),
+            price_p75=percentile(prices, 0.75),
+        )
+
+class ListingStatsMySql():
+
+    DB_TABLE_NAME = 'listing_stats'
+    QUERY_SELECT = '''select source, city, state, zip_code, beds, day, listing_count,
+price_mean, price_p25, price_median, price_p75 from {table_name}'''.format(table_name=DB_TABLE_NAME)
+    # listings a crawl saw on the day with the price it stored, every crawl moves date_updated of the listings it
+    # saw, canonical_id comes from all_listings once the listing is merged
+    QUERY_SELECT_LISTINGS_SEEN = '''select all_l.id, all_l.canonical_id, "zillow" as source, zillow.city, zillow.state,
+zillow.zip_code, zillow.beds, zillow.price
+FROM zillow_listings as zillow LEFT JOIN all_listings as all_l ON all_l.id = CONCAT("zillow-", zillow.listing_id)
+where zillow.date_updated >= %(day_start)s and zillow.date_updated < %(day_end)s
+UNION ALL
+select all_l.id, all_l.canonical_id, "trulia" as source, trulia.city, trulia.state,
+trulia.zip_code, trulia.beds, trulia.price
+FROM trulia_listings as trulia LEFT JOIN all_listings as all_l ON all_l.id = CONCAT("trulia-", trulia.listing_id)
+where trulia.date_updated >= %(day_start)s and trulia.date_updated < %(day_end)s'''
+    QUERY_DELETE_DAY = '''delete from {table_name} where day = %(day)s'''.format(table_name=DB_TABLE_NAME)
+    QUERY_SELECT_DAY = '''select 1 from {table_name} where day = %(day)s limit 1'''.format(table_name=DB_TABLE_NAME)
+    QUERY_UPSERT = '''insert into {table_name}
+(source, city, state, zip_code, beds, day, listing_count, price_mean, price_p25, price_median, price_p75)
+VALUES (
+%(source)s,
+%(city)s,
+%(state)s,
+%(zip_code)s,
+%(beds)s,
+%(day)s,
+%(listing_count)s,
+%(price_mean)s,
+%(price_p25)s,
+%(price_median)s,
+%(price_p75)s
+)
+ON DUPLICATE KEY UPDATE listing_count=%(listing_count)s, price_mean=%(price_mean)s, price_p25=%(price_p25)s,
+price_median=%(price_median)s, price_p75=%(price_p75)s, date_updated=CURRENT_TIMESTAMP;'''.format(table_name=DB_TABLE_NAME)
+    UPSERT_BATCH_SIZE = 1000
+
+    def __init__(self):
+        self.db_selector = {'host': MYSQL_HOST,
+                            'user': MYSQL_USER,
+                            'passwd': MYSQL_PASS,
+                            'db': MYSQL_DB,
+                            'port': MYSQL_PORT,
+                            'use_unicode': False,
+                            'charset': 'latin1',
+                           }
+        self.db_handle = MySQLdb.connect(**self.db_selector)
+
+    def rollup_crawl(self):
+        """
+        Snapshot today, and yesterday too when it has no snapshot yet, i.e. its crawls were merged after midnight.
+        Returns the number of rollup rows written.
+        """
+        today = datetime.date.today()
+        count = 0
+        yesterday = today - datetime.timedelta(days=1)
+        if not self.has_listing_stats(yesterday):
+            count += self.rollup(yesterday)
+        return count + self.rollup(today)
+
+    def has_listing_stats(self, day):
+        cursor = None
+        try:
+            cursor = self.db_handle.cursor(MySQLdb.cursors.DictCursor)
+            cursor.execute(self.QUERY_SELECT_DAY, {"day": day})
+            result = cursor.fetchone() is not None
+            cursor.connection.commit()
+        except Exception as e:
+            LOGGER.exception(e)
+            raise StoreListingResultsException(e)
+        finally:
+            if cursor is not None:
+                cursor.close()
+        return result
+
+    def rollup(self, day=None):
+        """
+        Snapshot the stats of the listings live on day, replacing what was stored for day, so groups
+        whose listings are all gone since an earlier run that day disappear as well.
+        Returns the number of rollup rows written.
+
+        :param day: defaults to today, a past day only counts the listings not crawled again since
+        :type day: datetime.date
+        """
+        today = datetime.date.today()
+        if day is None:
+            day = today
+        if day > today:
+            raise ValueError("%s has not been crawled yet" % day)
+        day_start = datetime.datetime.combine(day, datetime.time())
+        LOGGER.info("Rolling up listing stats of %s", day)
+        rows = stream_query(self.db_selector, self.QUERY_SELECT_LISTINGS_SEEN,
+                            {"day_start": day_start, "day_end": day_start + datetime.timedelta(days=1)})
+        return self.replace_listing_stats(day, compute_listing_stats(rows, day))
+
+    def replace_listing_stats(self, day, listing_stats):
+        """Replace every rollup of day in one transaction, so readers never see half a day"""
+        cursor = None
+        count = 0
+        try:
+            cursor = self.db_handle.cursor(MySQLdb.cursors.DictCursor)
+            cursor.execute(self.QUERY_DELETE_DAY, {"day": day})
+            batch = []
+            for stats in listing_stats:
+                batch.append(stats._asdict())
+                if len(batch) >= self.UPSERT_BATCH_SIZE:
+                    cursor.executemany(self.QUERY_UPSERT, batch)
+                    count += len(batch)
+                    batch = []
+            if batch:
+                cursor.executemany(self.QUERY_UPSERT, batch)
+                count += len(batch)
+            cursor.connection.commit()
+        except Exception as e:
+            # keep the day's previous snapshot
+            self.db_handle.rollback()
+            LOGGER.exception(e)
+            raise StoreListingResultsException(e)
+        finally:
+            if cursor is not None:
+                cursor.close()
+        return count
+
+    def select_listing_stats(self, stats_parameter_object, start_day=None, end_day=None):
+        """
+        Look up rollups. Parameters left as None match the '*' rollup, so leaving beds
+        out returns stats across every bed count instead of one row per bed count.
+        """
+        cursor = None
+        try:
+            cursor = self.db_handle.cursor(MySQLdb.cursors.DictCursor)
+            where_clauses = []
+            args = {}
+            for name, value in stats_parameter_object._asdict().items():
+                if value is None and name in ('city', 'state'):
+                    continue
+                where_clauses.append("{name} = %({name})s".format(name=name))
+                args[name] = value if value is not None else ALL
+            if start_day is not None:
+                where_clauses.append("day >= %(start_day)s")
+                args["start_day"] = start_day
+            if end_day is not None:
+                where_clauses.append("day <= %(end_day)s")
+                args["end_day"] = end_day
+            query_select = self.QUERY_SELECT
+            if where_clauses:
+                query_select += " where %s" % " and ".join(where_clauses)
+            query_select += " order by day"
+            cursor.execute(query_select, args)
+            results = cursor.fetchall()
+            cursor.connection.commit()
+        except Exception as e:
+            LOGGER.exception(e)
+            raise Exception(e)
+        finally:
+            if cursor is not None:
+                cursor.close()
+        for row in results:
+            row["day"] = row["day"].isoformat()
+        return results
+
+    def close(self):
+        self.db_handle.close()
+
+def _parse_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+
+    command_subparser = parser.add_subparsers(dest='sub_command')
+    command_subparser.required = True
+
+    rollup_parser = command_subparser.add_parser('rollup',
+                                                 help="snapshot a day's stats, the union does it after every merge")
+    rollup_parser.add_argument('--day', type=lambda day: datetime.datetime.strptime(day, "%Y-%m-%d").date(),
+                               help="YYYY-MM-DD, defaults to today.\n"
+                                    "A past day only counts the listings not crawled again since")
+    select_parser = command_subparser.add_parser('select')
+    select_parser.add_argument('--city', required=True)
+    select_parser.add_argument('--state')
+
+    return parser.parse_args()
+
+def _main():
+    options = _parse_args()
+
+    listing_stats_mysql = ListingStatsMySql()
+
+    if options.sub_command == 'rollup':
+        count = listing_stats_mysql.rollup(options.day)
+        LOGGER.info("Rollup complete. Total rows: %s", count)
+    elif options.sub_command == 'select':
+        stats_parameter_object = StatsParameterObject(source=None, city=options.city, state=options.state,
+                                                      zip_code=None, beds=None)
+        results = listing_stats_mysql.select_listing_stats(stats_parameter_object)
+        LOGGER.info(results)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format=DEFAULT_LOG_FORMAT_STRING, datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO)
+    _main()
@@ -0,0 +1,171 @@
+"""
+:author: Henley Kuang
+:since: 06/22/2019
+
+Fingerprints of the last stored crawl of every (source, location, page), so the RPCs can skip parsing and
+storing a page whose listing ids and prices have not changed since. A fingerprint older than
+PAGE_FINGERPRINT_MAX_AGE_DAYS is ignored, so every page is stored again at least that often and
+date_updated of listings still online keeps moving.
+
+Table SCHEMA:
+CREATE TABLE `page_fingerprints` (
+    `source` varchar(32) NOT NULL,
+    `location` varchar(255) NOT NULL,
+    `page_num` smallint(5) unsigned NOT NULL,
+    `fingerprint` char(40) NOT NULL,
+    `date_updated` datetime DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (`source`, `location`, `page_num`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import MySQLdb
+
+from rent_price_collection.utils.config import (
+    DEFAULT_LOG_FORMAT_STRING,
+    MYSQL_HOST,
+    MYSQL_USER,
+    MYSQL_PASS,
+    MYSQL_DB,
+    MYSQL_PORT,
+    PAGE_FINGERPRINT_MAX_AGE_DAYS,
+)
+from rent_price_collection.utils.exceptions import (
+    StoreListingResultsException,
+)
+from rent_price_collection.utils.tracing import (
+    traced,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+# listing keys of each source that make up a page's fingerprint, zillow apartment complexes carry their prices in units
+FINGERPRINT_KEYS = {
+    'zillow': ('id', 'price', 'units'),
+    'trulia': ('id', 'price'),
+}
+
+def page_fingerprint(source, listings):
+    """
+    sha1 of the ids and prices of a page's listings, in page order
+
+    >>> page_fingerprint('trulia', [{'id': 1, 'price': '$1,200', 'photoUrl': 'a.jpg'}]) == \\
+    ...     page_fingerprint('trulia', [{'id': 1, 'price': '$1,200', 'photoUrl': 'b.jpg'}])
+    True
+    """
+    keys = FINGERPRINT_KEYS[source]
+    normalized = [[listing.get(key) for key in keys] for listing in listings]
+    return hashlib.sha1(json.dumps(normalized, sort_keys=True).encode('utf-8')).hexdigest()
+
+class PageFingerprintsMySql(object):
+
+    DB_TABLE_NAME = 'page_fingerprints'
+    QUERY_SELECT = '''select page_num, fingerprint from {table_name}
+where source = %(source)s and location = %(location)s
+and date_updated > DATE_SUB(NOW(), INTERVAL %(max_age_days)s DAY)'''.format(table_name=DB_TABLE_NAME)
+    QUERY_UPSERT = '''insert into {table_name} (source, location, page_num, fingerprint)
+VALUES (%(source)s, %(location)s, %(page_num)s, %(fingerprint)s)
+ON DUPLICATE KEY UPDATE fingerprint=%(fingerprint)s, date_updated=CURRENT_TIMESTAMP;'''.format(table_name=DB_TABLE_NAME)
+    QUERY_DELETE = '''delete from {table_name} where source = %(source)s'''.format(table_name=DB_TABLE_NAME)
+
+    def __init__(self, max_age_days=PAGE_FINGERPRINT_MAX_AGE_DAYS):
+        self.max_age_days = max_age_days
+        self.db_selector = {'host': MYSQL_HOST,
+                            'user': MYSQL_USER,
+                            'passwd': MYSQL_PASS,
+                            'db': MYSQL_DB,
+                            'port': MYSQL_PORT,
+                            'use_unicode': False,
+                            'charset': 'latin1',
+                           }
+        self.db_handle = MySQLdb.connect(**self.db_selector)
+
+    @traced("mysql select_fingerprints")
+    def select_fingerprints(self, source, location):
+        """:returns: dict of page_num -> fingerprint of the pages stored within max_age_days"""
+        cursor = None
+        try:
+            cursor = self.db_handle.cursor(MySQLdb.cursors.DictCursor)
+            cursor.execute(self.QUERY_SELECT, {"source": source, "location": location,
+                                               "max_age_days": self.max_age_days})
+            results = cursor.fetchall()
+            cursor.connection.commit()
+        except Exception as e:
+            LOGGER.exception(e)
+            raise StoreListingResultsException(e)
+        finally:
+            if cursor is not None:
+                cursor.close()
+        return dict((row["page_num"], row["fingerprint"]) for row in results)
+
+    @traced("mysql upsert_fingerprints")
+    def upsert_fingerprints(self, source, location, fingerprints):
+        """:param fingerprints: dict of page_num -> fingerprint of pages that were just stored"""
+        if not fingerprints:
+            return
+        cursor = None
+        try:
+            cursor = self.db_handle.cursor(MySQLdb.cursors.DictCursor)
+            cursor.executemany(self.QUERY_UPSERT, [{
+                "source": source,
+                "location": location,
+                "page_num": page_num,
+                "fingerprint": fingerprint,
+            } for page_num, fingerprint in sorted(fingerprints.items())])
+            cursor.connection.commit()
+        except Exception as e:
+            LOGGER.exception(e)
+            raise StoreListingResultsException(e)
+        finally:
+            if cursor is not None:
+                cursor.close()
+
+    def delete_fingerprints(self, source):
+        """Forget every fingerprint of a source, its next crawl parses and stores every page"""
+        cursor = None
+        try:
+            cursor = self.db_handle.cursor(MySQLdb.cursors.DictCursor)
+            cursor.execute(self.QUERY_DELETE, {"source": source})
+            cursor.connection.commit()
+        except Exception as e:
+            LOGGER.exception(e)
+            raise StoreListingResultsException(e)
+        finally:
+            if cursor is not None:
+                cursor.close()
+
+    def close(self):
+        self.db_handle.close()
+
+def _parse_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+
+    command_subparser = parser.add_subparsers(dest='sub_command')
+    command_subparser.required = True
+
+    select_parser = command_subparser.add_parser('select')
+    select_parser.add_argument('--source', required=True, choices=sorted(FINGERPRINT_KEYS.keys()))
+    select_parser.add_argument('--location', required=True)
+    delete_parser = command_subparser.add_parser('delete')
+    delete_parser.add_argument('--source', required=True, choices=sorted(FINGERPRINT_KEYS.keys()))
+
+    return parser.parse_args()
+
+def _main():
+    options = _parse_args()
+
+    page_fingerprints_mysql = PageFingerprintsMySql()
+
+    if options.sub_command == 'select':
+        LOGGER.info(page_fingerprints_mysql.select_fingerprints(options.source, options.location))
+    elif options.sub_command == 'delete':
+        page_fingerprints_mysql.delete_fingerprints(options.source)
+    page_fingerprints_mysql.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format=DEFAULT_LOG_FORMAT_STRING, datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO)
+    _main()
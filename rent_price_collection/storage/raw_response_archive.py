@@ -0,0 +1,253 @@
+"""
+:author: Henley Kuang
+:since: 06/21/2019
+
+Append-only archive of the raw listings of every crawled page, so rows can be re-derived with a fixed
+parser without crawling again, see app/reprocess.py.
+
+Layout under RAW_RESPONSE_ARCHIVE_DIR, one directory per source:
+
+<source>/<YYYYmmddTHHMMSS>-<pid>-<n>.jsonl.gz segments of one JSON line per page:
+    {"source": "zillow", "location": "Round Lake,IL", "page": 2, "timestamp": 1561100000.0, "listings": [...]}
+<source>/index.jsonl                          one line per page: location, page, timestamp, segment and line
+
+A segment is closed and a new one started after RAW_RESPONSE_SEGMENT_MAX_BYTES of uncompressed JSON or
+RAW_RESPONSE_SEGMENT_MAX_SECONDS, whichever comes first. Segments are gzip, or zstd (.jsonl.zst) when
+RAW_RESPONSE_COMPRESSION = 'zstd' and zstandard is installed. Every page is flushed as it is written, so a
+crawl that dies midway leaves its segment readable up to its last page.
+"""
+
+import argparse
+import datetime
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import zstandard
+except ImportError:
+    # zstandard is optional, without it segments are gzipped
+    zstandard = None
+
+from rent_price_collection.utils.config import (
+    DEFAULT_LOG_FORMAT_STRING,
+    RAW_RESPONSE_ARCHIVE_DIR,
+    RAW_RESPONSE_COMPRESSION,
+    RAW_RESPONSE_SEGMENT_MAX_BYTES,
+    RAW_RESPONSE_SEGMENT_MAX_SECONDS,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+INDEX_FILE_NAME = 'index.jsonl'
+SEGMENT_EXTENSIONS = {
+    'gzip': '.jsonl.gz',
+    'zstd': '.jsonl.zst',
+}
+READ_CHUNK_BYTES = 1024 * 1024
+# raised reading a segment whose writer has not closed it yet
+TRUNCATED_ERRORS = (EOFError, IOError, ValueError) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+class _GzipSegmentWriter(object):
+
+    def __init__(self, path):
+        self._file = gzip.open(path, 'ab')
+
+    def write(self, data):
+        self._file.write(data)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+class _ZstdSegmentWriter(object):
+
+    def __init__(self, path):
+        self._raw_file = open(path, 'ab')
+        self._file = zstandard.ZstdCompressor().stream_writer(self._raw_file)
+
+    def write(self, data):
+        self._file.write(data)
+        # a flushed block is decodable without the end of the frame
+        self._file.flush(zstandard.FLUSH_BLOCK)
+
+    def close(self):
+        self._file.flush(zstandard.FLUSH_FRAME)
+        self._raw_file.close()
+
+class RawResponseArchive(object):
+    """Writer of one process, safe to share between threads"""
+
+    def __init__(self, directory=RAW_RESPONSE_ARCHIVE_DIR, compression=RAW_RESPONSE_COMPRESSION,
+                 segment_max_bytes=RAW_RESPONSE_SEGMENT_MAX_BYTES, segment_max_seconds=RAW_RESPONSE_SEGMENT_MAX_SECONDS):
+        if compression == 'zstd' and zstandard is None:
+            LOGGER.warning("zstandard is not installed, raw responses are gzipped")
+            compression = 'gzip'
+        if compression not in SEGMENT_EXTENSIONS:
+            raise ValueError("Unknown raw response compression: %s" % compression)
+        self.directory = directory
+        self.compression = compression
+        self.segment_max_bytes = segment_max_bytes
+        self.segment_max_seconds = segment_max_seconds
+        self._lock = threading.Lock()
+        # source -> [segment name, writer, bytes written, lines written, opened at]
+        self._segments = {}
+        self._index_files = {}
+        self._segment_count = 0
+
+    def _open_segment(self, source):
+        source_directory = os.path.join(self.directory, source)
+        if not os.path.isdir(source_directory):
+            os.makedirs(source_directory)
+        opened = time.time()
+        self._segment_count += 1
+        name = "%s-%s-%s%s" % (datetime.datetime.utcfromtimestamp(opened).strftime("%Y%m%dT%H%M%S"), os.getpid(),
+                               self._segment_count, SEGMENT_EXTENSIONS[self.compression])
+        writer_class = _ZstdSegmentWriter if self.compression == 'zstd' else _GzipSegmentWriter
+        self._segments[source] = [name, writer_class(os.path.join(source_directory, name)), 0, 0, opened]
+        if source not in self._index_files:
+            self._index_files[source] = open(os.path.join(source_directory, INDEX_FILE_NAME), 'ab')
+        LOGGER.info("Archiving %s responses to %s", source, name)
+        return self._segments[source]
+
+    def append(self, source, location, page_num, listings, timestamp=None):
+        """Archive the raw listings of one page, as returned by the api client"""
+        timestamp = timestamp if timestamp is not None else time.time()
+        line = (json.dumps({
+            "source": source,
+            "location": location,
+            "page": page_num,
+            "timestamp": timestamp,
+            "listings": listings,
+        }, sort_keys=True) + "\n").encode('utf-8')
+        with self._lock:
+            segment = self._segments.get(source)
+            if segment is not None and (segment[2] >= self.segment_max_bytes or
+                                        time.time() - segment[4] >= self.segment_max_seconds):
+                segment[1].close()
+                segment = None
+            if segment is None:
+                segment = self._open_segment(source)
+            name, writer, _, line_num, _ = segment
+            writer.write(line)
+            segment[2] += len(line)
+            segment[3] += 1
+            index_line = json.dumps({
+                "location": location,
+                "page": page_num,
+                "timestamp": timestamp,
+                "segment": name,
+                "line": line_num,
+            }, sort_keys=True) + "\n"
+            # one write per line, appends of concurrent crawls of the same source do not interleave
+            self._index_files[source].write(index_line.encode('utf-8'))
+            self._index_files[source].flush()
+
+    def close(self):
+        with self._lock:
+            for segment in self._segments.values():
+                segment[1].close()
+            for index_file in self._index_files.values():
+                index_file.close()
+            self._segments = {}
+            self._index_files = {}
+
+def _iter_lines(chunks, path):
+    """Split an iterable of byte chunks into lines, dropping a partial last line of a segment that is not closed"""
+    pending = b''
+    try:
+        for chunk in chunks:
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                if line.strip():
+                    yield line
+    except TRUNCATED_ERRORS as e:
+        LOGGER.warning("%s ends early, it was not closed: %s", path, e)
+
+def iter_segment(path):
+    """Yield the pages of a segment in written order"""
+    if path.endswith(SEGMENT_EXTENSIONS['zstd']):
+        if zstandard is None:
+            raise ValueError("Install zstandard to read %s" % path)
+        with open(path, 'rb') as raw_file:
+            reader = zstandard.ZstdDecompressor().stream_reader(raw_file)
+            for line in _iter_lines(iter(lambda: reader.read(READ_CHUNK_BYTES), b''), path):
+                yield json.loads(line.decode('utf-8'))
+    else:
+        with gzip.open(path, 'rb') as segment_file:
+            # line by line, a large read of a segment that is not closed fails with the pages it already decoded
+            for line in _iter_lines(segment_file, path):
+                yield json.loads(line.decode('utf-8'))
+
+def iter_index(directory, source, since=None, until=None, location=None):
+    """
+    Yield the index entries of a source's pages
+    :param since: unix timestamp, inclusive
+    :param until: unix timestamp, exclusive
+    """
+    index_path = os.path.join(directory, source, INDEX_FILE_NAME)
+    if not os.path.exists(index_path):
+        return
+    with open(index_path, 'rb') as index_file:
+        for line in index_file:
+            try:
+                entry = json.loads(line.decode('utf-8'))
+            except ValueError:
+                # a partial last line of a crawl that is still writing
+                continue
+            if since is not None and entry["timestamp"] < since:
+                continue
+            if until is not None and entry["timestamp"] >= until:
+                continue
+            if location is not None and entry["location"] != location:
+                continue
+            yield entry
+
+def select_segments(directory, source, since=None, until=None, location=None):
+    """:returns: paths of the segments holding matching pages, oldest first"""
+    first_timestamps = {}
+    for entry in iter_index(directory, source, since, until, location):
+        first_timestamps[entry["segment"]] = min(entry["timestamp"], first_timestamps.get(entry["segment"], entry["timestamp"]))
+    return [os.path.join(directory, source, name) for name in sorted(first_timestamps, key=first_timestamps.get)]
+
+def iter_pages(path, since=None, until=None, location=None):
+    """Yield the pages of a segment matching the same filters as iter_index"""
+    for page in iter_segment(path):
+        if since is not None and page["timestamp"] < since:
+            continue
+        if until is not None and page["timestamp"] >= until:
+            continue
+        if location is not None and page["location"] != location:
+            continue
+        yield page
+
+def _parse_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--directory', default=RAW_RESPONSE_ARCHIVE_DIR)
+    parser.add_argument('--source', required=True, choices=['zillow', 'trulia'])
+    parser.add_argument('--location')
+
+    return parser.parse_args()
+
+def _main():
+    options = _parse_args()
+    if not options.directory:
+        raise SystemExit("Set RAW_RESPONSE_ARCHIVE_DIR or pass --directory")
+
+    pages = 0
+    listings = 0
+    for path in select_segments(options.directory, options.source, location=options.location):
+        for page in iter_pages(path, location=options.location):
+            pages += 1
+            listings += len(page["listings"])
+        LOGGER.info("%s: %s pages, %s listings so far", os.path.basename(path), pages, listings)
+    LOGGER.info("Archived %s pages with %s listings", pages, listings)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format=DEFAULT_LOG_FORMAT_STRING, datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO)
+    _main()
@@ -0,0 +1,158 @@
+"""
+:author: Henley Kuang
+:since: 06/16/2019
+
+Criteria users want to be alerted about when new listings are collected.
+Every criterion is optional, a saved search with only an email matches every new listing.
+
+Table SCHEMA:
+CREATE TABLE `saved_searches` (
+    `saved_search_id` int(10) unsigned NOT NULL AUTO_INCREMENT,
+    `email` varchar(255) NOT NULL,
+    `city` varchar(255) DEFAULT NULL,
+    `state` varchar(255) DEFAULT NULL,
+    `zip_code` mediumint(6) signed DEFAULT NULL,
+    `min_price` int(10) unsigned DEFAULT NULL,
+    `max_price` int(10) unsigned DEFAULT NULL,
+    `min_beds` tinyint(3) unsigned DEFAULT NULL,
+    `max_beds` tinyint(3) unsigned DEFAULT NULL,
+    `date_created` datetime DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (`saved_search_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+"""
+
+import argparse
+import logging
+import MySQLdb
+
+from collections import namedtuple
+
+from rent_price_collection.utils.config import (
+    DEFAULT_LOG_FORMAT_STRING,
+    MYSQL_HOST,
+    MYSQL_USER,
+    MYSQL_PASS,
+    MYSQL_DB,
+    MYSQL_PORT,
+)
+from rent_price_collection.utils.exceptions import (
+    StoreListingResultsException,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+SAVED_SEARCH_PARAMETERS = ['email', 'city', 'state', 'zip_code', 'min_price', 'max_price', 'min_beds', 'max_beds']
+SavedSearch = namedtuple('SavedSearch', ['saved_search_id'] + SAVED_SEARCH_PARAMETERS)
+
+class SavedSearchesMySql(object):
+
+    DB_TABLE_NAME = 'saved_searches'
+    QUERY_SELECT = '''select saved_search_id, {columns} from {table_name}'''.format(
+        columns=", ".join(SAVED_SEARCH_PARAMETERS), table_name=DB_TABLE_NAME)
+    QUERY_INSERT = '''insert into {table_name} ({columns}) VALUES ({values});'''.format(
+        table_name=DB_TABLE_NAME,
+        columns=", ".join(SAVED_SEARCH_PARAMETERS),
+        values=", ".join("%({})s".format(name) for name in SAVED_SEARCH_PARAMETERS),
+    )
+    QUERY_DELETE = '''delete from {table_name} where saved_search_id = %(saved_search_id)s;'''.format(
+        table_name=DB_TABLE_NAME)
+
+    def __init__(self):
+        self.db_selector = {'host': MYSQL_HOST,
+                            'user': MYSQL_USER,
+                            'passwd': MYSQL_PASS,
+                            'db': MYSQL_DB,
+                            'port': MYSQL_PORT,
+                            'use_unicode': False,
+                            'charset': 'latin1',
+                           }
+        self.db_handle = MySQLdb.connect(**self.db_selector)
+
+    def select_saved_searches(self):
+        """:returns: list of SavedSearch"""
+        cursor = None
+        try:
+            cursor = self.db_handle.cursor(MySQLdb.cursors.DictCursor)
+            cursor.execute(self.QUERY_SELECT)
+            results = cursor.fetchall()
+            cursor.connection.commit()
+        except Exception as e:
+            LOGGER.exception(e)
+            raise Exception(e)
+        finally:
+            if cursor is not None:
+                cursor.close()
+        return [SavedSearch(**row) for row in results]
+
+    def insert_saved_search(self, **saved_search_parameters):
+        """Store a saved search and return its id, parameters left out are not filtered on"""
+        cursor = None
+        try:
+            cursor = self.db_handle.cursor(MySQLdb.cursors.DictCursor)
+            cursor.execute(self.QUERY_INSERT, dict((name, saved_search_parameters.get(name))
+                                                   for name in SAVED_SEARCH_PARAMETERS))
+            saved_search_id = cursor.lastrowid
+            cursor.connection.commit()
+        except Exception as e:
+            LOGGER.exception(e)
+            raise StoreListingResultsException(e)
+        finally:
+            if cursor is not None:
+                cursor.close()
+        return saved_search_id
+
+    def delete_saved_search(self, saved_search_id):
+        cursor = None
+        try:
+            cursor = self.db_handle.cursor(MySQLdb.cursors.DictCursor)
+            cursor.execute(self.QUERY_DELETE, {"saved_search_id": saved_search_id})
+            cursor.connection.commit()
+        except Exception as e:
+            LOGGER.exception(e)
+            raise StoreListingResultsException(e)
+        finally:
+            if cursor is not None:
+                cursor.close()
+
+    def close(self):
+        self.db_handle.close()
+
+def _parse_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+
+    command_subparser = parser.add_subparsers(dest='sub_command')
+    command_subparser.required = True
+
+    insert_parser = command_subparser.add_parser('insert')
+    insert_parser.add_argument('--email', required=True)
+    insert_parser.add_argument('--city')
+    insert_parser.add_argument('--state')
+    insert_parser.add_argument('--zip-code', type=int)
+    insert_parser.add_argument('--min-price', type=int)
+    insert_parser.add_argument('--max-price', type=int)
+    insert_parser.add_argument('--min-beds', type=int)
+    insert_parser.add_argument('--max-beds', type=int)
+    delete_parser = command_subparser.add_parser('delete')
+    delete_parser.add_argument('saved_search_id', type=int)
+    command_subparser.add_parser('select')
+
+    return parser.parse_args()
+
+def _main():
+    options = _parse_args()
+
+    saved_searches_mysql = SavedSearchesMySql()
+
+    if options.sub_command == 'insert':
+        saved_search_id = saved_searches_mysql.insert_saved_search(
+            **dict((name, getattr(options, name)) for name in SAVED_SEARCH_PARAMETERS))
+        LOGGER.info("Saved search %s", saved_search_id)
+    elif options.sub_command == 'delete':
+        saved_searches_mysql.delete_saved_search(options.saved_search_id)
+    elif options.sub_command == 'select':
+        LOGGER.info(saved_searches_mysql.select_saved_searches())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format=DEFAULT_LOG_FORMAT_STRING, datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO)
+    _main()
@@ -0,0 +1,50 @@
+"""
+:author: Henley Kuang
+:since: 05/19/2019
+"""
+
+import logging
+import MySQLdb
+
+from rent_price_collection.utils.config import (
+    MYSQL_STREAM_FETCH_SIZE,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+def stream_query(db_selector, query, args=None, fetch_size=MYSQL_STREAM_FETCH_SIZE):
+    """
+    Generator yielding the rows of query as dicts from an unbuffered SSDictCursor.
+    Memory stays at fetch_size rows no matter how large the result is.
+
+    :param db_selector: MySQLdb.connect keyword arguments
+    :type db_selector: dict
+    :param query: sql query
+    :type query: string
+    :param args: query parameters
+    :type args: dict or tuple
+    :param fetch_size: rows pulled per round trip
+    :type fetch_size: int
+    """
+    db_handle = MySQLdb.connect(**db_selector)
+    cursor = None
+    drained = False
+    try:
+        cursor = db_handle.cursor(MySQLdb.cursors.SSDictCursor)
+        cursor.execute(query, args)
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+        drained = True
+    except Exception as e:
+        LOGGER.exception("Query: %s | Exception: %s", query, e)
+        raise
+    finally:
+        # closing an unbuffered cursor reads off every remaining row, so when the consumer
+        # stops early the connection is dropped instead
+        if drained and cursor is not None:
+            cursor.close()
+        db_handle.close()
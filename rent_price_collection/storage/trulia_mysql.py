@@ -26,6 +26,12 @@ import argparse
 import logging
 import MySQLdb
 
+from rent_price_collection.storage.streaming import (
+    stream_query,
+)
+from rent_price_collection.utils.cache import (
+    bump_cache_generation,
+)
 from rent_price_collection.utils.config import (
     DEFAULT_LOG_FORMAT_STRING,
     MYSQL_HOST,
@@ -33,10 +39,19 @@ from rent_price_collection.utils.config import (
     MYSQL_PASS,
     MYSQL_DB,
     MYSQL_PORT,
+    MYSQL_STREAM_FETCH_SIZE,
 )
 from rent_price_collection.utils.exceptions import (
     StoreListingResultsException,
 )
+from rent_price_collection.utils.metrics import (
+    increment,
+    timer,
+)
+from rent_price_collection.utils.tracing import (
+    span,
+    traced,
+)
 
 LOGGER = logging.getLogger(__name__)
 
@@ -44,6 +59,12 @@ class TruliaMySql():
 
     DB_TABLE_NAME = 'trulia_listings'
     QUERY_SELECT = '''select * from {table_name}'''.format(table_name=DB_TABLE_NAME)
+    QUERY_SELECT_EXISTING_IDS = '''select listing_id from {table_name} where listing_id in ({{placeholders}})'''.format(
+        table_name=DB_TABLE_NAME)
+    SELECT_EXISTING_IDS_BATCH_SIZE = 1000
+    # listings on a page skipped as unchanged were still seen, only their date_updated moves
+    QUERY_TOUCH = '''update {table_name} set date_updated=CURRENT_TIMESTAMP where listing_id in ({{placeholders}})'''.format(
+        table_name=DB_TABLE_NAME)
     QUERY_UPSERT = '''insert into {table_name}
 (listing_id, card_url, street_address, city, state, zip_code, beds, baths, lat, lng, sqft, price)
 VALUES (
@@ -60,18 +81,45 @@ VALUES (
 %(sqft)s,
 %(price)s
 )
-ON DUPLICATE KEY UPDATE price=%(price)s, sqft=%(sqft)s, date_updated=CURRENT_TIMESTAMP;'''.format(table_name=DB_TABLE_NAME)
+ON DUPLICATE KEY UPDATE price=%(price)s, sqft=%(sqft)s,
+zip_code=IF(zip_code = -1, %(zip_code)s, zip_code), city=IF(city = '-1', %(city)s, city), date_updated=CURRENT_TIMESTAMP;'''.format(table_name=DB_TABLE_NAME)
+    # app/reprocess.py: rewrites what the parsers derive but a zip code or city filled in since, the price only
+    # from an observation at least as new as the row, and keeps date_updated, assigned explicitly so ON UPDATE
+    # CURRENT_TIMESTAMP does not fire
+    QUERY_REPROCESS_UPSERT = '''insert into {table_name}
+(listing_id, card_url, street_address, city, state, zip_code, beds, baths, lat, lng, sqft, price,
+date_collected, date_updated)
+VALUES (
+%(listing_id)s,
+%(card_url)s,
+%(street_address)s,
+%(city)s,
+%(state)s,
+%(zip_code)s,
+%(beds)s,
+%(baths)s,
+%(lat)s,
+%(lng)s,
+%(sqft)s,
+%(price)s,
+%(observed_at)s,
+%(observed_at)s
+)
+ON DUPLICATE KEY UPDATE price=IF(%(observed_at)s >= date_updated, %(price)s, price),
+card_url=%(card_url)s, street_address=%(street_address)s, city=IF(%(city)s = '-1', city, %(city)s), state=%(state)s,
+zip_code=IF(%(zip_code)s = -1, zip_code, %(zip_code)s), beds=%(beds)s, baths=%(baths)s, lat=%(lat)s, lng=%(lng)s, sqft=%(sqft)s,
+date_updated=date_updated;'''.format(table_name=DB_TABLE_NAME)
 
     def __init__(self):
-        db_selector = {'host': MYSQL_HOST,
-                       'user': MYSQL_USER,
-                       'passwd': MYSQL_PASS,
-                       'db': MYSQL_DB,
-                       'port': MYSQL_PORT,
-                       'use_unicode': False,
-                       'charset': 'latin1',
-                      }
-        self.db_handle = MySQLdb.connect(**db_selector)
+        self.db_selector = {'host': MYSQL_HOST,
+                            'user': MYSQL_USER,
+                            'passwd': MYSQL_PASS,
+                            'db': MYSQL_DB,
+                            'port': MYSQL_PORT,
+                            'use_unicode': False,
+                            'charset': 'latin1',
+                           }
+        self.db_handle = MySQLdb.connect(**self.db_selector)
 
     def select_trulia_listings(self, limit=None):
         cursor = None
@@ -110,7 +158,74 @@ ON DUPLICATE KEY UPDATE price=%(price)s, sqft=%(sqft)s, date_updated=CURRENT_TIM
                 "sqft": trulia_listing.sqft,
                 "price": trulia_listing.price,
             } for trulia_listing in trulia_listings_tuple]
-            cursor.executemany(self.QUERY_UPSERT, value_list)
+            with timer("storage_upsert_seconds", table=self.DB_TABLE_NAME), \
+                    span("mysql upsert", **{"db.table": self.DB_TABLE_NAME, "db.rows": len(value_list)}):
+                cursor.executemany(self.QUERY_UPSERT, value_list)
+                cursor.connection.commit()
+            increment("storage_rows_written_total", len(value_list), table=self.DB_TABLE_NAME)
+            bump_cache_generation()
+        except Exception as e:
+            LOGGER.exception(e)
+            raise StoreListingResultsException(e)
+        finally:
+            if cursor is not None:
+                cursor.close()
+
+    def reprocess_trulia_listings(self, observations):
+        """
+        :param observations: (trulia_listing, observed_at) pairs, observed_at the datetime the archived
+            page was crawled
+        """
+        cursor = None
+        try:
+            cursor = self.db_handle.cursor(MySQLdb.cursors.DictCursor)
+            value_list = []
+            for trulia_listing, observed_at in observations:
+                values = trulia_listing._asdict()
+                values["observed_at"] = observed_at
+                value_list.append(values)
+            cursor.executemany(self.QUERY_REPROCESS_UPSERT, value_list)
+            cursor.connection.commit()
+            increment("storage_rows_written_total", len(value_list), table=self.DB_TABLE_NAME)
+            bump_cache_generation()
+        except Exception as e:
+            LOGGER.exception(e)
+            raise StoreListingResultsException(e)
+        finally:
+            if cursor is not None:
+                cursor.close()
+
+    @traced("mysql select_existing_listing_ids")
+    def select_existing_listing_ids(self, listing_ids):
+        """Return the subset of listing_ids already stored, used to tell new listings from updated ones"""
+        cursor = None
+        existing_listing_ids = set()
+        listing_ids = list(listing_ids)
+        try:
+            cursor = self.db_handle.cursor(MySQLdb.cursors.DictCursor)
+            for start in range(0, len(listing_ids), self.SELECT_EXISTING_IDS_BATCH_SIZE):
+                batch = listing_ids[start:start + self.SELECT_EXISTING_IDS_BATCH_SIZE]
+                cursor.execute(self.QUERY_SELECT_EXISTING_IDS.format(placeholders=", ".join(["%s"] * len(batch))),
+                               batch)
+                existing_listing_ids.update(row["listing_id"] for row in cursor.fetchall())
+            cursor.connection.commit()
+        except Exception as e:
+            LOGGER.exception(e)
+            raise StoreListingResultsException(e)
+        finally:
+            if cursor is not None:
+                cursor.close()
+        return existing_listing_ids
+
+    def touch_trulia_listings(self, listing_ids):
+        """Set date_updated of listing_ids to now, for listings seen on a page that was not parsed"""
+        cursor = None
+        listing_ids = list(listing_ids)
+        try:
+            cursor = self.db_handle.cursor()
+            for start in range(0, len(listing_ids), self.SELECT_EXISTING_IDS_BATCH_SIZE):
+                batch = listing_ids[start:start + self.SELECT_EXISTING_IDS_BATCH_SIZE]
+                cursor.execute(self.QUERY_TOUCH.format(placeholders=", ".join(["%s"] * len(batch))), batch)
             cursor.connection.commit()
         except Exception as e:
             LOGGER.exception(e)
@@ -119,6 +234,16 @@ ON DUPLICATE KEY UPDATE price=%(price)s, sqft=%(sqft)s, date_updated=CURRENT_TIM
             if cursor is not None:
                 cursor.close()
 
+    def iter_trulia_listings(self, limit=None, fetch_size=MYSQL_STREAM_FETCH_SIZE):
+        """
+        Stream rows off an unbuffered server side cursor, fetch_size rows per round trip.
+        A dedicated connection is used since an unbuffered cursor ties up its connection until it is drained.
+        """
+        query_select = self.QUERY_SELECT
+        if limit:
+            query_select = "%s limit %s" % (query_select, limit)
+        return stream_query(self.db_selector, query_select, fetch_size=fetch_size)
+
     def close(self):
         self.db_handle.close()
 
@@ -0,0 +1,128 @@
+"""
+:author: Henley Kuang
+:since: 06/18/2019
+
+Fill in the zip code, and the city when it is missing, of rows already stored with zip_code -1
+from their lat/lng, see utils/reverse_geocoder.py. all_listings picks the new values up on the next union.
+
+python rent_price_collection/storage/zip_code_backfill.py --table zillow_listings --table trulia_listings
+"""
+
+import argparse
+import logging
+import MySQLdb
+
+from rent_price_collection.storage.streaming import (
+    stream_query,
+)
+from rent_price_collection.utils.cache import (
+    bump_cache_generation,
+)
+from rent_price_collection.utils.config import (
+    DEFAULT_LOG_FORMAT_STRING,
+    MYSQL_HOST,
+    MYSQL_USER,
+    MYSQL_PASS,
+    MYSQL_DB,
+    MYSQL_PORT,
+    ZIP_CENTROIDS_FILE,
+)
+from rent_price_collection.utils.exceptions import (
+    StoreListingResultsException,
+)
+from rent_price_collection.utils.reverse_geocoder import (
+    ReverseGeocoder,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+# table -> primary key column
+BACKFILL_TABLES = {
+    'zillow_listings': 'listing_id',
+    'trulia_listings': 'listing_id',
+}
+
+class ZipCodeBackfill(object):
+
+    QUERY_SELECT_MISSING = '''select {id_column} as id, city, lat, lng from {table_name} where zip_code = -1'''
+    QUERY_UPDATE = '''update {table_name} set zip_code = %(zip_code)s, city = %(city)s where {id_column} = %(id)s'''
+    UPDATE_BATCH_SIZE = 1000
+
+    def __init__(self, reverse_geocoder):
+        self.reverse_geocoder = reverse_geocoder
+        self.db_selector = {'host': MYSQL_HOST,
+                            'user': MYSQL_USER,
+                            'passwd': MYSQL_PASS,
+                            'db': MYSQL_DB,
+                            'port': MYSQL_PORT,
+                            'use_unicode': False,
+                            'charset': 'latin1',
+                           }
+        self.db_handle = MySQLdb.connect(**self.db_selector)
+
+    def _updates(self, table_name):
+        id_column = BACKFILL_TABLES[table_name]
+        rows = stream_query(self.db_selector, self.QUERY_SELECT_MISSING.format(id_column=id_column, table_name=table_name))
+        for row in rows:
+            if row['lat'] == -1 and row['lng'] == -1:
+                continue
+            centroid = self.reverse_geocoder.nearest(float(row['lat']), float(row['lng']))
+            if centroid is None:
+                continue
+            city = centroid.city if row['city'] == '-1' and centroid.city else row['city']
+            yield {"id": row['id'], "zip_code": centroid.zip_code, "city": city}
+
+    def backfill(self, table_name):
+        """Returns the number of rows updated"""
+        cursor = None
+        count = 0
+        query_update = self.QUERY_UPDATE.format(table_name=table_name, id_column=BACKFILL_TABLES[table_name])
+        try:
+            cursor = self.db_handle.cursor(MySQLdb.cursors.DictCursor)
+            batch = []
+            for update in self._updates(table_name):
+                batch.append(update)
+                if len(batch) >= self.UPDATE_BATCH_SIZE:
+                    cursor.executemany(query_update, batch)
+                    count += len(batch)
+                    batch = []
+            if batch:
+                cursor.executemany(query_update, batch)
+                count += len(batch)
+            cursor.connection.commit()
+            if count:
+                bump_cache_generation()
+        except Exception as e:
+            LOGGER.exception(e)
+            raise StoreListingResultsException(e)
+        finally:
+            if cursor is not None:
+                cursor.close()
+        return count
+
+    def close(self):
+        self.db_handle.close()
+
+def _parse_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--table', action='append', choices=sorted(BACKFILL_TABLES.keys()),
+                        help='defaults to every table')
+    parser.add_argument('--centroids-file', default=ZIP_CENTROIDS_FILE)
+
+    return parser.parse_args()
+
+def _main():
+    options = _parse_args()
+    if not options.centroids_file:
+        raise SystemExit("Set ZIP_CENTROIDS_FILE or pass --centroids-file")
+
+    zip_code_backfill = ZipCodeBackfill(ReverseGeocoder.from_file(options.centroids_file))
+    for table_name in options.table or sorted(BACKFILL_TABLES.keys()):
+        count = zip_code_backfill.backfill(table_name)
+        LOGGER.info("Backfilled %s rows of %s", count, table_name)
+    zip_code_backfill.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format=DEFAULT_LOG_FORMAT_STRING, datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO)
+    _main()
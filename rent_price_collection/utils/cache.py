@@ -0,0 +1,364 @@
+"""
+:author: Henley Kuang
+:since: 05/25/2019
+
+Result caching for the search api, and the response cache the api clients share, see RestClient.
+
+Every cached search result is tagged with the cache generation it was computed under. The generation lives in a
+small file shared by every process on the box and is bumped whenever listings are written
+(upserts and the all_listings union), which invalidates every cached entry at once in every uwsgi worker.
+The file only reaches processes on the same box, so the api pairs it with the latest date_changed in mysql,
+see WatermarkGeneration.
+"""
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+
+from rent_price_collection.utils.config import (
+    CACHE_GENERATION_FILE,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+class CacheGeneration(object):
+
+    def __init__(self, generation_file=CACHE_GENERATION_FILE):
+        self.generation_file = generation_file
+        self._stat_key = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def current(self):
+        """Return the current generation, the file is only re-read when its stat changes"""
+        try:
+            stat = os.stat(self.generation_file)
+        except OSError:
+            return 0
+        stat_key = (stat.st_ino, stat.st_mtime, stat.st_size)
+        if stat_key != self._stat_key:
+            with self._lock:
+                try:
+                    with open(self.generation_file) as f:
+                        self._generation = int(f.read().strip() or 0)
+                except (IOError, ValueError):
+                    self._generation = 0
+                self._stat_key = stat_key
+        return self._generation
+
+    def bump(self):
+        """Invalidate every entry cached under the current generation"""
+        generation = self.current() + 1
+        directory = os.path.dirname(self.generation_file) or "."
+        # write then rename so readers never see a half written file
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(str(generation))
+            os.rename(tmp_path, self.generation_file)
+        except OSError as e:
+            LOGGER.warning("Failed to bump cache generation in %s: %s", self.generation_file, e)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        return generation
+
+def bump_cache_generation():
+    """Called after listings are committed so cached search results are dropped"""
+    return CacheGeneration().bump()
+
+class WatermarkGeneration(object):
+    """
+    A generation that also changes whenever a watermark read from the database does, e.g. max(date_changed),
+    so writes made from another box invalidate cached entries too. A daemon thread reads the watermark every
+    check_seconds, and right away once the generation file is bumped, requests never wait on the read.
+    """
+
+    def __init__(self, read_watermark, check_seconds, generation=None):
+        self.read_watermark = read_watermark
+        self.check_seconds = check_seconds
+        self.generation = generation if generation else CacheGeneration()
+        self._watermark = None
+        self._read_generation = None
+        self._wake = threading.Event()
+
+    def _read(self):
+        generation = self.generation.current()
+        try:
+            self._watermark = str(self.read_watermark())
+        except Exception as e:
+            LOGGER.warning("Failed to read the cache watermark, keeping the last one: %s", e)
+        self._read_generation = generation
+
+    def _read_loop(self):
+        while True:
+            self._wake.wait(self.check_seconds)
+            self._wake.clear()
+            self._read()
+
+    def start(self):
+        """Read the watermark now and keep reading it from a daemon thread"""
+        self._read()
+        read_thread = threading.Thread(target=self._read_loop, name="cache-watermark")
+        read_thread.daemon = True
+        read_thread.start()
+
+    def current(self):
+        """Return (file generation, last watermark read)"""
+        generation = self.generation.current()
+        if generation != self._read_generation:
+            self._wake.set()
+        return generation, self._watermark
+
+class LRUCache(object):
+    """In process LRU cache with a ttl per entry"""
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, generation):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires_at, entry_generation, value = entry
+            if entry_generation != generation or expires_at < time.time():
+                return None
+            # re-insert to mark as most recently used
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, generation, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl_seconds, generation, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+class SizedTTLCache(object):
+    """In process LRU cache bounded by the total size of its values, with a ttl per entry"""
+
+    def __init__(self, max_bytes, ttl_seconds, sizeof=len):
+        """:param sizeof: function returning the size in bytes of a value"""
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.sizeof = sizeof
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires_at, size, value = entry
+            if expires_at < time.time():
+                self.size -= size
+                return None
+            # re-insert to mark as most recently used
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            self._pop(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (time.time() + self.ttl_seconds, size, value)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def pop(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+class _Call(object):
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight(object):
+    """Concurrent calls with the same key wait for the first one and share its result or exception"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """:returns: (result, shared), shared is True when the result came from another thread's call"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = func()
+            return call.result, False
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+class FileCacheBackend(object):
+    """Cache stored as one pickle per entry in a local directory, shared by every process on the box"""
+
+    def __init__(self, directory, max_entries, ttl_seconds):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._sets_since_evict = 0
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def get(self, key, generation):
+        try:
+            with open(self._path(key), "rb") as f:
+                expires_at, entry_generation, entry_key, value = pickle.load(f)
+        except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return None
+        if entry_key != key or entry_generation != generation or expires_at < time.time():
+            return None
+        return value
+
+    def set(self, key, generation, value):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump((time.time() + self.ttl_seconds, generation, key, value), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self._path(key))
+        except (IOError, OSError) as e:
+            LOGGER.warning("Failed to write cache entry: %s", e)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        self._sets_since_evict += 1
+        if self._sets_since_evict >= max(self.max_entries // 10, 1):
+            self._sets_since_evict = 0
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently written entries beyond max_entries"""
+        try:
+            names = [name for name in os.listdir(self.directory) if not name.startswith(".")]
+        except OSError:
+            return
+        if len(names) <= self.max_entries:
+            return
+        paths = []
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                paths.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+        paths.sort()
+        for _, path in paths[:len(paths) - self.max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+class SearchResultCache(object):
+    """
+    Two level cache: an in process LRU in front of an optional shared backend.
+    Values are only returned when they were cached under the current generation.
+    """
+
+    def __init__(self, max_entries, ttl_seconds, shared_backend=None, generation=None):
+        self.local = LRUCache(max_entries, ttl_seconds)
+        self.shared_backend = shared_backend
+        self.generation = generation if generation else CacheGeneration()
+
+    def get(self, key):
+        generation = self.generation.current()
+        value = self.local.get(key, generation)
+        if value is None and self.shared_backend is not None:
+            value = self.shared_backend.get(key, generation)
+            if value is not None:
+                self.local.set(key, generation, value)
+        return value
+
+    def set(self, key, value, generation=None):
+        """Pass the generation read before computing value so a bump during the query is not missed"""
+        if generation is None:
+            generation = self.generation.current()
+        self.local.set(key, generation, value)
+        if self.shared_backend is not None:
+            self.shared_backend.set(key, generation, value)
+
+def _normalize_value(value):
+    if value is None:
+        return None
+    if isinstance(value, tuple):
+        return [_normalize_value(v) for v in value]
+    if isinstance(value, (int, float, bool)):
+        return value
+    # search parameters are case insensitive like matches
+    return str(value).lower()
+
+def search_cache_key(search_parameter_object, limit, offset, sortby, desc, bbox=None, near=None, radius=None):
+    """Build a cache key that is the same for every request returning the same results"""
+    key = {
+        "search": dict((name, _normalize_value(value))
+                       for name, value in search_parameter_object._asdict().items()),
+        "limit": int(limit),
+        "offset": int(offset),
+        "sortby": _normalize_value(sortby),
+        "desc": bool(desc),
+        "bbox": _normalize_value(bbox),
+        "near": _normalize_value(near),
+        "radius": radius,
+    }
+    return json.dumps(key, sort_keys=True)
@@ -10,12 +10,118 @@ GMAIL_USER = '<user>@gmail.com'
 GMAIL_PASSWORD = '<password_here>'
 GMAIL_SENT_TO_EMAILS = ['<user>@gmail.com'] # [..., ..., ...]
 
+# notifications are sent from a background thread, 'smtp' sends through SMTP_HOST and 'log' only logs them
+NOTIFY_TRANSPORT = 'smtp'
+SMTP_HOST = 'smtp.gmail.com'
+SMTP_PORT = 465
+SMTP_USE_SSL = True
+SMTP_TIMEOUT_SECONDS = 30
+# messages to the same recipients queued within this window are sent as one digest
+NOTIFY_BATCH_SECONDS = 5
+NOTIFY_MAX_RETRIES = 4
+NOTIFY_RETRY_BACKOFF_SECONDS = 5
+# how long the end of a crawl waits for queued notifications to go out
+NOTIFY_FLUSH_TIMEOUT_SECONDS = 120
+
 # mysql connection for storage of crawled data
 MYSQL_HOST = '<mysql_host>'
 MYSQL_USER = '<mysql_user>'
 MYSQL_PASS = '<mysql_pass>'
 MYSQL_DB = '<mysql_db>'
 MYSQL_PORT = 3306
+# connections per api process, one per concurrent request
+MYSQL_POOL_SIZE = 8
+MYSQL_POOL_TIMEOUT_SECONDS = 10
+# rows pulled per round trip when streaming reads off a server side cursor
+MYSQL_STREAM_FETCH_SIZE = 1000
+# rows per chunk written to the client by the /export endpoint
+EXPORT_CHUNK_ROWS = 500
+
+# search result cache, bumping the generation file invalidates every process' cache
+CACHE_GENERATION_FILE = '/tmp/rent_price_collection_cache_generation'
+SEARCH_CACHE_MAX_ENTRIES = 1024
+SEARCH_CACHE_TTL_SECONDS = 300
+# cached results and etags also change with the latest date_changed of all_listings, re-read in the background
+# every this many seconds
+SEARCH_CACHE_WATERMARK_CHECK_SECONDS = 5
+# set to a local directory to share cached results between uwsgi processes
+SEARCH_CACHE_SHARED_DIR = None
+SEARCH_BATCH_MAX_QUERIES = 20
+
+# 'mysql' queries mysql for every search, 'columnar' serves searches from an in memory copy of all_listings
+API_SERVING_MODE = 'mysql'
+COLUMNAR_REFRESH_SECONDS = 60
+
+# /autocomplete merges in new listings every refresh and rebuilds from scratch every rebuild
+# every api worker keeps its own in memory index of all_listings while enabled
+AUTOCOMPLETE_ENABLED = False
+AUTOCOMPLETE_REFRESH_SECONDS = 60
+AUTOCOMPLETE_REBUILD_SECONDS = 3600
+
+# /tiles checks for merged listings every refresh, browsers and proxies may reuse a tile for max age
+# every api worker keeps its own in memory index of all_listings while enabled
+TILES_ENABLED = False
+TILES_REFRESH_SECONDS = 60
+TILES_CACHE_MAX_ENTRIES = 4096
+TILES_MAX_AGE_SECONDS = 300
+
+# csv of zip code centroids used to fill in missing zip codes from lat/lng, see utils/reverse_geocoder.py
+ZIP_CENTROIDS_FILE = None
+# listings further than this from every centroid keep zip code -1
+ZIP_BACKFILL_MAX_MILES = 10
+
+# gzipped archive every api request and response is appended to, see utils/http_archive.py
+HTTP_RECORD_FILE = None
+# host:port the api clients connect to over plain http instead of the real domains, e.g. scripts/replay_server.py
+API_HOST_OVERRIDE = None
+# identical GETs of the api clients share one request and are answered from memory for the ttl, see
+# RestClient. The least recently used responses are evicted past the max bytes, a ttl of 0 disables it
+REST_RESPONSE_CACHE_TTL_SECONDS = 900
+REST_RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# skip parsing and storing pages whose listing ids and prices match the last crawl, every page is stored
+# again once its fingerprint is older than the max age
+SKIP_UNCHANGED_PAGES = True
+PAGE_FINGERPRINT_MAX_AGE_DAYS = 7
+
+# directory the raw listings of every crawled page are archived to for app/reprocess.py, None disables it
+RAW_RESPONSE_ARCHIVE_DIR = None
+# 'gzip', or 'zstd' when zstandard is installed
+RAW_RESPONSE_COMPRESSION = 'gzip'
+# a new segment is started after this many uncompressed bytes or seconds
+RAW_RESPONSE_SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+RAW_RESPONSE_SEGMENT_MAX_SECONDS = 24 * 3600
+REPROCESS_WORKERS = 4
+REPROCESS_UPSERT_BATCH_SIZE = 1000
+
+# crawl metrics in the Prometheus text format, see utils/metrics.py. The file is rewritten at the end of every
+# run (e.g. for node_exporter's textfile collector), the port serves /metrics while a crawl runs
+METRICS_FILE = None
+METRICS_SUMMARY_FILE = None
+METRICS_PORT = None
+
+# profiles of crawls run with --profile and of the api, see utils/profiling.py
+PROFILE_DIR = 'profiles'
+PROFILE_SAMPLE_INTERVAL_SECONDS = 0.01
+# functions listed per stage in the .top.txt summaries
+PROFILE_TOP_N = 30
+# None, 'sampling' or 'deterministic', which only profiles API_PROFILE_SAMPLE_RATE of requests
+API_PROFILE_MODE = None
+API_PROFILE_SAMPLE_RATE = 0.01
+API_PROFILE_FLUSH_SECONDS = 60
+
+# every location crawl is appended to this file as a trace of spans, see utils/tracing.py, None disables tracing
+TRACE_FILE = None
+
+# proxies of --proxy-file are quarantined on a ban (403, 429, captcha) or after failing too often, see
+# utils/proxy_pool.py. Quarantines double for a proxy that keeps failing
+PROXY_MAX_CONSECUTIVE_FAILURES = 3
+PROXY_MIN_SUCCESS_RATE = 0.5
+PROXY_QUARANTINE_SECONDS = 300
+PROXY_MAX_QUARANTINE_SECONDS = 3600
+PROXY_PROBE_INTERVAL_SECONDS = 30
+# how long a request waits for a proxy to leave quarantine when every proxy is quarantined
+PROXY_ACQUIRE_TIMEOUT_SECONDS = 120
 
 SLEEP_BETWEEN_LOCATIONS_MIN = 10
 SLEEP_BETWEEN_LOCATIONS_MAX = 30
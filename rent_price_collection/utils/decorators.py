@@ -6,6 +6,14 @@ import time
 
 from functools import wraps
 
+from rent_price_collection.utils.metrics import (
+    increment,
+)
+from rent_price_collection.utils.tracing import (
+    add_span_event,
+    span,
+)
+
 def retry_decorator(exceptionstocheck, tries=4, delay=3, backoff=2, logger=None):
     """
     Retry calling the decorated function using an exponential backoff.
@@ -48,7 +56,11 @@ def retry_decorator(exceptionstocheck, tries=4, delay=3, backoff=2, logger=None)
                         logger.warning(msg, exc_info=1)
                     else:
                         print(msg)
-                    time.sleep(mdelay)
+                    increment("api_retries_total", function=f.__name__, exception=type(e).__name__)
+                    increment("sleep_seconds_total", mdelay, kind="retry")
+                    add_span_event("retry", function=f.__name__, exception=type(e).__name__, message=str(e))
+                    with span("retry_wait", function=f.__name__, exception=type(e).__name__, delay_seconds=mdelay):
+                        time.sleep(mdelay)
                     mtries -= 1
                     mdelay *= backoff
             return f(*args, **kwargs)
@@ -12,9 +12,16 @@ class APIRequestTimedOutException(Exception):
 class EmailSendingException(Exception):
     pass
 
+class InvalidSearchParameterException(Exception):
+    pass
+
 class MergeQueryAllListingsException(Exception):
     pass
 
+# retried like a timed out request, a proxy may leave quarantine meanwhile
+class NoProxyAvailableException(APIRequestTimedOutException):
+    pass
+
 class ResponseMissingKeyException(Exception):
     pass
 
@@ -0,0 +1,133 @@
+"""
+:author: Henley Kuang
+:since: 05/18/2019
+"""
+
+import math
+
+from collections import namedtuple
+
+from rent_price_collection.utils.exceptions import (
+    InvalidSearchParameterException,
+)
+
+EARTH_RADIUS_MILES = 3958.8
+MILES_PER_DEGREE_LAT = 69.0
+METERS_PER_MILE = 1609.344
+
+BoundingBox = namedtuple('BoundingBox', ['south', 'west', 'north', 'east'])
+GeoPoint = namedtuple('GeoPoint', ['lat', 'lng'])
+
+def _parse_floats(value, count, name):
+    try:
+        floats = [float(v) for v in value.split(",")]
+    except (AttributeError, ValueError):
+        raise InvalidSearchParameterException("%s must be %s comma separated numbers: %s" % (name, count, value))
+    if len(floats) != count:
+        raise InvalidSearchParameterException("%s must be %s comma separated numbers: %s" % (name, count, value))
+    return floats
+
+def parse_bbox(value):
+    """Parse a ``west,south,east,north`` string into a BoundingBox
+
+    >>> parse_bbox('-88.1,41.9,-87.8,42.2')
+    BoundingBox(south=41.9, west=-88.1, north=42.2, east=-87.8)
+    """
+    west, south, east, north = _parse_floats(value, 4, "bbox")
+    if not (-90 <= south <= north <= 90):
+        raise InvalidSearchParameterException("bbox latitudes out of range: %s" % value)
+    if not (-180 <= west <= 180 and -180 <= east <= 180):
+        raise InvalidSearchParameterException("bbox longitudes out of range: %s" % value)
+    return BoundingBox(south=south, west=west, north=north, east=east)
+
+def parse_near(value):
+    """Parse a ``lat,lng`` string into a GeoPoint
+
+    >>> parse_near('42.06,-87.96')
+    GeoPoint(lat=42.06, lng=-87.96)
+    """
+    lat, lng = _parse_floats(value, 2, "near")
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise InvalidSearchParameterException("near is out of range: %s" % value)
+    return GeoPoint(lat=lat, lng=lng)
+
+def parse_radius(value):
+    """Parse a radius in miles"""
+    try:
+        radius = float(value)
+    except (TypeError, ValueError):
+        raise InvalidSearchParameterException("radius must be a number of miles: %s" % value)
+    if radius <= 0:
+        raise InvalidSearchParameterException("radius must be greater than 0: %s" % value)
+    return radius
+
+def bbox_around(point, radius_miles):
+    """Return the BoundingBox enclosing a circle of radius_miles around point.
+    Used to narrow a radius search down to an index range before the exact distance check.
+    """
+    lat_diff = radius_miles / MILES_PER_DEGREE_LAT
+    cos_lat = math.cos(math.radians(point.lat))
+    if cos_lat < 1e-6:
+        lng_diff = 180.0
+    else:
+        lng_diff = min(radius_miles / (MILES_PER_DEGREE_LAT * cos_lat), 180.0)
+    return BoundingBox(
+        south=max(point.lat - lat_diff, -90.0),
+        west=max(point.lng - lng_diff, -180.0),
+        north=min(point.lat + lat_diff, 90.0),
+        east=min(point.lng + lng_diff, 180.0),
+    )
+
+def haversine_miles(lat1, lng1, lat2, lng2):
+    """Great circle distance between two points in miles"""
+    lat1, lng1, lat2, lng2 = [math.radians(v) for v in (lat1, lng1, lat2, lng2)]
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_MILES * math.asin(math.sqrt(a))
+
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+def geohash(lat, lng, precision=7):
+    """Geohash of a point, nearby points share a prefix
+
+    >>> geohash(42.06, -87.96, 6)
+    'dp3rq2'
+    """
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even_bit = True
+    while len(chars) < precision:
+        value_range, value = (lng_range, lng) if even_bit else (lat_range, lat)
+        middle = (value_range[0] + value_range[1]) / 2
+        if value >= middle:
+            bits = bits * 2 + 1
+            value_range[0] = middle
+        else:
+            bits = bits * 2
+            value_range[1] = middle
+        even_bit = not even_bit
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(GEOHASH_BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(chars)
+
+def geohash_cell_size(precision):
+    """(height, width) in degrees of a geohash cell"""
+    lng_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lng_bits
+
+def geohash_neighbors(lat, lng, precision=7):
+    """Geohash of the cell containing a point and of the 8 cells around it"""
+    height, width = geohash_cell_size(precision)
+    neighbors = set()
+    for lat_step in (-1, 0, 1):
+        for lng_step in (-1, 0, 1):
+            neighbor_lat = min(max(lat + lat_step * height, -90.0), 90.0)
+            neighbor_lng = (lng + lng_step * width + 180.0) % 360.0 - 180.0
+            neighbors.add(geohash(neighbor_lat, neighbor_lng, precision))
+    return neighbors
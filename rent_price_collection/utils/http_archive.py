@@ -0,0 +1,147 @@
+"""
+:author: Henley Kuang
+:since: 06/20/2019
+
+Record every api request and response made through RestClient, and look them up again for
+scripts/replay_server.py, so crawls can be replayed offline.
+
+An archive is a gzipped file of JSON lines, one exchange per line:
+{"time": 1561000000.0, "domain": "www.zillow.com", "method": "GET", "path": "/search/...",
+ "body": null, "status": 200, "content": "..."}
+Bodies that are not utf-8 are stored base64 encoded under content_base64 instead of content.
+"""
+
+import argparse
+import base64
+import gzip
+import json
+import logging
+import threading
+import time
+
+from collections import defaultdict
+
+from rent_price_collection.utils.config import (
+    DEFAULT_LOG_FORMAT_STRING,
+    HTTP_RECORD_FILE,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+class HttpArchiveWriter(object):
+    """Appends exchanges to a gzipped archive, safe to share between threads"""
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._lock = threading.Lock()
+        # append mode adds a gzip member per run, readers see them as one stream
+        self._file = gzip.open(path, 'ab')
+        LOGGER.info("Recording api requests to %s", path)
+
+    def record(self, domain, method, path, body, status, content):
+        exchange = {
+            "time": time.time(),
+            "domain": domain,
+            "method": method,
+            "path": path,
+            "body": body,
+            "status": status,
+        }
+        try:
+            exchange["content"] = content.decode('utf-8')
+        except UnicodeDecodeError:
+            exchange["content_base64"] = base64.b64encode(content).decode('ascii')
+        line = (json.dumps(exchange, sort_keys=True) + "\n").encode('utf-8')
+        with self._lock:
+            self._file.write(line)
+            # flush per exchange so a crawl killed midway still leaves a readable archive
+            self._file.flush()
+            self.count += 1
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+def iter_http_archive(path):
+    """Yield the exchanges of an archive in recorded order, an archive still being written is read up to its last flush"""
+    with gzip.open(path, 'rb') as archive_file:
+        try:
+            for line in archive_file:
+                if not line.strip():
+                    continue
+                exchange = json.loads(line.decode('utf-8'))
+                if "content_base64" in exchange:
+                    exchange["content"] = base64.b64decode(exchange.pop("content_base64"))
+                else:
+                    exchange["content"] = exchange["content"].encode('utf-8')
+                yield exchange
+        except (EOFError, IOError) as e:
+            LOGGER.warning("%s ends early, it was not closed: %s", path, e)
+
+class HttpArchive(object):
+    """
+    Exchanges of one or more archives by (domain, method, path). A request recorded several times is
+    answered with each recording in turn, then starts over.
+    """
+
+    def __init__(self, paths):
+        self.exchanges = defaultdict(list)
+        self._positions = defaultdict(int)
+        self._lock = threading.Lock()
+        count = 0
+        for path in paths:
+            for exchange in iter_http_archive(path):
+                self.exchanges[(exchange["domain"], exchange["method"], exchange["path"])].append(exchange)
+                count += 1
+        LOGGER.info("Loaded %s exchanges of %s distinct requests", count, len(self.exchanges))
+
+    def lookup(self, domain, method, path):
+        """:returns: the next recorded exchange of the request, None when it was never recorded"""
+        key = (domain, method, path)
+        exchanges = self.exchanges.get(key)
+        if not exchanges:
+            return None
+        with self._lock:
+            position = self._positions[key]
+            self._positions[key] = (position + 1) % len(exchanges)
+        return exchanges[position]
+
+_http_recorder = None
+_http_recorder_lock = threading.Lock()
+
+def open_http_recorder(path):
+    """Record every following RestClient request to path, None stops recording"""
+    global _http_recorder
+    with _http_recorder_lock:
+        if _http_recorder is not None:
+            _http_recorder.close()
+        _http_recorder = HttpArchiveWriter(path) if path else None
+    return _http_recorder
+
+def get_http_recorder():
+    """Shared HttpArchiveWriter, opened on HTTP_RECORD_FILE on first use, None when not recording"""
+    global _http_recorder
+    if _http_recorder is None and HTTP_RECORD_FILE is not None:
+        with _http_recorder_lock:
+            if _http_recorder is None:
+                _http_recorder = HttpArchiveWriter(HTTP_RECORD_FILE)
+    return _http_recorder
+
+def _parse_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('archive', nargs='+')
+
+    return parser.parse_args()
+
+def _main():
+    options = _parse_args()
+
+    http_archive = HttpArchive(options.archive)
+    for (domain, method, path), exchanges in sorted(http_archive.exchanges.items()):
+        LOGGER.info("%s %s%s recorded %s time(s)", method, domain, path[:120], len(exchanges))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format=DEFAULT_LOG_FORMAT_STRING, datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO)
+    _main()
@@ -0,0 +1,259 @@
+"""
+:author: Henley Kuang
+:since: 06/23/2019
+
+In process counters and latency histograms of a crawl, exported in the Prometheus text format to a file
+(e.g. for node_exporter's textfile collector) or a local /metrics endpoint, and as a JSON summary at the
+end of a run.
+
+Every metric is labeled with the labels of the enclosing context, so code far from the RPC such as
+RestClient.request is broken down by source and location without passing them around:
+
+with metrics_context(source="zillow", location=location):
+    ...
+    increment("http_requests_total", domain=domain, status=200)
+    with timer("parse_seconds"):
+        ...
+"""
+
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+LOGGER = logging.getLogger(__name__)
+
+# seconds, from a fast parse to a request held up by a slow api
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+METRIC_HELP = {
+    'http_requests_total': 'Api requests by response status',
+    'http_request_seconds': 'Api request latency, connect to last byte',
+    'http_response_bytes_total': 'Api response body bytes on the wire',
+    'http_response_decoded_bytes_total': 'Api response body bytes after decompression',
+    'http_errors_total': 'Api requests that timed out or returned an undecodable body',
+    'rest_cache_requests_total': 'Api GET requests by how they were answered: hit, coalesced or miss',
+    'api_retries_total': 'Retries of api client calls',
+    'api_response_errors_total': 'Api responses missing expected keys',
+    'pages_total': 'Result pages fetched',
+    'pages_skipped_total': 'Result pages skipped as unchanged since the last crawl',
+    'parse_seconds': 'Time to extract the listings of one page',
+    'listings_parsed_total': 'Listings extracted from result pages',
+    'storage_upsert_seconds': 'Time of one batch upsert',
+    'storage_rows_written_total': 'Rows upserted',
+    'sleep_seconds_total': 'Time spent sleeping between requests and locations',
+    'proxy_requests_total': 'Api requests by proxy and outcome',
+    'proxy_quarantines_total': 'Times a proxy was quarantined',
+}
+
+_context = threading.local()
+
+def _context_labels():
+    return getattr(_context, 'labels', {})
+
+@contextlib.contextmanager
+def metrics_context(**labels):
+    """Add labels to every metric recorded by this thread inside the block"""
+    previous = _context_labels()
+    merged = dict(previous)
+    merged.update(labels)
+    _context.labels = merged
+    try:
+        yield
+    finally:
+        _context.labels = previous
+
+def _label_key(labels):
+    merged = dict(_context_labels())
+    merged.update(labels)
+    return tuple(sorted((name, str(value)) for name, value in merged.items()))
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for name, value in pairs)
+
+class _Histogram(object):
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count', 'max')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[position] += 1
+                break
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, fraction):
+        """Estimated by interpolating within the bucket holding the quantile, capped at the largest value seen"""
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, self.counts):
+            if count and seen + count >= rank:
+                return min(lower + (bound - lower) * (rank - seen) / count, self.max)
+            seen += count
+            lower = bound
+        return self.max
+
+class MetricsRegistry(object):
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.started = time.time()
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(self.buckets)
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Observe the seconds the block took, also when it raises"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+            self.started = time.time()
+
+    def render_prometheus(self):
+        """Every metric in the Prometheus text exposition format"""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(histogram.counts), histogram.sum, histogram.count))
+                                for key, histogram in self._histograms.items())
+        lines = []
+        typed = set()
+        for (name, label_key), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# HELP %s %s' % (name, METRIC_HELP.get(name, name)))
+                lines.append('# TYPE %s counter' % name)
+            lines.append('%s%s %s' % (name, _format_labels(label_key), repr(float(value))))
+        for (name, label_key), (counts, total, count) in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# HELP %s %s' % (name, METRIC_HELP.get(name, name)))
+                lines.append('# TYPE %s histogram' % name)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append('%s_bucket%s %s' % (name, _format_labels(label_key, [('le', repr(bound))]), cumulative))
+            lines.append('%s_bucket%s %s' % (name, _format_labels(label_key, [('le', '+Inf')]), count))
+            lines.append('%s_sum%s %s' % (name, _format_labels(label_key), repr(total)))
+            lines.append('%s_count%s %s' % (name, _format_labels(label_key), count))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """JSON serializable totals of every metric, histograms with count, sum, mean and estimated p50/p95/max"""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+            summary = {"elapsed_seconds": round(time.time() - self.started, 3), "counters": [], "histograms": []}
+            for (name, label_key), value in counters:
+                summary["counters"].append({"name": name, "labels": dict(label_key), "value": value})
+            for (name, label_key), histogram in histograms:
+                summary["histograms"].append({
+                    "name": name,
+                    "labels": dict(label_key),
+                    "count": histogram.count,
+                    "sum": round(histogram.sum, 6),
+                    "mean": round(histogram.sum / histogram.count, 6) if histogram.count else None,
+                    "p50": histogram.quantile(0.5),
+                    "p95": histogram.quantile(0.95),
+                    "max": histogram.max,
+                })
+        return summary
+
+    def totals(self):
+        """Counter values and histogram sums by name, summed over every label, for a short report"""
+        totals = {}
+        with self._lock:
+            for (name, _), value in self._counters.items():
+                totals[name] = totals.get(name, 0) + value
+            for (name, _), histogram in self._histograms.items():
+                totals[name] = round(totals.get(name, 0) + histogram.sum, 6)
+        return totals
+
+    def write_prometheus_file(self, path):
+        """Write atomically, so a collector never reads half a file"""
+        temporary_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(temporary_path, 'w') as metrics_file:
+            metrics_file.write(self.render_prometheus())
+        os.rename(temporary_path, path)
+
+    def write_summary_file(self, path):
+        with open(path, 'w') as summary_file:
+            json.dump(self.summary(), summary_file, indent=2, sort_keys=True)
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOGGER.debug(format, *args)
+
+def start_metrics_server(port, registry=None, host='127.0.0.1'):
+    """Serve GET /metrics from a daemon thread for the rest of the process"""
+    server = HTTPServer((host, port), _MetricsHandler)
+    server.registry = registry if registry is not None else METRICS
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server")
+    thread.daemon = True
+    thread.start()
+    LOGGER.info("Serving metrics on http://%s:%s/metrics", host, port)
+    return server
+
+# the process wide registry
+METRICS = MetricsRegistry()
+
+def increment(name, value=1, **labels):
+    METRICS.increment(name, value, **labels)
+
+def observe(name, value, **labels):
+    METRICS.observe(name, value, **labels)
+
+def timer(name, **labels):
+    return METRICS.timer(name, **labels)
@@ -0,0 +1,77 @@
+"""
+:author: Henley Kuang
+:since: 06/01/2019
+
+Helpers to turn the display strings stored for listings into numbers.
+"""
+
+import re
+
+PRICE_REGEX = re.compile(r'\$?\s*([0-9][0-9,]*(?:\.[0-9]+)?)')
+BEDS_REGEX = re.compile(r'([0-9]+)')
+
+def parse_price(price):
+    """
+    Return the monthly price in dollars, the lower bound for ranges, None if there is no price
+
+    >>> parse_price('$2,600/mo')
+    2600
+    >>> parse_price('$1,785+')
+    1785
+    >>> parse_price('$1,200 - $1,450')
+    1200
+    >>> parse_price('-1') is None
+    True
+    """
+    if price is None:
+        return None
+    if isinstance(price, (int, float)):
+        return int(price) if price > 0 else None
+    if price.strip().startswith("-"):
+        # -1 is stored when the api had no price
+        return None
+    match = PRICE_REGEX.search(price)
+    if match is None:
+        return None
+    value = int(float(match.group(1).replace(",", "")))
+    if value <= 0:
+        return None
+    return value
+
+def parse_beds(beds):
+    """
+    Return the number of bedrooms, 0 for studios, None if unknown
+
+    >>> parse_beds('2bd')
+    2
+    >>> parse_beds('Studio')
+    0
+    >>> parse_beds('-1') is None
+    True
+    """
+    if beds is None:
+        return None
+    if isinstance(beds, int):
+        return beds if beds >= 0 else None
+    if "studio" in beds.lower():
+        return 0
+    if beds.strip().startswith("-"):
+        return None
+    match = BEDS_REGEX.search(beds)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+def percentile(sorted_values, fraction):
+    """
+    Linear interpolated percentile of an already sorted list
+
+    >>> percentile([1, 2, 3, 4], 0.5)
+    2.5
+    """
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
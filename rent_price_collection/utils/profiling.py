@@ -0,0 +1,365 @@
+"""
+:author: Henley Kuang
+:since: 06/24/2019
+
+Profiles of crawls (--profile on zillow_rpc.py and trulia_rpc.py) and of the api (API_PROFILE_MODE), broken
+down by stage. Code marks its stages, which nest:
+
+with profile_stage("fetch"):
+    ...
+    with profile_stage("decode"):
+        ...
+
+'sampling' mode walks the stacks of the profiled threads every PROFILE_SAMPLE_INTERVAL_SECONDS from a
+background thread. Its overhead does not depend on how much python runs, so it can stay on in production.
+It writes <name>.collapsed, one "stage;...;file.py:function count" line per distinct stack, for
+flamegraph.pl or speedscope, and <name>.top.txt with the samples of every stage and the top functions.
+
+'deterministic' mode runs cProfile, one profile per stage, and writes <name>.<stage>.pstats and
+<name>.top.txt with the top functions of every stage by cumulative time. It slows python code down
+severalfold, the api only runs it for API_PROFILE_SAMPLE_RATE of requests.
+
+Only threads of the OS are sampled, under gevent (run_uwsgi_gevent.sh) every greenlet shows up as the hub.
+"""
+
+import contextlib
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+
+from rent_price_collection.utils.config import (
+    PROFILE_SAMPLE_INTERVAL_SECONDS,
+    PROFILE_TOP_N,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+PROFILE_MODES = ('sampling', 'deterministic')
+# stage of code outside of any profile_stage block
+OTHER_STAGE = 'other'
+
+# thread ident -> stack of stage names, read by the sampling thread
+_thread_stages = {}
+# the running profiler of the process, None when profiling is off
+_profiler = None
+
+@contextlib.contextmanager
+def profile_stage(name):
+    """Attribute the block to a stage, a no-op unless a profiler is running"""
+    profiler = _profiler
+    if profiler is None:
+        yield
+        return
+    ident = threading.current_thread().ident
+    stages = _thread_stages.setdefault(ident, [])
+    stages.append(name)
+    profiler.enter_stage(stages)
+    try:
+        yield
+    finally:
+        stages.pop()
+        profiler.exit_stage(stages)
+        if not stages:
+            _thread_stages.pop(ident, None)
+
+def _frame_name(code, names):
+    name = names.get(code)
+    if name is None:
+        name = names[code] = "%s:%s" % (os.path.basename(code.co_filename), code.co_name)
+    return name
+
+def _write_text(path, text):
+    with io.open(path, 'w', encoding='utf-8') as text_file:
+        text_file.write(text if isinstance(text, type(u'')) else text.decode('utf-8'))
+
+class SamplingProfiler(object):
+
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL_SECONDS, all_threads=False, starting_thread=True):
+        """
+        :param all_threads: also sample threads outside of any stage, idle server threads waiting on a
+            socket otherwise crowd out the requests
+        :param starting_thread: also sample the thread starting the profiler outside of any stage
+        """
+        self.interval = interval
+        self.all_threads = all_threads
+        self.starting_thread = starting_thread
+        self.samples = 0
+        self.stacks = {}
+        self._names = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._main_ident = None
+
+    def start(self):
+        self._main_ident = threading.current_thread().ident if self.starting_thread else None
+        self._thread = threading.Thread(target=self._sample_forever, name="profile-sampler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def enter_stage(self, stages):
+        pass
+
+    def exit_stage(self, stages):
+        pass
+
+    def _sample_forever(self):
+        own_ident = threading.current_thread().ident
+        while not self._stopped.wait(self.interval):
+            self.sample(own_ident)
+
+    def sample(self, own_ident=None):
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            stages = _thread_stages.get(ident)
+            if not stages and not self.all_threads and ident != self._main_ident:
+                continue
+            frames = []
+            while frame is not None:
+                frames.append(_frame_name(frame.f_code, self._names))
+                frame = frame.f_back
+            frames.reverse()
+            # a copy, the thread may leave its stage while it is read
+            stack = ";".join(list(stages or [OTHER_STAGE]) + frames)
+            with self._lock:
+                self.samples += 1
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def collapsed(self):
+        with self._lock:
+            return "".join("%s %s\n" % (stack, count) for stack, count in sorted(self.stacks.items()))
+
+    def top(self, top_n=PROFILE_TOP_N):
+        with self._lock:
+            stacks = list(self.stacks.items())
+            samples = max(self.samples, 1)
+        stage_samples = {}
+        self_samples = {}
+        total_samples = {}
+        for stack, count in stacks:
+            frames = stack.split(";")
+            # the innermost stage, stage names carry no ':' unlike frames
+            stage = [frame for frame in frames if ':' not in frame][-1]
+            stage_samples[stage] = stage_samples.get(stage, 0) + count
+            functions = [frame for frame in frames if ':' in frame]
+            if functions:
+                self_samples[functions[-1]] = self_samples.get(functions[-1], 0) + count
+            for function in set(functions):
+                total_samples[function] = total_samples.get(function, 0) + count
+        lines = ["%s samples every %s seconds" % (self.samples, self.interval), "", "samples by stage:"]
+        for stage, count in sorted(stage_samples.items(), key=lambda item: -item[1]):
+            lines.append("%8s %5.1f%%  %s" % (count, 100.0 * count / samples, stage))
+        for title, counts in (("self", self_samples), ("total", total_samples)):
+            lines.extend(["", "top %s functions by %s samples:" % (top_n, title)])
+            for function, count in sorted(counts.items(), key=lambda item: -item[1])[:top_n]:
+                lines.append("%8s %5.1f%%  %s" % (count, 100.0 * count / samples, function))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path_prefix, top_n=PROFILE_TOP_N):
+        """:returns: paths written"""
+        _write_text(path_prefix + '.collapsed', self.collapsed())
+        _write_text(path_prefix + '.top.txt', self.top(top_n))
+        return [path_prefix + '.collapsed', path_prefix + '.top.txt']
+
+class DeterministicProfiler(object):
+    """cProfile of the thread starting the profiler, switched to the profile of the innermost stage"""
+
+    def __init__(self):
+        self.profiles = {}
+        self._ident = None
+        self._current = None
+
+    def _switch(self, stage):
+        current = self.profiles.get(self._current)
+        if current is not None:
+            current.disable()
+        self._current = stage
+        profile = self.profiles.get(stage)
+        if profile is None:
+            profile = self.profiles[stage] = cProfile.Profile()
+        profile.enable()
+
+    def start(self):
+        self._ident = threading.current_thread().ident
+        self._switch(OTHER_STAGE)
+
+    def stop(self):
+        profile = self.profiles.get(self._current)
+        if profile is not None:
+            profile.disable()
+        self._current = None
+
+    def enter_stage(self, stages):
+        if threading.current_thread().ident == self._ident and self._current is not None:
+            self._switch(stages[-1])
+
+    def exit_stage(self, stages):
+        if threading.current_thread().ident == self._ident and self._current is not None:
+            self._switch(stages[-1] if stages else OTHER_STAGE)
+
+    def top(self, top_n=PROFILE_TOP_N):
+        return stats_top(dict((stage, pstats.Stats(profile)) for stage, profile in self.profiles.items()
+                              if _has_stats(profile)), top_n)
+
+    def write(self, path_prefix, top_n=PROFILE_TOP_N):
+        """:returns: paths written"""
+        paths = []
+        for stage, profile in sorted(self.profiles.items()):
+            if _has_stats(profile):
+                paths.append('%s.%s.pstats' % (path_prefix, stage))
+                profile.dump_stats(paths[-1])
+        _write_text(path_prefix + '.top.txt', self.top(top_n))
+        return paths + [path_prefix + '.top.txt']
+
+def _has_stats(profile):
+    profile.create_stats()
+    return bool(profile.stats)
+
+def stats_top(stats_by_stage, top_n=PROFILE_TOP_N):
+    """Top functions of every stage by cumulative time, from pstats.Stats"""
+    out = io.BytesIO() if sys.version_info[0] == 2 else io.StringIO()
+    for stage, stats in sorted(stats_by_stage.items()):
+        out.write(str("==== %s: %.3f seconds\n" % (stage, stats.total_tt)))
+        stats.stream = out
+        stats.sort_stats('cumulative').print_stats(top_n)
+    return out.getvalue()
+
+def profile_path_prefix(directory, name):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return os.path.join(directory, "%s-%s-%s" % (name, time.strftime("%Y%m%dT%H%M%S"), os.getpid()))
+
+def start_profiler(mode, interval=PROFILE_SAMPLE_INTERVAL_SECONDS):
+    """Start the profiler of the process, the calling thread is always profiled"""
+    global _profiler
+    if _profiler is not None:
+        raise ValueError("A profiler is already running")
+    if mode == 'sampling':
+        profiler = SamplingProfiler(interval)
+    elif mode == 'deterministic':
+        profiler = DeterministicProfiler()
+    else:
+        raise ValueError("Unknown profile mode: %s" % mode)
+    profiler.start()
+    _profiler = profiler
+    return profiler
+
+def stop_profiler(path_prefix=None, top_n=PROFILE_TOP_N):
+    """Stop the profiler of the process and write its profile, :returns: paths written"""
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is None:
+        return []
+    profiler.stop()
+    if path_prefix is None:
+        return []
+    paths = profiler.write(path_prefix, top_n)
+    LOGGER.info("Wrote profile: %s", ", ".join(paths))
+    return paths
+
+class ProfilingMiddleware(object):
+    """
+    WSGI middleware profiling every request in 'sampling' mode, or sample_rate of requests in
+    'deterministic' mode, with the route's first path segment as stage. Profiles are rewritten every
+    flush_seconds under path_prefix.
+    """
+
+    def __init__(self, app, mode, path_prefix, sample_rate=1.0, flush_seconds=60,
+                 interval=PROFILE_SAMPLE_INTERVAL_SECONDS, top_n=PROFILE_TOP_N):
+        if mode not in PROFILE_MODES:
+            raise ValueError("Unknown profile mode: %s" % mode)
+        self.app = app
+        self.mode = mode
+        self.path_prefix = path_prefix
+        self.sample_rate = sample_rate
+        self.flush_seconds = flush_seconds
+        self.top_n = top_n
+        self.flushed = time.time()
+        self._lock = threading.Lock()
+        self._stats = {}
+        self.sampler = None
+        if mode == 'sampling':
+            global _profiler
+            # the importing thread does not serve requests
+            self.sampler = SamplingProfiler(interval, starting_thread=False)
+            self.sampler.start()
+            _profiler = self.sampler
+
+    def _stage(self, environ):
+        return "%s %s" % (environ.get('REQUEST_METHOD', 'GET'),
+                          '/' + environ.get('PATH_INFO', '/').lstrip('/').split('/')[0])
+
+    def __call__(self, environ, start_response):
+        stage = self._stage(environ)
+        if self.mode == 'sampling':
+            return self._sampled(stage, environ, start_response)
+        if random.random() < self.sample_rate:
+            return self._profiled(stage, environ, start_response)
+        return self.app(environ, start_response)
+
+    def _sampled(self, stage, environ, start_response):
+        # a generator, so streamed bodies are attributed to the request too
+        with profile_stage(stage):
+            result = self.app(environ, start_response)
+            try:
+                for chunk in result:
+                    yield chunk
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        self._maybe_flush()
+
+    def _profiled(self, stage, environ, start_response):
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            result = self.app(environ, start_response)
+            try:
+                for chunk in result:
+                    profile.disable()
+                    yield chunk
+                    profile.enable()
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        finally:
+            profile.disable()
+            if _has_stats(profile):
+                with self._lock:
+                    if stage in self._stats:
+                        self._stats[stage].add(profile)
+                    else:
+                        self._stats[stage] = pstats.Stats(profile)
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if time.time() - self.flushed < self.flush_seconds or not self._lock.acquire(False):
+            return
+        try:
+            self.flushed = time.time()
+            self.flush()
+        except Exception as e:
+            LOGGER.warning("Failed to write the api profile to %s: %s", self.path_prefix, e)
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        """Rewrite the profile files, the caller holds the lock in deterministic mode"""
+        if self.sampler is not None:
+            self.sampler.write(self.path_prefix, self.top_n)
+            return
+        for stage, stats in self._stats.items():
+            stats.dump_stats('%s.%s.pstats' % (self.path_prefix, stage.replace(' ', '_').replace('/', '')))
+        _write_text(self.path_prefix + '.top.txt', stats_top(self._stats, self.top_n))
@@ -0,0 +1,275 @@
+"""
+:author: Henley Kuang
+:since: 06/26/2019
+
+Pool of proxies the api clients spread their requests over, see --proxy-file on zillow_rpc.py and
+trulia_rpc.py. Every request leases a proxy and reports back how it went:
+
+- success: moves the proxy's success rate and latency averages
+- failure: timeouts, connection errors and 5xx, PROXY_MAX_CONSECUTIVE_FAILURES in a row or a success rate
+  under PROXY_MIN_SUCCESS_RATE quarantine the proxy
+- ban: 403, 429 or a captcha page quarantine the proxy at once
+
+Leases are drawn at random weighted by each proxy's score, its success rate over its latency and the
+requests it already has in flight, so the healthiest proxies get most of the traffic while every
+healthy proxy carries its share. Proxies without a request yet are leased first, a proxy whose requests
+all failed is scored as if they had timed out. A quarantined proxy is probed from a background thread once
+its quarantine is over and leased again once it passes. Quarantines double for a
+proxy that keeps failing, up to PROXY_MAX_QUARANTINE_SECONDS.
+
+Proxy file, one proxy per line, # starts a comment:
+10.0.0.1:3128
+user:password@10.0.0.2:3128
+"""
+
+import logging
+import random
+import threading
+import time
+
+from base64 import b64encode
+from httplib import HTTPSConnection
+
+from rent_price_collection.utils.config import (
+    PROXY_ACQUIRE_TIMEOUT_SECONDS,
+    PROXY_MAX_CONSECUTIVE_FAILURES,
+    PROXY_MAX_QUARANTINE_SECONDS,
+    PROXY_MIN_SUCCESS_RATE,
+    PROXY_PROBE_INTERVAL_SECONDS,
+    PROXY_QUARANTINE_SECONDS,
+)
+from rent_price_collection.utils.exceptions import (
+    NoProxyAvailableException,
+)
+from rent_price_collection.utils.metrics import (
+    increment,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+SUCCESS = 'success'
+FAILURE = 'failure'
+BAN = 'ban'
+BAN_STATUSES = (403, 429)
+# weight of the latest request in the moving averages
+EWMA_ALPHA = 0.2
+# success rate a proxy leaving quarantine starts over with
+PROBATION_SUCCESS_RATE = 0.5
+# requests before a low success rate alone quarantines a proxy
+MIN_REQUESTS_FOR_SUCCESS_RATE = 10
+PROBE_TIMEOUT_SECONDS = 15
+# latency scored for a proxy whose requests all failed, as slow as a request timing out
+UNMEASURED_LATENCY_SECONDS = PROBE_TIMEOUT_SECONDS
+
+class Proxy(object):
+
+    __slots__ = ('host', 'port', 'user', 'password', 'latency', 'success_rate', 'in_flight', 'requests',
+                 'failures', 'bans', 'consecutive_failures', 'quarantined', 'quarantined_until', 'quarantines',
+                 'last_domain')
+
+    def __init__(self, host, port, user=None, password=None):
+        self.host = host
+        self.port = int(port)
+        self.user = user
+        self.password = password
+        self.latency = None
+        self.success_rate = 1.0
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.bans = 0
+        self.consecutive_failures = 0
+        self.quarantined = False
+        self.quarantined_until = 0
+        self.quarantines = 0
+        self.last_domain = None
+
+    @property
+    def name(self):
+        return "%s:%s" % (self.host, self.port)
+
+    def score(self):
+        latency = self.latency if self.latency is not None else UNMEASURED_LATENCY_SECONDS
+        return self.success_rate / max(latency, 0.001) / (1 + self.in_flight)
+
+    def tunnel_headers(self):
+        """Headers of the CONNECT request opening the tunnel through the proxy"""
+        if not (self.user and self.password):
+            return None
+        credentials = b64encode(("%s:%s" % (self.user, self.password)).encode("ascii")).decode("ascii")
+        return {'Proxy-Authorization': 'Basic %s' % credentials}
+
+    def stats(self):
+        return {
+            "proxy": self.name,
+            "requests": self.requests,
+            "failures": self.failures,
+            "bans": self.bans,
+            "success_rate": round(self.success_rate, 3),
+            "latency_seconds": round(self.latency, 3) if self.latency is not None else None,
+            "quarantined": self.quarantined,
+        }
+
+def parse_proxy(spec):
+    """
+    :param spec: host:port or user:password@host:port
+
+    >>> parse_proxy('user:secret@10.0.0.2:3128').name
+    '10.0.0.2:3128'
+    """
+    user = password = None
+    if '@' in spec:
+        credentials, spec = spec.rsplit('@', 1)
+        user, _, password = credentials.partition(':')
+    host, _, port = spec.rpartition(':')
+    if not host or not port.isdigit():
+        raise ValueError("Expected [user:password@]host:port, got: %s" % spec)
+    return Proxy(host, port, user, password)
+
+def load_proxy_file(path):
+    proxies = []
+    with open(path, 'r') as proxy_file:
+        for line in proxy_file:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                proxies.append(parse_proxy(line))
+    return proxies
+
+def probe_proxy(proxy, domain, timeout=PROBE_TIMEOUT_SECONDS):
+    """:returns: True when a HEAD request to domain through the proxy is answered without a ban"""
+    connection = HTTPSConnection(proxy.host, proxy.port, timeout=timeout)
+    try:
+        connection.set_tunnel(domain, headers=proxy.tunnel_headers())
+        connection.request('HEAD', '/')
+        status = connection.getresponse().status
+        return status < 500 and status not in BAN_STATUSES
+    except Exception as e:
+        LOGGER.debug("Probe of %s failed: %s", proxy.name, e)
+        return False
+    finally:
+        connection.close()
+
+class ProxyPool(object):
+
+    def __init__(self, proxies, probe=probe_proxy, probe_interval=PROXY_PROBE_INTERVAL_SECONDS,
+                 acquire_timeout=PROXY_ACQUIRE_TIMEOUT_SECONDS):
+        """
+        :param proxies: Proxy list, see load_proxy_file
+        :param probe: function(proxy, domain) -> bool, checks a quarantined proxy
+        """
+        if not proxies:
+            raise ValueError("A proxy pool needs at least one proxy")
+        self.proxies = proxies
+        self.probe = probe
+        self.probe_interval = probe_interval
+        self.acquire_timeout = acquire_timeout
+        self._condition = threading.Condition()
+        self._stopped = threading.Event()
+        self._prober = None
+
+    def __len__(self):
+        return len(self.proxies)
+
+    def start(self):
+        """Start probing quarantined proxies in the background"""
+        self._prober = threading.Thread(target=self._probe_forever, name="proxy-prober")
+        self._prober.daemon = True
+        self._prober.start()
+
+    def close(self):
+        self._stopped.set()
+        if self._prober is not None:
+            self._prober.join()
+        LOGGER.info("Proxy pool: %s", self.stats())
+
+    def acquire(self, domain=None):
+        """
+        Lease the proxy to send the next request through, wait for one to leave quarantine when every
+        proxy is quarantined
+        :raises NoProxyAvailableException: after acquire_timeout seconds without a healthy proxy
+        """
+        deadline = time.time() + self.acquire_timeout
+        with self._condition:
+            while True:
+                available = [proxy for proxy in self.proxies if not proxy.quarantined]
+                if available:
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise NoProxyAvailableException("All %s proxies are quarantined" % len(self.proxies))
+                self._condition.wait(min(remaining, self.probe_interval))
+            untried = [proxy for proxy in available if proxy.requests == 0]
+            if untried:
+                proxy = random.choice(untried)
+            else:
+                proxy = self._weighted_choice(available)
+            proxy.in_flight += 1
+            proxy.last_domain = domain or proxy.last_domain
+            return proxy
+
+    @staticmethod
+    def _weighted_choice(proxies):
+        scores = [proxy.score() for proxy in proxies]
+        pick = random.uniform(0, sum(scores))
+        for proxy, score in zip(proxies, scores):
+            pick -= score
+            if pick <= 0:
+                return proxy
+        return proxies[-1]
+
+    def release(self, proxy, outcome, latency):
+        """Return a leased proxy with the outcome of its request, SUCCESS, FAILURE or BAN"""
+        with self._condition:
+            proxy.in_flight -= 1
+            proxy.requests += 1
+            if outcome == SUCCESS:
+                proxy.success_rate += EWMA_ALPHA * (1 - proxy.success_rate)
+                proxy.latency = latency if proxy.latency is None else proxy.latency + EWMA_ALPHA * (latency - proxy.latency)
+                proxy.consecutive_failures = 0
+            else:
+                proxy.success_rate -= EWMA_ALPHA * proxy.success_rate
+                proxy.consecutive_failures += 1
+                proxy.failures += 1
+                if outcome == BAN:
+                    proxy.bans += 1
+                    self._quarantine(proxy, "banned")
+                elif proxy.consecutive_failures >= PROXY_MAX_CONSECUTIVE_FAILURES:
+                    self._quarantine(proxy, "%s failures in a row" % proxy.consecutive_failures)
+                elif proxy.requests >= MIN_REQUESTS_FOR_SUCCESS_RATE and proxy.success_rate < PROXY_MIN_SUCCESS_RATE:
+                    self._quarantine(proxy, "success rate %.2f" % proxy.success_rate)
+        increment("proxy_requests_total", proxy=proxy.name, outcome=outcome)
+
+    def _quarantine(self, proxy, reason):
+        if proxy.quarantined:
+            return
+        seconds = min(PROXY_QUARANTINE_SECONDS * 2 ** proxy.quarantines, PROXY_MAX_QUARANTINE_SECONDS)
+        proxy.quarantined = True
+        proxy.quarantined_until = time.time() + seconds
+        proxy.quarantines += 1
+        increment("proxy_quarantines_total", proxy=proxy.name)
+        LOGGER.warning("Quarantined proxy %s for %s seconds: %s", proxy.name, seconds, reason)
+
+    def _probe_forever(self):
+        while not self._stopped.wait(self.probe_interval):
+            self.probe_quarantined()
+
+    def probe_quarantined(self):
+        """Probe every proxy whose quarantine is over, healthy ones are leased again"""
+        with self._condition:
+            due = [proxy for proxy in self.proxies if proxy.quarantined and proxy.quarantined_until <= time.time()]
+        for proxy in due:
+            # outside the lock, a probe may take PROBE_TIMEOUT_SECONDS
+            healthy = self.probe(proxy, proxy.last_domain)
+            with self._condition:
+                proxy.quarantined = False
+                if healthy:
+                    proxy.consecutive_failures = 0
+                    proxy.success_rate = PROBATION_SUCCESS_RATE
+                    LOGGER.info("Proxy %s passed its probe, leasing it again", proxy.name)
+                    self._condition.notify_all()
+                else:
+                    self._quarantine(proxy, "failed its probe")
+
+    def stats(self):
+        with self._condition:
+            return [proxy.stats() for proxy in self.proxies]
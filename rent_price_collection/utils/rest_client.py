@@ -7,69 +7,360 @@ import logging
 import json
 import socket
 import ssl
+import threading
+import time
 import xml.etree.ElementTree as ET
+import zlib
 
-from httplib import HTTPSConnection
+from base64 import b64encode
+from httplib import HTTPConnection, HTTPSConnection
 
+try:
+    import brotli
+except ImportError:
+    # brotli is optional, without it only gzip and deflate are accepted
+    brotli = None
+
+from rent_price_collection.utils.cache import (
+    SingleFlight,
+    SizedTTLCache,
+)
+from rent_price_collection.utils.config import (
+    API_HOST_OVERRIDE,
+    REST_RESPONSE_CACHE_MAX_BYTES,
+    REST_RESPONSE_CACHE_TTL_SECONDS,
+)
 from rent_price_collection.utils.exceptions import (
     APIResponseException,
     APIRequestTimedOutException,
 )
+from rent_price_collection.utils.http_archive import (
+    get_http_recorder,
+)
+from rent_price_collection.utils.metrics import (
+    increment,
+    observe,
+)
+from rent_price_collection.utils.profiling import (
+    profile_stage,
+)
+from rent_price_collection.utils.proxy_pool import (
+    BAN,
+    BAN_STATUSES,
+    FAILURE,
+    SUCCESS,
+)
+from rent_price_collection.utils.tracing import (
+    set_span_attributes,
+    span,
+)
 
 LOGGER = logging.getLogger(__name__)
 
 DEFAULT_USERAGENT = "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/51.0.2704.106 Safari/537.36";
+ACCEPT_ENCODING = "gzip, deflate, br" if brotli is not None else "gzip, deflate"
+JSON_MEDIA_TYPES = ('application/json', 'text/json', 'text/javascript')
+XML_MEDIA_TYPES = ('application/xml', 'text/xml')
+READ_CHUNK_BYTES = 64 * 1024
+# start of a raw body logged when a response is not what the api client expects
+RESPONSE_LOG_BYTES = 2048
+DECODE_ERRORS = (ValueError, zlib.error, ET.ParseError) + ((brotli.error,) if brotli is not None else ())
+
+def _media_type(content_type):
+    """
+    >>> _media_type('application/json; charset=utf-8')
+    'application/json'
+    """
+    return (content_type or '').split(';', 1)[0].strip().lower()
+
+def _is_json(media_type):
+    return media_type in JSON_MEDIA_TYPES or media_type.endswith('+json')
+
+def _is_xml(media_type):
+    return media_type in XML_MEDIA_TYPES or media_type.endswith('+xml')
+
+class _BrotliDecompressor(object):
+
+    def __init__(self):
+        self._decompressor = brotli.Decompressor()
+
+    def decompress(self, data):
+        return self._decompressor.process(data)
+
+    def flush(self):
+        return b''
+
+class _DeflateDecompressor(object):
+    """deflate is zlib wrapped, but some servers send it raw, which the first chunk tells apart"""
+
+    def __init__(self):
+        self._decompressor = None
+
+    def decompress(self, data):
+        if self._decompressor is None:
+            self._decompressor = zlib.decompressobj(zlib.MAX_WBITS)
+            try:
+                return self._decompressor.decompress(data)
+            except zlib.error:
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decompressor.decompress(data)
+
+    def flush(self):
+        return self._decompressor.flush() if self._decompressor is not None else b''
+
+def _decompressor(content_encoding):
+    """:returns: object with decompress(data) and flush(), None for identity"""
+    content_encoding = (content_encoding or 'identity').strip().lower()
+    if content_encoding in ('gzip', 'x-gzip'):
+        # 32 + MAX_WBITS reads both the gzip and the zlib header
+        return zlib.decompressobj(32 + zlib.MAX_WBITS)
+    if content_encoding == 'deflate':
+        return _DeflateDecompressor()
+    if content_encoding == 'br' and brotli is not None:
+        return _BrotliDecompressor()
+    if content_encoding == 'identity':
+        return None
+    raise ValueError("Unsupported Content-Encoding: %s" % content_encoding)
+
+def read_response_content(response):
+    """
+    Read a response body, decompressing its Content-Encoding chunk by chunk as it arrives
+    :returns: (decoded body, bytes on the wire)
+    """
+    decompressor = _decompressor(response.getheader('Content-Encoding'))
+    chunks = []
+    wire_bytes = 0
+    while True:
+        chunk = response.read(READ_CHUNK_BYTES)
+        if not chunk:
+            break
+        wire_bytes += len(chunk)
+        chunks.append(decompressor.decompress(chunk) if decompressor is not None else chunk)
+    if decompressor is not None:
+        chunks.append(decompressor.flush())
+    return b''.join(chunks), wire_bytes
+
+def response_preview(response_content):
+    """Start of a raw response body, for logs"""
+    return response_content[:RESPONSE_LOG_BYTES]
+
+def _set_path(decoded, path, value):
+    keys = path.split('.')
+    for key in keys[:-1]:
+        decoded = decoded.setdefault(key, {})
+    decoded[keys[-1]] = value
+
+def prune_json(decoded, keep):
+    """
+    Only the keep paths of a decoded JSON document, nested as they were
+
+    >>> prune_json({'page': {'cards': [1], 'ads': [2]}, 'meta': {}}, ('page.cards', 'success'))
+    {'page': {'cards': [1]}}
+    """
+    pruned = {}
+    for path in keep:
+        value = decoded
+        for key in path.split('.'):
+            if not isinstance(value, dict) or key not in value:
+                break
+            value = value[key]
+        else:
+            _set_path(pruned, path, value)
+    return pruned
+
+def decode_response_content(response_content, content_type=None, keep=None):
+    """
+    Decode a response body by its Content-Type, JSON or XML, trying JSON then XML when it is neither
+    :param keep: dotted key paths to keep of a JSON body, see prune_json, None keeps everything. What is
+        dropped is garbage as soon as the body is decoded instead of living as long as the response.
+    """
+    media_type = _media_type(content_type)
+    if _is_xml(media_type):
+        return ET.fromstring(response_content)
+    if _is_json(media_type):
+        decoded = json.loads(response_content.decode('utf-8'))
+    else:
+        try:
+            decoded = json.loads(response_content.decode('utf-8'))
+        except ValueError:
+            return ET.fromstring(response_content)
+    return prune_json(decoded, keep) if keep else decoded
+
+class ResponseCache(object):
+    """
+    Responses of GET requests by (domain, path). Concurrent requests of the same url wait for the first
+    one and share its response, which then answers the url from memory for ttl_seconds. Only the body
+    and its content type are kept, every hit decodes its own copy.
+    """
+
+    def __init__(self, max_bytes=REST_RESPONSE_CACHE_MAX_BYTES, ttl_seconds=REST_RESPONSE_CACHE_TTL_SECONDS):
+        self.responses = SizedTTLCache(max_bytes, ttl_seconds, sizeof=lambda response: len(response[1]))
+        self.in_flight = SingleFlight()
+
+    def get(self, key, fetch):
+        """:returns: the (status, content, content type) of key, from fetch() unless it is cached or in flight"""
+        response = self.responses.get(key)
+        if response is not None:
+            increment("rest_cache_requests_total", result="hit")
+            return response
+        response, shared = self.in_flight.do(key, lambda: self._fetch(key, fetch))
+        increment("rest_cache_requests_total", result="coalesced" if shared else "miss")
+        return response
+
+    def _fetch(self, key, fetch):
+        # cached by a call that finished between the lookup and this one
+        response = self.responses.get(key)
+        if response is not None:
+            return response
+        response = fetch()
+        if response[0] < 400:
+            self.responses.set(key, response)
+        return response
+
+    def invalidate(self, key):
+        self.responses.pop(key)
+
+    def clear(self):
+        self.responses.clear()
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+def get_response_cache():
+    """ResponseCache shared by every RestClient of the process, None when REST_RESPONSE_CACHE_TTL_SECONDS is 0"""
+    global _response_cache
+    if _response_cache is None and REST_RESPONSE_CACHE_TTL_SECONDS > 0:
+        with _response_cache_lock:
+            if _response_cache is None:
+                _response_cache = ResponseCache()
+    return _response_cache
 
 class RestClient(object):
 
-    __slots__ = ('proxy_ip', 'proxy_port', 'proxy_user', 'proxy_pass', 'user_agent', 'request_timeout')
+    __slots__ = ('proxy_ip', 'proxy_port', 'proxy_user', 'proxy_pass', 'user_agent', 'request_timeout', 'api_host',
+                 'proxy_pool', 'response_cache')
 
     def __init__(self, proxy_ip=None, proxy_port=None,
                  proxy_user=None, proxy_pass=None,
-                 user_agent=DEFAULT_USERAGENT, request_timeout=60):
+                 user_agent=DEFAULT_USERAGENT, request_timeout=60, api_host=None, proxy_pool=None,
+                 response_cache=None):
+        """
+        :param api_host: host:port to send every request to over plain http with the domain as Host header,
+            e.g. scripts/replay_server.py. Defaults to API_HOST_OVERRIDE.
+        :param proxy_pool: ProxyPool leasing a proxy to every request, used instead of proxy_ip
+        :param response_cache: ResponseCache of GET requests, defaults to the one shared by the process
+        """
         self.proxy_ip = proxy_ip
         self.proxy_port = proxy_port
         self.proxy_user = proxy_user
         self.proxy_pass = proxy_pass
         self.user_agent = user_agent
         self.request_timeout = request_timeout
+        self.api_host = api_host if api_host else API_HOST_OVERRIDE
+        self.proxy_pool = proxy_pool
+        self.response_cache = response_cache if response_cache is not None else get_response_cache()
 
-    def request(self, domain, path, method, data=None):
-        if self.proxy_ip and self.proxy_port:
-            connection = HTTPSConnection(self.proxy_ip, self.proxy_port, timeout=self.request_timeout)
-            connection.set_tunnel(domain)
+    def request(self, domain, path, method, data=None, keep=None, with_content=False):
+        """
+        :param keep: dotted key paths of a JSON response to return, see prune_json, None returns all of it
+        :param with_content: return (decoded, body as received) so callers can log what keep dropped
+        """
+        if method == 'GET' and self.response_cache is not None:
+            _, response_content, content_type = self.response_cache.get(
+                (domain, path), lambda: self._fetch(domain, path, method, data))
         else:
-            connection = HTTPSConnection(domain, timeout=self.request_timeout)
-        response_content = None
+            _, response_content, content_type = self._fetch(domain, path, method, data)
         try:
-            headers = {'User-Agent': self.user_agent}
+            with profile_stage("decode"):
+                decoded = decode_response_content(response_content, content_type, keep)
+        except DECODE_ERRORS as e:
+            # the retry fetches it again
+            self.invalidate(domain, path)
+            self._raise_decode_error(domain, e, response_content)
+        if with_content:
+            return decoded, response_content
+        return decoded
+
+    def invalidate(self, domain, path):
+        """Drop the cached response of a GET, e.g. one the api client found missing keys"""
+        if self.response_cache is not None:
+            self.response_cache.invalidate((domain, path))
+
+    def _raise_decode_error(self, domain, error, response_content):
+        LOGGER.error("Value error (%s) in response_content: %s", error, response_content)
+        increment("http_errors_total", domain=domain, error="decode")
+        raise APIResponseException(response_content)
+
+    def _fetch(self, domain, path, method, data):
+        """:returns: (status, decompressed body, content type) of a response that is neither a 5xx nor a ban"""
+        proxy = None
+        if self.api_host:
+            connection = HTTPConnection(self.api_host, timeout=self.request_timeout)
+        elif self.proxy_pool is not None:
+            proxy = self.proxy_pool.acquire(domain)
+            connection = HTTPSConnection(proxy.host, proxy.port, timeout=self.request_timeout)
+            connection.set_tunnel(domain, headers=proxy.tunnel_headers())
+        elif self.proxy_ip and self.proxy_port:
+            connection = HTTPSConnection(self.proxy_ip, self.proxy_port, timeout=self.request_timeout)
+            tunnel_headers = None
             if self.proxy_user and self.proxy_pass:
                 base64_bytes = b64encode(
                     ("%s:%s" % (self.proxy_user, self.proxy_pass)).encode("ascii")
                 ).decode("ascii")
-                headers['Authorization'] = 'Basic %s' % base64_bytes
-            connection.request(method, path, headers=headers, body=data)
-            response = connection.getresponse()
-            # In python3, defaultencoding is utf-8.
-            # In python2, defaultencoding is ascii.
-            response_content = response.read()
-            try:
-                # JSON
-                return json.loads(response_content.decode('utf-8'))
-            except:
-                # XML
-                return ET.fromstring(response_content)
-        except ValueError as e:
-            LOGGER.error("Value error (%s) in response_content: %s", e, response_content)
-            raise APIResponseException(response_content)
+                # the proxy authenticates the CONNECT, the api never sees the credentials
+                tunnel_headers = {'Proxy-Authorization': 'Basic %s' % base64_bytes}
+            connection.set_tunnel(domain, headers=tunnel_headers)
+        else:
+            connection = HTTPSConnection(domain, timeout=self.request_timeout)
+        response_content = None
+        start = time.time()
+        # anything but a response is the proxy's fault, e.g. a refused tunnel
+        proxy_outcome = FAILURE
+        try:
+            headers = {'User-Agent': self.user_agent, 'Accept-Encoding': ACCEPT_ENCODING}
+            if self.api_host:
+                headers['Host'] = domain
+            with span("HTTP %s" % method, **{"http.method": method, "http.host": domain, "http.target": path[:256]}):
+                connection.request(method, path, headers=headers, body=data)
+                response = connection.getresponse()
+                # In python3, defaultencoding is utf-8.
+                # In python2, defaultencoding is ascii.
+                response_content, wire_bytes = read_response_content(response)
+                set_span_attributes(**{"http.status_code": response.status,
+                                       "http.response_content_length": wire_bytes,
+                                       "http.response_content_length_uncompressed": len(response_content)})
+                if proxy is not None:
+                    set_span_attributes(proxy=proxy.name)
+            observe("http_request_seconds", time.time() - start, domain=domain)
+            increment("http_requests_total", domain=domain, status=response.status)
+            increment("http_response_bytes_total", wire_bytes, domain=domain)
+            increment("http_response_decoded_bytes_total", len(response_content), domain=domain)
+            http_recorder = get_http_recorder()
+            if http_recorder is not None:
+                http_recorder.record(domain, method, path, data, response.status, response_content)
+            if response.status >= 500:
+                raise APIResponseException("HTTP %s on %s %s" % (response.status, method, path))
+            if proxy is not None:
+                if response.status in BAN_STATUSES or b'captcha' in response_content[:4096].lower():
+                    proxy_outcome = BAN
+                    # retried through another proxy
+                    raise APIResponseException("Proxy %s was banned by %s: HTTP %s" % (proxy.name, domain, response.status))
+                proxy_outcome = SUCCESS
+            return response.status, response_content, response.getheader('Content-Type')
+        except DECODE_ERRORS as e:
+            # a body that does not decompress
+            self._raise_decode_error(domain, e, response_content)
         except (socket.timeout, ssl.SSLError) as e:
+            increment("http_errors_total", domain=domain, error="timeout")
             LOGGER.error("Timed out request on %s, %s: %s", method, path, e)
             raise APIRequestTimedOutException("Timed out request: %s" % e)
         finally:
             connection.close()
+            if proxy is not None:
+                self.proxy_pool.release(proxy, proxy_outcome, time.time() - start)
 
-    def get(self, domain, path):
-        return self.request(domain, path, 'GET')
+    def get(self, domain, path, keep=None, with_content=False):
+        return self.request(domain, path, 'GET', keep=keep, with_content=with_content)
 
     def post(self, domain, path, data):
         if isinstance(data, str):
@@ -78,5 +369,5 @@ class RestClient(object):
             data_str = json.dumps(data)
         return self.request(path, 'POST', data_str)
 
-def get_client(proxy_ip=None, proxy_port=None, proxy_user=None, proxy_pass=None):
-    return RestClient(proxy_ip, proxy_port, proxy_user, proxy_pass)
+def get_client(proxy_ip=None, proxy_port=None, proxy_user=None, proxy_pass=None, api_host=None, proxy_pool=None):
+    return RestClient(proxy_ip, proxy_port, proxy_user, proxy_pass, api_host=api_host, proxy_pool=proxy_pool)
@@ -0,0 +1,220 @@
+"""
+:author: Henley Kuang
+:since: 06/18/2019
+
+Offline reverse geocoding of lat/lng to the nearest zip code centroid, used to fill in the zip code
+(and city when missing) of listings the apis return without one, e.g. Zillow apartment complexes.
+
+Centroids are loaded from ZIP_CENTROIDS_FILE, a csv with a header and at least zip, lat and lng columns,
+city and state are used when present. The Census Gazetteer ZCTA file
+(https://www.census.gov/geographies/reference-files/time-series/geo/gazetteer-files.html, tab separated,
+GEOID/INTPTLAT/INTPTLONG columns) works as is. Points are stored as 3d unit vectors in a kd-tree, so the
+nearest neighbor by straight line distance is also the nearest on the globe.
+"""
+
+import argparse
+import csv
+import logging
+import math
+import threading
+
+from collections import namedtuple
+
+from rent_price_collection.utils.config import (
+    DEFAULT_LOG_FORMAT_STRING,
+    ZIP_BACKFILL_MAX_MILES,
+    ZIP_CENTROIDS_FILE,
+)
+from rent_price_collection.utils.geo import (
+    EARTH_RADIUS_MILES,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+ZipCentroid = namedtuple('ZipCentroid', ['zip_code', 'city', 'state', 'lat', 'lng'])
+
+# accepted header names of each column, compared lowercased and stripped
+COLUMN_NAMES = {
+    'zip_code': ('zip', 'zip_code', 'zipcode', 'postal_code', 'geoid', 'zcta5'),
+    'city': ('city', 'primary_city', 'place'),
+    'state': ('state', 'state_code', 'usps'),
+    'lat': ('lat', 'latitude', 'intptlat'),
+    'lng': ('lng', 'lon', 'long', 'longitude', 'intptlong'),
+}
+
+def _to_vector(lat, lng):
+    lat = math.radians(lat)
+    lng = math.radians(lng)
+    return (math.cos(lat) * math.cos(lng), math.cos(lat) * math.sin(lng), math.sin(lat))
+
+class KDTree(object):
+    """
+    Static 3d kd-tree, nodes are stored in flat lists with the median of each range at its middle.
+    """
+
+    def __init__(self, points, values):
+        """
+        :param points: list of (x, y, z)
+        :param values: list of values, one per point
+        """
+        order = list(range(len(points)))
+        self.points = [None] * len(points)
+        self.values = [None] * len(points)
+        self.axes = [0] * len(points)
+        # iterative build, each range is sorted on its widest axis and split at the median
+        stack = [(0, len(points), order)]
+        while stack:
+            start, end, indices = stack.pop()
+            if start >= end:
+                continue
+            axis = max(range(3), key=lambda a: max(points[i][a] for i in indices) - min(points[i][a] for i in indices))
+            indices.sort(key=lambda i: points[i][axis])
+            middle = (start + end) // 2
+            median = indices[middle - start]
+            self.points[middle] = points[median]
+            self.values[middle] = values[median]
+            self.axes[middle] = axis
+            stack.append((start, middle, indices[:middle - start]))
+            stack.append((middle + 1, end, indices[middle - start + 1:]))
+
+    def nearest(self, point):
+        """:returns: (squared distance, value) of the nearest point, None when empty"""
+        best = [float('inf'), None]
+        stack = [(0, len(self.points))]
+        while stack:
+            start, end = stack.pop()
+            if start >= end:
+                continue
+            middle = (start + end) // 2
+            node = self.points[middle]
+            distance = sum((node[a] - point[a]) ** 2 for a in range(3))
+            if distance < best[0]:
+                best[0] = distance
+                best[1] = self.values[middle]
+            difference = point[self.axes[middle]] - node[self.axes[middle]]
+            near, far = ((start, middle), (middle + 1, end)) if difference < 0 else ((middle + 1, end), (start, middle))
+            # the far side can only be closer when the splitting plane is
+            if difference ** 2 < best[0]:
+                stack.append(far)
+            stack.append(near)
+        if best[1] is None:
+            return None
+        return best[0], best[1]
+
+class ReverseGeocoder(object):
+
+    def __init__(self, centroids, max_miles=ZIP_BACKFILL_MAX_MILES):
+        """:param centroids: non empty list of ZipCentroid"""
+        if not centroids:
+            raise ValueError("No zip code centroids to search")
+        self.max_miles = max_miles
+        self.tree = KDTree([_to_vector(centroid.lat, centroid.lng) for centroid in centroids], centroids)
+        LOGGER.info("Loaded %s zip code centroids", len(centroids))
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        return cls(load_zip_centroids(path), **kwargs)
+
+    def nearest(self, lat, lng):
+        """Nearest zip code centroid, None when it is further than max_miles away e.g. outside the dataset"""
+        result = self.tree.nearest(_to_vector(lat, lng))
+        if result is None:
+            return None
+        squared_chord, centroid = result
+        miles = 2 * EARTH_RADIUS_MILES * math.asin(min(math.sqrt(squared_chord) / 2, 1.0))
+        if miles > self.max_miles:
+            return None
+        return centroid
+
+    def backfill(self, listing):
+        """
+        Return a ZillowListing or TruliaListing with zip_code, and city when it is -1, filled in from lat/lng.
+        Listings with a zip code or without coordinates are returned unchanged.
+        """
+        if int(listing.zip_code) != -1:
+            return listing
+        try:
+            lat = float(listing.lat)
+            lng = float(listing.lng)
+        except (TypeError, ValueError):
+            return listing
+        if lat == -1 and lng == -1:
+            return listing
+        centroid = self.nearest(lat, lng)
+        if centroid is None:
+            return listing
+        updates = {'zip_code': centroid.zip_code}
+        if listing.city in ('-1', b'-1') and centroid.city:
+            updates['city'] = centroid.city
+        return listing._replace(**updates)
+
+def load_zip_centroids(path):
+    with open(path, 'r') as centroids_file:
+        sample_lines = centroids_file.read(4096).splitlines()
+        if not sample_lines:
+            return []
+        centroids_file.seek(0)
+        reader = csv.reader(centroids_file, delimiter='\t' if '\t' in sample_lines[0] else ',')
+        header = [name.strip().lower() for name in next(reader)]
+        positions = {}
+        for column, names in COLUMN_NAMES.items():
+            for name in names:
+                if name in header:
+                    positions[column] = header.index(name)
+                    break
+        for column in ('zip_code', 'lat', 'lng'):
+            if column not in positions:
+                raise ValueError("%s has no %s column, expected one of %s" % (path, column, COLUMN_NAMES[column]))
+        centroids = []
+        for row in reader:
+            try:
+                centroids.append(ZipCentroid(
+                    zip_code=int(row[positions['zip_code']]),
+                    city=row[positions['city']].strip() if 'city' in positions else None,
+                    state=row[positions['state']].strip() if 'state' in positions else None,
+                    lat=float(row[positions['lat']]),
+                    lng=float(row[positions['lng']]),
+                ))
+            except (IndexError, ValueError):
+                continue
+    return centroids
+
+_reverse_geocoder = None
+_reverse_geocoder_lock = threading.Lock()
+
+def get_reverse_geocoder():
+    """Shared ReverseGeocoder loaded from ZIP_CENTROIDS_FILE on first use, None when it is not configured"""
+    global _reverse_geocoder
+    if ZIP_CENTROIDS_FILE is None:
+        return None
+    with _reverse_geocoder_lock:
+        if _reverse_geocoder is None:
+            try:
+                centroids = load_zip_centroids(ZIP_CENTROIDS_FILE)
+            except (IOError, ValueError) as e:
+                LOGGER.error("Failed to load zip code centroids, zip codes are not backfilled: %s", e)
+                return None
+            if not centroids:
+                LOGGER.warning("%s has no zip code centroids, zip codes are not backfilled", ZIP_CENTROIDS_FILE)
+                return None
+            _reverse_geocoder = ReverseGeocoder(centroids)
+    return _reverse_geocoder
+
+def _parse_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('lat', type=float)
+    parser.add_argument('lng', type=float)
+    parser.add_argument('--centroids-file', default=ZIP_CENTROIDS_FILE)
+
+    return parser.parse_args()
+
+def _main():
+    options = _parse_args()
+
+    reverse_geocoder = ReverseGeocoder.from_file(options.centroids_file)
+    LOGGER.info(reverse_geocoder.nearest(options.lat, options.lng))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format=DEFAULT_LOG_FORMAT_STRING, datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO)
+    _main()
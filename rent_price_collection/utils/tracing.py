@@ -0,0 +1,338 @@
+"""
+:author: Henley Kuang
+:since: 06/25/2019
+
+Span trees of crawls. Every location is one trace, with child spans for its page fetches, region lookups,
+http requests, retry waits, parsing, mysql reads and upserts and sleeps:
+
+with span("crawl_location", source="zillow", location=location):
+    with span("fetch_page", page=page_num):
+        ...
+
+The current span is kept per thread, so code called inside a span, such as retry_decorator or the
+storage classes, nests its spans under it without passing it around. Spans are a no-op until
+open_trace_exporter is called.
+
+Each finished trace is appended to TRACE_FILE as one line of OTLP/JSON, the format of the OpenTelemetry
+collector's file exporter, so the file can also be read by its otlpjsonfile receiver:
+{"resourceSpans": [{"resource": {...}, "scopeSpans": [{"scope": {...}, "spans": [...]}]}]}
+
+python rent_price_collection/utils/tracing.py report --file traces.jsonl --top 10
+python rent_price_collection/utils/tracing.py show --file traces.jsonl --trace-id <trace id>
+"""
+
+import argparse
+import binascii
+import contextlib
+import json
+import logging
+import numbers
+import os
+import threading
+import time
+
+from functools import wraps
+
+from rent_price_collection.utils.config import (
+    DEFAULT_LOG_FORMAT_STRING,
+    TRACE_FILE,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+SERVICE_NAME = 'rent_price_collection'
+STATUS_OK = 'STATUS_CODE_OK'
+STATUS_ERROR = 'STATUS_CODE_ERROR'
+# name of the root span of every location crawl, listed by the report
+LOCATION_SPAN_NAME = 'crawl_location'
+
+_context = threading.local()
+
+def _random_id(num_bytes):
+    return binascii.hexlify(os.urandom(num_bytes)).decode('ascii')
+
+def _otlp_value(value):
+    """OTLP/JSON AnyValue, 64 bit integers are strings in the proto3 JSON mapping"""
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, numbers.Integral):
+        return {"intValue": str(value)}
+    if isinstance(value, numbers.Real):
+        return {"doubleValue": value}
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    return {"stringValue": u"%s" % (value,)}
+
+def _otlp_attributes(attributes):
+    return [{"key": key, "value": _otlp_value(value)} for key, value in sorted(attributes.items())]
+
+def _plain_value(value):
+    if "intValue" in value:
+        return int(value["intValue"])
+    return list(value.values())[0] if value else None
+
+class Span(object):
+
+    __slots__ = ('trace', 'span_id', 'parent_span_id', 'name', 'attributes', 'events', 'start', 'end',
+                 'status', 'status_message')
+
+    def __init__(self, trace, name, parent_span_id, attributes):
+        self.trace = trace
+        self.span_id = _random_id(8)
+        self.parent_span_id = parent_span_id
+        self.name = name
+        self.attributes = attributes
+        self.events = []
+        self.start = time.time()
+        self.end = None
+        self.status = STATUS_OK
+        self.status_message = None
+
+    def to_otlp(self):
+        otlp_span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_span_id or "",
+            "name": self.name,
+            "kind": "SPAN_KIND_INTERNAL",
+            "startTimeUnixNano": str(int(self.start * 1e9)),
+            "endTimeUnixNano": str(int(self.end * 1e9)),
+            "attributes": _otlp_attributes(self.attributes),
+            "events": [{
+                "timeUnixNano": str(int(event_time * 1e9)),
+                "name": event_name,
+                "attributes": _otlp_attributes(event_attributes),
+            } for event_time, event_name, event_attributes in self.events],
+            "status": {"code": self.status},
+        }
+        if self.status_message:
+            otlp_span["status"]["message"] = self.status_message
+        return otlp_span
+
+class _Trace(object):
+    """Spans of one root span, exported together once it ends"""
+
+    __slots__ = ('trace_id', 'spans')
+
+    def __init__(self):
+        self.trace_id = _random_id(16)
+        self.spans = []
+
+class TraceExporter(object):
+    """Appends every finished trace to a JSONL file, safe to share between threads"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'ab')
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        line = json.dumps({"resourceSpans": [{
+            "resource": {"attributes": _otlp_attributes({"service.name": SERVICE_NAME, "process.pid": os.getpid()})},
+            "scopeSpans": [{
+                "scope": {"name": __name__},
+                "spans": [exported_span.to_otlp() for exported_span in spans],
+            }],
+        }]}, sort_keys=True) + "\n"
+        with self._lock:
+            self._file.write(line.encode('utf-8'))
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+_exporter = None
+
+def open_trace_exporter(path):
+    """Export traces to path from now on, None stops tracing"""
+    global _exporter
+    if _exporter is not None:
+        _exporter.close()
+    _exporter = TraceExporter(path) if path else None
+    return _exporter
+
+def _span_stack():
+    stack = getattr(_context, 'stack', None)
+    if stack is None:
+        stack = _context.stack = []
+    return stack
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Time the block as a child of the current span of this thread, or as the root of a new trace"""
+    exporter = _exporter
+    if exporter is None:
+        yield None
+        return
+    stack = _span_stack()
+    if stack:
+        current = Span(stack[-1].trace, name, stack[-1].span_id, attributes)
+    else:
+        current = Span(_Trace(), name, None, attributes)
+    stack.append(current)
+    try:
+        yield current
+    except Exception as e:
+        current.status = STATUS_ERROR
+        current.status_message = "%s: %s" % (type(e).__name__, e)
+        raise
+    finally:
+        current.end = time.time()
+        stack.pop()
+        current.trace.spans.append(current)
+        if current.parent_span_id is None:
+            try:
+                exporter.export(current.trace.spans)
+            except Exception as e:
+                LOGGER.warning("Failed to export trace %s: %s", current.trace.trace_id, e)
+
+def traced(name):
+    """Decorator running every call of the function in a span"""
+    def deco_traced(f):
+        @wraps(f)
+        def f_traced(*args, **kwargs):
+            with span(name):
+                return f(*args, **kwargs)
+        return f_traced
+    return deco_traced
+
+def set_span_attributes(**attributes):
+    """Add attributes to the current span of this thread, if any"""
+    stack = getattr(_context, 'stack', None)
+    if stack:
+        stack[-1].attributes.update(attributes)
+
+def add_span_event(name, **attributes):
+    stack = getattr(_context, 'stack', None)
+    if stack:
+        stack[-1].events.append((time.time(), name, attributes))
+
+def iter_traces(path):
+    """Yield the spans of every trace in a file as dicts with plain attributes and float seconds"""
+    with open(path, 'rb') as trace_file:
+        for line in trace_file:
+            try:
+                resource_spans = json.loads(line.decode('utf-8'))["resourceSpans"]
+            except ValueError:
+                # a partial last line of a crawl that is still writing
+                continue
+            spans = []
+            for resource_span in resource_spans:
+                for scope_span in resource_span["scopeSpans"]:
+                    for otlp_span in scope_span["spans"]:
+                        spans.append({
+                            "trace_id": otlp_span["traceId"],
+                            "span_id": otlp_span["spanId"],
+                            "parent_span_id": otlp_span.get("parentSpanId") or None,
+                            "name": otlp_span["name"],
+                            "start": int(otlp_span["startTimeUnixNano"]) / 1e9,
+                            "end": int(otlp_span["endTimeUnixNano"]) / 1e9,
+                            "attributes": dict((attribute["key"], _plain_value(attribute["value"]))
+                                               for attribute in otlp_span.get("attributes", [])),
+                            "status": otlp_span.get("status", {}).get("code", STATUS_OK),
+                        })
+            if spans:
+                yield spans
+
+def _children(spans):
+    children = {}
+    for trace_span in spans:
+        children.setdefault(trace_span["parent_span_id"], []).append(trace_span)
+    return children
+
+def critical_path(root, children):
+    """
+    Segments (span, seconds) of the chain of spans the root waited on, walking back from its end and
+    always into the child that finished last. Time not covered by a child counts toward its parent.
+    """
+    segments = []
+    cursor = root["end"]
+    for child in sorted(children.get(root["span_id"], []), key=lambda child: child["end"], reverse=True):
+        if child["end"] > cursor:
+            # overlaps a child already on the path
+            continue
+        if cursor - child["end"] > 0:
+            segments.append((root, cursor - child["end"]))
+        segments.extend(critical_path(child, children))
+        cursor = child["start"]
+    if cursor - root["start"] > 0:
+        segments.append((root, cursor - root["start"]))
+    return segments
+
+def summarize_critical_path(segments):
+    """Seconds of the critical path by span name, longest first"""
+    seconds = {}
+    for trace_span, duration in segments:
+        seconds[trace_span["name"]] = seconds.get(trace_span["name"], 0) + duration
+    return sorted(seconds.items(), key=lambda item: -item[1])
+
+def report(path, top=10, name=LOCATION_SPAN_NAME):
+    """:returns: lines listing the slowest root spans with the breakdown of their critical path"""
+    roots = []
+    for spans in iter_traces(path):
+        children = _children(spans)
+        for root in children.get(None, []):
+            if root["name"] == name:
+                roots.append((root, children))
+    roots.sort(key=lambda item: item[0]["start"] - item[0]["end"])
+    lines = []
+    for root, children in roots[:top]:
+        duration = root["end"] - root["start"]
+        lines.append("%8.1fs  %s %s  pages: %s  trace: %s" % (
+            duration, root["attributes"].get("source"), root["attributes"].get("location"),
+            len([child for child in children.get(root["span_id"], []) if child["name"] == "fetch_page"]),
+            root["trace_id"]))
+        for span_name, seconds in summarize_critical_path(critical_path(root, children)):
+            lines.append("%18.1fs %5.1f%%  %s" % (seconds, 100.0 * seconds / duration if duration else 0, span_name))
+    return lines
+
+def show(path, trace_id):
+    """:returns: lines of the span tree of one trace"""
+    lines = []
+    for spans in iter_traces(path):
+        if spans[0]["trace_id"] != trace_id:
+            continue
+        children = _children(spans)
+        def _show(trace_span, depth):
+            lines.append("%s%s %.3fs %s%s" % (
+                "  " * depth, trace_span["name"], trace_span["end"] - trace_span["start"],
+                json.dumps(trace_span["attributes"], sort_keys=True),
+                "" if trace_span["status"] != STATUS_ERROR else " ERROR"))
+            for child in sorted(children.get(trace_span["span_id"], []), key=lambda child: child["start"]):
+                _show(child, depth + 1)
+        for root in children.get(None, []):
+            _show(root, 0)
+    return lines
+
+def _parse_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+
+    command_subparser = parser.add_subparsers(dest='sub_command')
+    command_subparser.required = True
+
+    report_parser = command_subparser.add_parser('report', help='slowest locations and their critical path')
+    report_parser.add_argument('--file', default=TRACE_FILE)
+    report_parser.add_argument('--top', type=int, default=10)
+    show_parser = command_subparser.add_parser('show', help='span tree of one trace')
+    show_parser.add_argument('--file', default=TRACE_FILE)
+    show_parser.add_argument('--trace-id', required=True)
+
+    return parser.parse_args()
+
+def _main():
+    options = _parse_args()
+    if not options.file:
+        raise SystemExit("Set TRACE_FILE or pass --file")
+
+    if options.sub_command == 'report':
+        lines = report(options.file, options.top)
+    else:
+        lines = show(options.file, options.trace_id)
+    for line in lines:
+        LOGGER.info(line)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format=DEFAULT_LOG_FORMAT_STRING, datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO)
+    _main()